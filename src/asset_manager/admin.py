@@ -1,19 +1,34 @@
+import json
 from collections import OrderedDict
+from datetime import timedelta
 
 from django import forms
 from django.contrib import admin, messages
 from django.contrib.admin import helpers
 from django.contrib.auth.models import User, Permission
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from django.core.exceptions import PermissionDenied
+from django.conf.urls import url
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator, InvalidPage
+from django.db import transaction
+from django.db.models import Avg, Case, DurationField, ExpressionWrapper, F, IntegerField, Q, Sum, When
+from django.http import HttpResponseRedirect, HttpResponseNotAllowed, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.template.response import TemplateResponse
-from django.db.models import Q
 
 from .models import (
     Type, Location, Manufacturer, Supplier,
-    Office, Profile, Asset, Exchange
+    Office, Profile, Asset, AssetCount, Exchange, DirectoryMapping, Notification, Stocktake
 )
+from .exchanges import load_assets, get_pending_asset_ids, start_exchanges, end_exchanges, log_asset_changes
+from .forms import AssignToLocationForm, AssignToUserForm, HandOverForm, AssetImportForm, StocktakeForm
+from .stocktake import reconcile, apply_stocktake
+from .importer import import_assets, read_rows
+from .search import search_assets, lookup_codes
+from .warranty import WARNING_DAYS, get_expiring_assets, get_expiring_warranties
 
 
 class ProfileInline(admin.StackedInline):
@@ -28,10 +43,12 @@ class ProfileInline(admin.StackedInline):
 class UserAdmin(BaseUserAdmin):
     inlines = (ProfileInline, )
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff', 'get_location')
-    list_select_related = ('profile', )
+    list_select_related = ('profile__location', )
 
     def get_location(self, instance):
-        return instance.profile.location
+        profile = getattr(instance, 'profile', None)
+        if profile:
+            return profile.location
     get_location.short_description = 'Location'
 
     def get_inline_instances(self, request, obj=None):
@@ -79,6 +96,12 @@ class OfficeAdmin(admin.ModelAdmin):
     # ]
 
 
+class DirectoryMappingAdmin(admin.ModelAdmin):
+    list_display = ('org_unit_path', 'building_id', 'office', 'location')
+    list_select_related = ('office', 'location__office')
+    list_filter = ('office',)
+
+
 def get_permitted_locations_for_user(user, location_type=None):
     query = Q(management_group__in=user.groups.all())
     if location_type:
@@ -90,7 +113,7 @@ class AssetAdmin(admin.ModelAdmin):
     list_display = (
         'get_code', 'name', 'asset_type', 'old_code',
         'supplier', 'manufacturer',
-        'status', 'location'
+        'status', 'location', 'last_exchanged_at', 'is_recently_exchanged'
     )
 
     fieldsets = (
@@ -108,66 +131,191 @@ class AssetAdmin(admin.ModelAdmin):
         })
     )
 
+    # get_search_results searches them through asset_manager.search
+    search_fields = ('name', 'old_code')
+    actions = ['assign_to_location', 'assign_to_user', 'hand_over']
+    assign_actions = ('assign_to_location', 'assign_to_user')
+    import_errors_shown = 100
+    lookup_max_codes = 10000
+    warranty_per_page = 100
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urlpatterns = super(AssetAdmin, self).get_urls()
+        my_urls = [
+            url(r'^import/$', self.admin_site.admin_view(self.import_view), name='%s_%s_import' % info),
+            url(r'^lookup\.json$', self.admin_site.admin_view(self.lookup_json_view), name='%s_%s_lookup_json' % info),
+            url(r'^warranty/$', self.admin_site.admin_view(self.warranty_view), name='%s_%s_warranty' % info),
+        ]
+        return my_urls + urlpatterns
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search by printed code, legacy code and name, see asset_manager.search."""
+        if not search_term.strip():
+            return queryset, False
+        return search_assets(queryset, search_term), False
+
+    def lookup_json_view(self, request):
+        """Look many codes up at once for scanners and label tools: POST
+        ``{"codes": [...]}`` or GET ``?codes=PVN00001,OLD-42``.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        if request.method == 'POST':
+            try:
+                codes = [str(code) for code in json.loads(request.body.decode('utf-8'))['codes']]
+            except (ValueError, KeyError, TypeError) as e:
+                return JsonResponse({'error': 'Invalid request: %s' % e}, status=400)
+        else:
+            codes = [code for code in request.GET.get('codes', '').split(',') if code]
+        if len(codes) > self.lookup_max_codes:
+            return JsonResponse({'error': 'At most %d codes per request' % self.lookup_max_codes}, status=400)
+        results, unknown = lookup_codes(codes)
+        return JsonResponse({'results': results, 'unknown': unknown})
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        result = None
+        if request.method == 'POST':
+            form = AssetImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                result = import_assets(
+                    read_rows(upload, upload.name), create_missing=form.cleaned_data['create_missing'])
+                if not result['errors']:
+                    self.message_user(
+                        request, 'Successfully imported %d assets from %s' % (result['created'], upload.name),
+                        messages.SUCCESS)
+        else:
+            form = AssetImportForm()
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Import assets',
+            'opts': opts,
+            'form': form,
+            'result': result,
+            'errors': result['errors'][:self.import_errors_shown] if result else [],
+            'has_change_permission': self.has_change_permission(request),
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/import.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+    def warranty_view(self, request):
+        """Assets whose warranty ends within ``days``, counted per location and
+        supplier, and listed for all the groups or the selected one.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        today = timezone.now().date()
+        try:
+            days = max(int(request.GET.get('days', WARNING_DAYS)), 1)
+        except ValueError:
+            days = WARNING_DAYS
+        groups = get_expiring_warranties(today, days)
+
+        queryset = (get_expiring_assets(today, days)
+                        .select_related('asset_type', 'supplier', 'location__office')
+                        .order_by('warranty_end_date', 'pk'))
+        group = {}
+        for key in ('location', 'supplier'):
+            # an empty value selects the group of no location or supplier
+            if key in request.GET and (request.GET[key].isdigit() or not request.GET[key]):
+                group[key] = request.GET[key]
+                queryset = queryset.filter(**{key: request.GET[key] or None})
+        paginator = Paginator(queryset, self.warranty_per_page)
+        try:
+            page = paginator.page(request.GET.get('p', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Warranties ending within %d days' % days,
+            'opts': opts,
+            'days': days,
+            'groups': groups,
+            'group': group,
+            'page': page,
+            'paginator': paginator,
+            'has_change_permission': self.has_change_permission(request),
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/warranty.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+    def exchange_action(self, request, queryset, form_class, action, title):
+        """Intermediate page of the bulk exchange actions, the exchanges are
+        started once the form is submitted and the selection is valid.
+        """
+        asset_ids = list(queryset.values_list('pk', flat=True))
+        assets = load_assets(asset_ids)
+        if request.POST.get('apply'):
+            form = form_class(request.POST, user=request.user)
+            if form.is_valid():
+                errors = form.check_assets(assets, get_pending_asset_ids(asset_ids))
+                if not errors:
+                    kwargs = form.get_exchange_kwargs()
+                    try:
+                        with transaction.atomic():
+                            start_exchanges(assets, **kwargs)
+                            log_asset_changes(
+                                request.user, assets,
+                                'Started an exchange to %s: %s' % (kwargs['receiver'], title))
+                    except ValidationError as e:
+                        errors = e.messages
+                if not errors:
+                    self.message_user(request, 'Successfully started %d exchanges to %s%s' % (
+                        len(assets), kwargs['receiver'], ', taken right away' if kwargs.get('take') else ''),
+                        messages.SUCCESS)
+                    return None
+                for error in errors:
+                    form.add_error(None, error)
+        else:
+            form = form_class(user=request.user)
+
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            'title': title,
+            'form': form,
+            'assets': assets,
+            'action': action,
+            'opts': opts,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'media': self.media + form.media,
+        }
+        request.current_app = self.admin_site.name
+        return TemplateResponse(
+            request, 'admin/%s/%s/exchange_action.html' % (opts.app_label, opts.model_name), context)
+
     def assign_to_location(self, request, queryset):
-        # TODO: On the first POST request: redirect to location assign page
-        # The page must have:
-        # - A list of selected assets
-        # - A form with
-        #   - `Location` fields
-        #   - `Receiver` fields
-        #       - Will be changed when the location changes
-        #       - Will be the list of managers of the selected location
-        #   - a submit button
-
-        # TODO: When user submit the form
-        # - Check if the form is valid
-        # - If the form is valid
-        #   - Create an exchange record with:
-        #       - The current user as the sender
-        #       - The selected user as the receiver
-        #       - The selected location as the destination
-        #       - Exchange type is "location_assigning"
-        #   - If current user is the manager of destination location
-        #       - Mark the exchange is complete
-        #       - Assign the asset to the location
-        pass
+        """Move the selected assets to a location, the receiver must manage it.
+        Managers of the location take the assets right away.
+        """
+        return self.exchange_action(
+            request, queryset, AssignToLocationForm, 'assign_to_location', 'Assign assets to a location')
+    assign_to_location.short_description = 'Assign selected assets to a location'
 
     def assign_to_user(self, request, queryset):
-        # TODO: On the first POST request: redirect to user assign page
-        # The page must have:
-        # - A list of selected assets
-        # - A form with
-        #   - `Receiver` fields
-        #   - a submit button
-
-        # TODO: When user submit the form
-        # - Check if the form is valid
-        # - If the form is valid
-        #   - Create an exchange record with:
-        #       - The current user as the sender
-        #       - The selected user as the receiver
-        #       - Exchange type is "user_assigning"
-        # - If current user is the receiver
-        #   - Mark the exchange is complete
-        #   - Assign asset to the user
-        pass
+        """Assign the selected assets to a user, taken right away if the user is oneself."""
+        return self.exchange_action(
+            request, queryset, AssignToUserForm, 'assign_to_user', 'Assign assets to a user')
+    assign_to_user.short_description = 'Assign selected assets to a user'
 
     def hand_over(self, request, queryset):
-        # TODO: On the first POST request: redirect to hand over page
-        # The page must have:
-        # - A list of selected assets
-        # - A form with
-        #   - `Receiver` fields
-        #       - Receivers are only the users with assign_asset permission
-        #   - a submit button
-        # TODO: When user submit the form
-        # - Check if the form is valid
-        # - If the form is valid
-        #   - Create an exchange record with:
-        #       - The current user as the sender
-        #       - The selected user as the receiver
-        #       - Exchange type is "releasing"
-        pass
+        """Give back the assets one holds to a user who can assign assets."""
+        return self.exchange_action(
+            request, queryset, HandOverForm, 'hand_over', 'Hand over assets')
+    hand_over.short_description = 'Hand over selected assets'
 
     def save_model(self, request, obj, form, change):
         if not change:
@@ -180,10 +328,7 @@ class AssetAdmin(admin.ModelAdmin):
         # Select all unassigning assets with the user is the holder
         # also select all the assets have location managed by the user
         # exclude all exchanging assets
-        return qs.filter(
-            Q(assigned=False, holder=request.user) |
-            Q(location__in=request.user.managing_locations.all())
-        )
+        return qs.filter(pk__in=Asset.get_visible_ids(request.user))
 
     def get_actions(self, request):
         """
@@ -209,14 +354,325 @@ class AssetAdmin(admin.ModelAdmin):
                     if name in dict(self.admin_site.actions).keys()
                 )
 
+        if request.user.has_perm('asset_manager.assign_asset'):
+            actions.pop('hand_over', None)
+        else:
+            for name in self.assign_actions:
+                actions.pop(name, None)
         return actions
 
+
+class ExchangeAdmin(admin.ModelAdmin):
+    list_display = (
+        'get_asset_id', 'get_asset_name', 'get_sender', 'get_receiver',
+        'reason', 'status', 'started_at', 'kitting_dued_at',
+    )
+    list_select_related = ('asset', 'sender', 'receiver')
+    list_filter = ('status', 'reason', 'kitting_required')
+    actions = ['accept_exchanges', 'reject_exchanges', 'cancel_exchanges']
+    kitting_per_page = 100
+    # completed kittings within this period make the average lead time
+    kitting_lead_time_days = 30
+    kitting_statuses = (Exchange.STATUS_PENDING, Exchange.STATUS_TAKEN)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urlpatterns = super(ExchangeAdmin, self).get_urls()
+        my_urls = [
+            url(r'^kitting/$', self.admin_site.admin_view(self.kitting_queue_view), name='%s_%s_kitting' % info),
+        ]
+        return my_urls + urlpatterns
+
+    def get_kitting_stats(self, now):
+        """Return the SLA figures of the kitting queue per assignee and in total,
+        with one query grouped by assignee.
+        """
+        today_end = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        since = now - timedelta(days=self.kitting_lead_time_days)
+        open_kitting = {'kitting_completed_at__isnull': True}
+
+        def count(**conditions):
+            return Sum(Case(When(then=1, **conditions), default=0, output_field=IntegerField()))
+
+        rows = list(
+            Exchange.objects
+                    .filter(kitting_required=True, status__in=self.kitting_statuses)
+                    .filter(Q(kitting_completed_at__isnull=True) | Q(kitting_completed_at__gte=since))
+                    .values('kitting_by__username')
+                    .annotate(
+                        open=count(**open_kitting),
+                        overdue=count(kitting_dued_at__lt=now, **open_kitting),
+                        due_today=count(kitting_dued_at__gte=now, kitting_dued_at__lt=today_end, **open_kitting),
+                        completed=count(kitting_completed_at__isnull=False),
+                        lead_time=Avg(Case(
+                            When(kitting_completed_at__isnull=False,
+                                 then=ExpressionWrapper(F('kitting_completed_at') - F('started_at'),
+                                                        output_field=DurationField())),
+                            output_field=DurationField())),
+                    )
+                    .order_by('kitting_by__username'))
+        total = {
+            key: sum(row[key] for row in rows)
+            for key in ('open', 'overdue', 'due_today', 'completed')
+        }
+        lead_times = [(row['lead_time'], row['completed']) for row in rows if row['lead_time'] is not None]
+        total['lead_time'] = (
+            sum((lead_time * completed for lead_time, completed in lead_times), timedelta()) / total['completed']
+            if lead_times else None)
+        return rows, total
+
+    def kitting_queue_view(self, request):
+        if not (self.has_change_permission(request) or request.user.has_perm('asset_manager.kitting_asset')):
+            raise PermissionDenied
+        opts = self.model._meta
+        now = timezone.now()
+        mine = request.GET.get('mine') == '1'
+
+        queryset = (Exchange.objects
+                            .filter(kitting_required=True, kitting_completed_at__isnull=True,
+                                    status__in=self.kitting_statuses)
+                            .select_related('asset', 'receiver', 'kitting_by', 'destination__office')
+                            .order_by(F('kitting_dued_at').asc(nulls_last=True), 'started_at'))
+        if mine:
+            queryset = queryset.filter(kitting_by=request.user)
+        paginator = Paginator(queryset, self.kitting_per_page)
+        try:
+            page = paginator.page(request.GET.get('p', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+        stats, total = self.get_kitting_stats(now)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Kitting queue',
+            'opts': opts,
+            'now': now,
+            'mine': mine,
+            'page': page,
+            'paginator': paginator,
+            'stats': stats,
+            'total': total,
+            'lead_time_days': self.kitting_lead_time_days,
+            'has_change_permission': self.has_change_permission(request),
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/kitting_queue.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+    def end_exchanges(self, request, queryset, status, verb):
+        """End the selected pending exchanges ``request.user`` may end: the ones
+        they receive, or send when cancelling.
+        """
+        selected = queryset.count()
+        own = {'sender': request.user} if status == Exchange.STATUS_CANCELLED else {'receiver': request.user}
+        ended = end_exchanges(list(queryset.filter(**own).values_list('pk', flat=True)), status, request.user)
+        if ended:
+            self.message_user(request, 'Successfully %s %d exchanges' % (verb, len(ended)), messages.SUCCESS)
+        if len(ended) < selected:
+            self.message_user(
+                request, '%d exchanges were not %s, they are not pending or not yours' % (
+                    selected - len(ended), verb), messages.WARNING)
+
+    def accept_exchanges(self, request, queryset):
+        self.end_exchanges(request, queryset, Exchange.STATUS_TAKEN, 'accepted')
+    accept_exchanges.short_description = 'Accept selected exchanges'
+
+    def reject_exchanges(self, request, queryset):
+        self.end_exchanges(request, queryset, Exchange.STATUS_REJECTED, 'rejected')
+    reject_exchanges.short_description = 'Reject selected exchanges'
+
+    def cancel_exchanges(self, request, queryset):
+        self.end_exchanges(request, queryset, Exchange.STATUS_CANCELLED, 'cancelled')
+    cancel_exchanges.short_description = 'Cancel selected exchanges'
+
+
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'message', 'created_at', 'sent_at')
+    list_select_related = ('recipient',)
+    search_fields = ('recipient__username', 'message')
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+
+class StocktakeAdmin(admin.ModelAdmin):
+    list_display = ('location', 'created_by', 'created_at', 'scanned', 'found', 'missing', 'misplaced', 'unknown')
+    list_select_related = ('location__office', 'created_by')
+    list_filter = (('location', admin.RelatedOnlyFieldListFilter),)
+    date_hierarchy = 'created_at'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urlpatterns = super(StocktakeAdmin, self).get_urls()
+        my_urls = [
+            url(r'^scan\.json$', self.admin_site.admin_view(self.scan_json_view), name='%s_%s_scan_json' % info),
+        ]
+        return my_urls + urlpatterns
+
+    def render_report(self, request, title, report, form=None, stocktake=None):
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            'title': title,
+            'opts': opts,
+            'form': form,
+            'report': report,
+            'stocktake': stocktake,
+            'has_change_permission': self.has_change_permission(request),
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/report.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+    def add_view(self, request, form_url='', extra_context=None):
+        """Scan form, previews the report or applies it."""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        report = None
+        if request.method == 'POST':
+            form = StocktakeForm(request.POST, request.FILES)
+            if form.is_valid():
+                location = form.cleaned_data['location']
+                codes = form.cleaned_data['scanned_codes']
+                if form.cleaned_data['apply']:
+                    stocktake, report = apply_stocktake(location, codes, request.user)
+                    self.log_addition(request, stocktake, 'Applied the stocktake of %s' % location)
+                    self.message_user(request, 'Successfully applied the stocktake of %s' % location, messages.SUCCESS)
+                    opts = self.model._meta
+                    return HttpResponseRedirect(
+                        reverse('admin:%s_%s_change' % (opts.app_label, opts.model_name), args=(stocktake.pk,)))
+                report = reconcile(location, codes)
+        else:
+            form = StocktakeForm()
+        return self.render_report(request, 'Stocktake', report, form=form)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        stocktake = get_object_or_404(Stocktake.objects.select_related('location__office', 'created_by'), pk=object_id)
+        return self.render_report(request, str(stocktake), json.loads(stocktake.report), stocktake=stocktake)
+
+    def scan_json_view(self, request):
+        """Stocktake for scanners: POST ``{"location": id, "codes": [...], "apply": bool}``
+        and get the report back.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+            location = Location.objects.get(pk=data['location'])
+            codes = [str(code) for code in data['codes']]
+        except (ValueError, KeyError, TypeError, Location.DoesNotExist) as e:
+            return JsonResponse({'error': 'Invalid request: %s' % e}, status=400)
+        if data.get('apply'):
+            stocktake, report = apply_stocktake(location, codes, request.user)
+            self.log_addition(request, stocktake, 'Applied the stocktake of %s' % location)
+            report['id'] = stocktake.pk
+        else:
+            report = reconcile(location, codes)
+        return JsonResponse(report)
+
+
+class AssetCountAdmin(admin.ModelAdmin):
+    """Report of the asset counts per office, and per location of an office,
+    read from the AssetCount rollup with one grouped query.
+    """
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_model_perms(self, request):
+        return {'change': self.has_change_permission(request)}
+
+    @staticmethod
+    def get_status_columns():
+        """Return the labels of the distinct status values, some statuses
+        share a value.
+        """
+        columns = OrderedDict()
+        for status, label in Asset.STATUSES_ALL:
+            columns[status] = '%s / %s' % (columns[status], label) if status in columns else label
+        return columns
+
+    def get_report_rows(self, office_id=None, asset_type_id=None):
+        """Return the rows of the report, one per office or per location of
+        ``office_id``, with the counts per status and their total.
+        """
+        counts = AssetCount.objects.filter(count__gt=0)
+        if asset_type_id:
+            counts = counts.filter(asset_type_id=asset_type_id)
+        if office_id:
+            group_by = ('location_id', 'location__name')
+            counts = counts.filter(location__office_id=office_id)
+        else:
+            group_by = ('location__office_id', 'location__office__name')
+        statuses = self.get_status_columns()
+        rows = OrderedDict()
+        for values in counts.values(*group_by, 'status').annotate(total=Sum('count')).order_by(group_by[1], 'status'):
+            pk, name = values[group_by[0]], values[group_by[1]]
+            row = rows.setdefault(pk, {'pk': pk, 'name': name, 'counts': OrderedDict(
+                (status, 0) for status in statuses), 'total': 0})
+            row['counts'][values['status']] += values['total']
+            row['total'] += values['total']
+        return list(rows.values())
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        office = None
+        if request.GET.get('office'):
+            office = get_object_or_404(Office, pk=request.GET['office'])
+        asset_type = None
+        if request.GET.get('type'):
+            asset_type = get_object_or_404(Type, pk=request.GET['type'])
+        statuses = self.get_status_columns()
+        rows = self.get_report_rows(office and office.pk, asset_type and asset_type.pk)
+        totals = {
+            'counts': [sum(row['counts'][status] for row in rows) for status in statuses],
+            'total': sum(row['total'] for row in rows),
+        }
+        for row in rows:
+            row['counts'] = list(row['counts'].items())
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Asset counts of %s' % office if office else 'Asset counts',
+            'opts': opts,
+            'office': office,
+            'asset_type': asset_type,
+            'types': Type.objects.order_by('name'),
+            'statuses': list(statuses.values()),
+            'rows': rows,
+            'totals': totals,
+            **(extra_context or {}),
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/report.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(Manufacturer, ManufacturerAdmin)
 admin.site.register(Location, LocationAdmin)
 admin.site.register(Office, OfficeAdmin)
+admin.site.register(DirectoryMapping, DirectoryMappingAdmin)
 admin.site.register(Type, TypeAdmin)
 admin.site.register(Supplier, SupplierAdmin)
 admin.site.register(Asset, AssetAdmin)
-admin.site.register(Exchange)
+admin.site.register(Exchange, ExchangeAdmin)
+admin.site.register(Notification, NotificationAdmin)
+admin.site.register(Stocktake, StocktakeAdmin)
+admin.site.register(AssetCount, AssetCountAdmin)
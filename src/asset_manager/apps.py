@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AssetManagerConfig(AppConfig):
     name = 'asset_manager'
     verbose_name = 'Asset Manager'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        from . import signals  # noqa
+        post_migrate.connect(signals.create_asset_search_index, sender=self)
+        post_migrate.connect(signals.fill_location_visibility, sender=self)
@@ -0,0 +1,160 @@
+"""Bulk exchange workflows of the asset admin actions.
+
+A workflow loads the selected assets with one query, validates the whole
+selection with set-based queries, then creates all the exchanges with one
+bulk insert and moves the assets with one update, in one transaction,
+which also refreshes their denormalized exchange fields and queues the
+notifications. Pending exchanges are ended the same way. The number of
+queries does not depend on the number of assets.
+"""
+from collections import defaultdict
+
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Asset, Exchange, Notification
+
+
+def load_assets(asset_ids):
+    return list(
+        Asset.objects
+             .filter(pk__in=asset_ids)
+             .values('pk', 'name', 'location_id', 'holder_id', 'assigned', 'asset_type__kitting_required')
+             .order_by('pk'))
+
+
+def get_pending_asset_ids(asset_ids):
+    """Return the ids of the assets having a pending exchange."""
+    return set(
+        Exchange.objects
+                .filter(asset__in=asset_ids, status=Exchange.STATUS_PENDING)
+                .values_list('asset_id', flat=True))
+
+
+@transaction.atomic
+def start_exchanges(assets, sender, receiver, reason, destination=None, comment='', take=False, assigned=False):
+    """Create one exchange per asset from ``sender`` to ``receiver``.
+
+    With ``take`` the exchanges are taken right away: the assets go to the
+    receiver, and to ``destination`` if set, ``assigned`` tells whether the
+    receiver uses them or keeps them in stock. Otherwise the exchanges wait
+    for the receiver.
+    """
+    now = timezone.now()
+    asset_ids = [asset['pk'] for asset in assets]
+    # lock the assets so no other exchange starts meanwhile
+    list(Asset.objects.select_for_update().filter(pk__in=asset_ids).values_list('pk'))
+    if get_pending_asset_ids(asset_ids):
+        raise ValidationError('Some assets got a pending exchange meanwhile, please try again.')
+
+    status = Exchange.STATUS_TAKEN if take else Exchange.STATUS_PENDING
+    exchanges = [
+        Exchange(
+            asset_id=asset['pk'],
+            sender=sender,
+            receiver=receiver,
+            source_id=asset['location_id'],
+            destination=destination,
+            reason=reason,
+            status=status,
+            ended_at=now if take else None,
+            ended_by=sender if take else None,
+            kitting_required=asset['asset_type__kitting_required'],
+            assigned=assigned,
+            comment=comment,
+        ) for asset in assets
+    ]
+    Exchange.objects.bulk_create(exchanges)
+    if not take:
+        Notification.queue(
+            (receiver.pk, '%s sent you %s %s, accept or reject it in the exchanges' % (
+                sender, Asset(pk=asset['pk']).get_code(), asset['name']))
+            for asset in assets)
+    if take:
+        values = {'holder': receiver, 'assigned': assigned, 'updated_at': now}
+        if destination:
+            values['location'] = destination
+        Asset.objects.filter(pk__in=asset_ids).update(**values)
+    Asset.update_exchange_fields(asset_ids)
+    return exchanges
+
+
+ENDED_STATUSES = (Exchange.STATUS_TAKEN, Exchange.STATUS_REJECTED, Exchange.STATUS_CANCELLED)
+
+
+@transaction.atomic
+def end_exchanges(exchange_ids, status, user):
+    """Move the pending exchanges among ``exchange_ids`` to ``status`` and
+    return the ids of the ones moved.
+
+    The pending exchanges are locked, with their assets, before their status
+    is changed with one update, so exchanges ended meanwhile by someone else
+    are left alone. The assets of taken exchanges go to their receiver, and
+    destination if any, with one update per receiver and destination.
+    """
+    if status not in ENDED_STATUSES:
+        raise ValueError('Invalid status %s' % status)
+    now = timezone.now()
+    ended = list(
+        Exchange.objects
+                .select_for_update()
+                .filter(pk__in=exchange_ids, status=Exchange.STATUS_PENDING)
+                .values('pk', 'asset_id', 'asset__name', 'sender_id', 'receiver_id', 'destination_id', 'assigned'))
+    if not ended:
+        return []
+    Exchange.objects.filter(pk__in=[exchange['pk'] for exchange in ended]).update(
+        status=status, ended_at=now, ended_by=user)
+    notify_exchange_ends(ended, status, user)
+
+    if status == Exchange.STATUS_TAKEN:
+        targets = defaultdict(list)
+        for exchange in ended:
+            key = (exchange['receiver_id'], exchange['destination_id'], exchange['assigned'])
+            targets[key].append(exchange['asset_id'])
+        for (receiver_id, destination_id, assigned), asset_ids in targets.items():
+            values = {'holder_id': receiver_id, 'assigned': assigned, 'updated_at': now}
+            if destination_id:
+                values['location_id'] = destination_id
+            Asset.objects.filter(pk__in=asset_ids).update(**values)
+    Asset.update_exchange_fields([exchange['asset_id'] for exchange in ended])
+    return [exchange['pk'] for exchange in ended]
+
+
+def notify_exchange_ends(exchanges, status, user):
+    """Queue notifications of ended exchanges: their sender learns the receiver
+    answer, their receiver a cancellation. Cancellations by someone else than
+    the sender, eg: stale ones, are sent to both.
+    """
+    verb = dict(((Exchange.STATUS_TAKEN, 'accepted'),
+                 (Exchange.STATUS_REJECTED, 'rejected'),
+                 (Exchange.STATUS_CANCELLED, 'cancelled')))[status]
+    messages = []
+    for exchange in exchanges:
+        message = '%s %s the exchange of %s %s' % (
+            user, verb, Asset(pk=exchange['asset_id']).get_code(), exchange['asset__name'])
+        recipients = set()
+        if status != Exchange.STATUS_CANCELLED or exchange['sender_id'] != user.pk:
+            recipients.add(exchange['sender_id'])
+        if status == Exchange.STATUS_CANCELLED:
+            recipients.add(exchange['receiver_id'])
+        recipients.discard(user.pk)
+        messages.extend((recipient_id, message) for recipient_id in recipients)
+    Notification.queue(messages)
+
+
+def log_asset_changes(user, assets, message):
+    """Add one admin log entry per asset with a single insert."""
+    content_type_id = ContentType.objects.get_for_model(Asset).pk
+    LogEntry.objects.bulk_create([
+        LogEntry(
+            user_id=user.pk,
+            content_type_id=content_type_id,
+            object_id=str(asset['pk']),
+            object_repr=asset['name'][:200],
+            action_flag=CHANGE,
+            change_message=message,
+        ) for asset in assets
+    ])
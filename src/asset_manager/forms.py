@@ -0,0 +1,137 @@
+from django import forms
+from django.contrib.auth.models import Permission, User
+from django.db.models import Q
+
+from .models import Asset, Exchange, Location
+from .stocktake import split_codes
+
+
+def get_asset_codes(assets, limit=10):
+    codes = ', '.join(Asset(pk=asset['pk']).get_code() for asset in assets[:limit])
+    if len(assets) > limit:
+        codes += '...'
+    return codes
+
+
+class ExchangeActionForm(forms.Form):
+    """Parameters and set-based checks of a bulk exchange admin action."""
+    receiver = forms.ModelChoiceField(queryset=User.objects.filter(is_active=True).order_by('username'))
+    reason = forms.TypedChoiceField(choices=Exchange.REASONS_ADMIN, coerce=int, initial=Exchange.REASON_EXCHANGE)
+    comment = forms.CharField(widget=forms.Textarea(attrs={'rows': 3}), required=False)
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop('user')
+        super(ExchangeActionForm, self).__init__(*args, **kwargs)
+
+    def check_assets(self, assets, pending_ids):
+        """Return the errors of the selection, ``pending_ids`` are the ids of
+        the selected assets having a pending exchange.
+        """
+        errors = []
+        pending = [asset for asset in assets if asset['pk'] in pending_ids]
+        if pending:
+            errors.append('%d assets already have a pending exchange: %s' % (len(pending), get_asset_codes(pending)))
+        return errors
+
+    def check_not_assigned(self, assets):
+        """Return the error of the selected assets in use by users, if any."""
+        assigned = [asset for asset in assets if asset['assigned']]
+        if assigned:
+            return ['%d assets are assigned to users, they must be handed over first: %s' % (
+                len(assigned), get_asset_codes(assigned))]
+        return []
+
+    def get_exchange_kwargs(self):
+        """Return the keyword arguments of ``asset_manager.exchanges.start_exchanges``."""
+        return {
+            'sender': self.user,
+            'receiver': self.cleaned_data['receiver'],
+            'reason': self.cleaned_data['reason'],
+            'comment': self.cleaned_data['comment'],
+        }
+
+
+class AssignToLocationForm(ExchangeActionForm):
+    location = forms.ModelChoiceField(queryset=Location.objects.select_related('office'))
+
+    field_order = ['location', 'receiver', 'reason', 'comment']
+
+    def clean(self):
+        cleaned_data = super(AssignToLocationForm, self).clean()
+        location = cleaned_data.get('location')
+        receiver = cleaned_data.get('receiver')
+        if location and receiver and not location.managers.filter(pk=receiver.pk).exists():
+            self.add_error('receiver', 'The receiver must be a manager of %s.' % location)
+        return cleaned_data
+
+    def check_assets(self, assets, pending_ids):
+        errors = super(AssignToLocationForm, self).check_assets(assets, pending_ids)
+        return errors + self.check_not_assigned(assets)
+
+    def get_exchange_kwargs(self):
+        kwargs = super(AssignToLocationForm, self).get_exchange_kwargs()
+        location = self.cleaned_data['location']
+        kwargs['destination'] = location
+        # managers of the destination take the assets right away
+        kwargs['take'] = location.managers.filter(pk=self.user.pk).exists()
+        kwargs['assigned'] = False
+        return kwargs
+
+
+class AssignToUserForm(ExchangeActionForm):
+    def check_assets(self, assets, pending_ids):
+        errors = super(AssignToUserForm, self).check_assets(assets, pending_ids)
+        return errors + self.check_not_assigned(assets)
+
+    def get_exchange_kwargs(self):
+        kwargs = super(AssignToUserForm, self).get_exchange_kwargs()
+        kwargs['take'] = kwargs['receiver'] == self.user
+        kwargs['assigned'] = True
+        return kwargs
+
+
+class HandOverForm(ExchangeActionForm):
+    def __init__(self, *args, **kwargs):
+        super(HandOverForm, self).__init__(*args, **kwargs)
+        permission = Permission.objects.filter(content_type__app_label='asset_manager', codename='assign_asset')
+        self.fields['receiver'].queryset = (
+            self.fields['receiver'].queryset
+                .filter(Q(is_superuser=True) | Q(user_permissions__in=permission) | Q(groups__permissions__in=permission))
+                .exclude(pk=self.user.pk)
+                .distinct())
+        self.fields['reason'].initial = Exchange.REASON_RETURN
+
+    def check_assets(self, assets, pending_ids):
+        errors = super(HandOverForm, self).check_assets(assets, pending_ids)
+        not_held = [asset for asset in assets if asset['holder_id'] != self.user.pk]
+        if not_held:
+            errors.append('%d assets are not held by you: %s' % (len(not_held), get_asset_codes(not_held)))
+        return errors
+
+
+class AssetImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV or XLSX file, see the import-assets command for the columns.')
+    create_missing = forms.BooleanField(
+        required=False, help_text='Create the unknown types, manufacturers, suppliers and locations.')
+
+
+class StocktakeForm(forms.Form):
+    location = forms.ModelChoiceField(queryset=Location.objects.select_related('office'))
+    codes = forms.CharField(
+        widget=forms.Textarea(attrs={'rows': 10}), required=False,
+        help_text='Scanned asset codes, one per line.')
+    file = forms.FileField(required=False, help_text='Or a text or CSV file of the scanned codes.')
+    apply = forms.BooleanField(
+        required=False,
+        help_text='Mark the missing assets not found and move the misplaced ones here. '
+                  'Otherwise only preview the report.')
+
+    def clean(self):
+        cleaned_data = super(StocktakeForm, self).clean()
+        codes = split_codes(cleaned_data.get('codes') or '')
+        if cleaned_data.get('file'):
+            codes.extend(split_codes(cleaned_data['file'].read().decode('utf-8-sig', 'replace')))
+        if not codes:
+            raise forms.ValidationError('Enter or upload the scanned codes.')
+        cleaned_data['scanned_codes'] = codes
+        return cleaned_data
@@ -0,0 +1,230 @@
+"""Import assets from CSV or XLSX files.
+
+The rows are streamed from the file and checked in one pass: the names of
+types, manufacturers, suppliers and locations are resolved with maps loaded
+by one query per model, the dates with ``Asset.check_dates``. Nothing is
+inserted unless the whole file is valid, then the missing lookups are
+created if asked and the assets are inserted with bulk_create in chunks,
+or one by one on databases not returning the ids of bulk inserts, as the
+codes of the assets are made from their ids.
+"""
+import csv
+import io
+import os
+from collections import Counter
+from datetime import date, datetime
+from functools import lru_cache
+
+from django.db import connection, transaction
+
+from .models import Asset, AssetCount, Location, Manufacturer, Office, Supplier, Type
+
+COLUMNS = (
+    'name', 'type', 'old_code', 'manufacturer', 'supplier', 'office', 'location',
+    'purchased_date', 'warranty_start_date', 'warranty_end_date', 'origin', 'status', 'note',
+)
+REQUIRED_COLUMNS = ('name', 'type', 'office', 'location')
+DATE_COLUMNS = ('purchased_date', 'warranty_start_date', 'warranty_end_date')
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y')
+LOOKUP_MODELS = (('type', Type), ('manufacturer', Manufacturer), ('supplier', Supplier))
+
+
+def read_csv(f):
+    for row in csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig')):
+        yield row
+
+
+def read_xlsx(f):
+    # only needed for XLSX files
+    from openpyxl import load_workbook
+
+    rows = load_workbook(f, read_only=True).active.iter_rows(values_only=True)
+    header = [str(value or '') for value in next(rows, ())]
+    for values in rows:
+        if any(value not in (None, '') for value in values):
+            yield dict(zip(header, values))
+
+
+def read_rows(f, filename):
+    """Yield the rows of a CSV or XLSX file, chosen by the file extension, as
+    dicts with lowercase column names.
+    """
+    reader = read_xlsx if os.path.splitext(filename)[1].lower() == '.xlsx' else read_csv
+    for row in reader(f):
+        yield {str(key).strip().lower(): value for key, value in row.items() if key}
+
+
+def get_choices(choices):
+    values = {label.lower(): value for value, label in choices}
+    values.update((str(value), value) for value, label in choices)
+    return values
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return parse_date_string(value)
+
+
+@lru_cache(maxsize=4096)
+def parse_date_string(value):
+    # the same few dates repeat over a whole inventory
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError('invalid date %s, expected YYYY-MM-DD or DD/MM/YYYY' % value)
+
+
+def parse_row(row, origins, statuses):
+    """Return the cleaned values of a row and its errors."""
+    values = {key: str(row.get(key) or '').strip() for key in COLUMNS if key not in DATE_COLUMNS}
+    errors = ['%s is required' % key for key in REQUIRED_COLUMNS if not values[key]]
+    for key in DATE_COLUMNS:
+        values[key] = None
+        if row.get(key) not in (None, ''):
+            try:
+                values[key] = parse_date(row[key] if isinstance(row[key], date) else str(row[key]).strip())
+            except ValueError as e:
+                errors.append('%s: %s' % (key, e))
+    errors.extend('%s: %s' % (key, message) for key, message in Asset.check_dates(
+        values['purchased_date'], values['warranty_start_date'], values['warranty_end_date']).items())
+    for key, choices, default in (('origin', origins, Asset.BRAND_NEW), ('status', statuses, Asset.EXCELLENCE)):
+        if not values[key]:
+            values[key] = default
+        elif values[key].lower() in choices:
+            values[key] = choices[values[key].lower()]
+        else:
+            errors.append('%s: unknown value %s' % (key, values[key]))
+    for key in ('name', 'old_code'):
+        if len(values[key]) > 100:
+            errors.append('%s: longer than 100 characters' % key)
+    return values, errors
+
+
+def load_lookups():
+    """Return the maps of lowercase names to ids, one query per model."""
+    lookups = {
+        key: {name.lower(): pk for pk, name in model.objects.values_list('pk', 'name')}
+        for key, model in LOOKUP_MODELS
+    }
+    lookups['office'] = {name.lower(): pk for pk, name in Office.objects.values_list('pk', 'name')}
+    lookups['location'] = {
+        (office_name.lower(), name.lower()): pk
+        for pk, office_name, name in Location.objects.values_list('pk', 'office__name', 'name')
+    }
+    return lookups
+
+
+def create_lookups(lookups, missing):
+    """Create the missing types, manufacturers, suppliers and locations with one
+    insert per model and add them to ``lookups``. Return the number created
+    per model.
+    """
+    created = {}
+    for key, model in LOOKUP_MODELS:
+        kwargs = {'kitting_required': False} if model is Type else {}
+        model.objects.bulk_create([model(name=name, **kwargs) for name, line in missing[key].values()])
+        lookups[key].update(
+            (name.lower(), pk) for pk, name in model.objects.filter(
+                name__in=[name for name, line in missing[key].values()]).values_list('pk', 'name'))
+        created[key] = len(missing[key])
+    Location.objects.bulk_create([
+        Location(office_id=lookups['office'][office_name.lower()], name=name)
+        for (office_name, name), line in missing['location'].values()
+    ])
+    if missing['location']:
+        lookups['location'] = load_lookups()['location']
+    created['location'] = len(missing['location'])
+    return created
+
+
+def insert_assets(assets):
+    """Insert ``assets`` and return them with their ids set."""
+    if connection.features.can_return_ids_from_bulk_insert:
+        return Asset.objects.bulk_create(assets)
+    # eg: SQLite, bulk_create would leave the ids unset. Insert the assets one
+    # by one and move the counts once, like AssetQuerySet.bulk_create does
+    for asset in assets:
+        asset.save_base(force_insert=True)
+    AssetCount.apply_deltas(Counter(asset.get_rollup_key() for asset in assets))
+    return assets
+
+
+def import_assets(rows, create_missing=False, chunk_size=1000, dry_run=False):
+    """Import the assets of ``rows``, dicts like the ones of ``read_rows``.
+
+    Return a dict with the number of ``created`` assets, their ``codes``, the
+    number of ``created_lookups`` per model and the ``errors`` as (line,
+    message) pairs. Nothing is imported if there are errors.
+    """
+    lookups = load_lookups()
+    origins = get_choices(Asset.ORIGINS)
+    statuses = get_choices(Asset.STATUSES_ALL)
+    # lowercase name -> (name, first line)
+    missing = {key: {} for key in ('type', 'manufacturer', 'supplier', 'location')}
+    parsed = []
+    errors = []
+
+    for line, row in enumerate(rows, 2):
+        if line == 2:
+            absent = [key for key in REQUIRED_COLUMNS if key not in row]
+            if absent:
+                return {'created': 0, 'codes': [], 'created_lookups': {},
+                        'errors': [(1, 'Missing columns: %s' % ', '.join(absent))]}
+        values, row_errors = parse_row(row, origins, statuses)
+        errors.extend((line, error) for error in row_errors)
+        if row_errors:
+            continue
+        for key, model in LOOKUP_MODELS:
+            name = values[key]
+            if name and name.lower() not in lookups[key]:
+                missing[key].setdefault(name.lower(), (name, line))
+        office_name = values['office'].lower()
+        if office_name not in lookups['office']:
+            errors.append((line, 'office: unknown office %s' % values['office']))
+            continue
+        location = (office_name, values['location'].lower())
+        if location not in lookups['location']:
+            missing['location'].setdefault(location, ((values['office'], values['location']), line))
+        parsed.append(values)
+
+    if not create_missing:
+        for key, names in missing.items():
+            errors.extend(
+                (line, '%s: unknown %s %s' % (key, key, name if key != 'location' else ' - '.join(name)))
+                for name, line in names.values())
+    if errors:
+        return {'created': 0, 'codes': [], 'created_lookups': {}, 'errors': sorted(errors)}
+
+    with transaction.atomic():
+        created_lookups = create_lookups(lookups, missing) if create_missing else {}
+        assets = []
+        for i in range(0, len(parsed), chunk_size):
+            assets.extend(insert_assets([
+                Asset(
+                    name=values['name'],
+                    old_code=values['old_code'],
+                    asset_type_id=lookups['type'][values['type'].lower()],
+                    manufacturer_id=lookups['manufacturer'].get(values['manufacturer'].lower()),
+                    supplier_id=lookups['supplier'].get(values['supplier'].lower()),
+                    location_id=lookups['location'][(values['office'].lower(), values['location'].lower())],
+                    purchased_date=values['purchased_date'],
+                    warranty_start_date=values['warranty_start_date'],
+                    warranty_end_date=values['warranty_end_date'],
+                    origin=values['origin'],
+                    status=values['status'],
+                    note=values['note'],
+                ) for values in parsed[i:i + chunk_size]
+            ]))
+        if dry_run:
+            transaction.set_rollback(True)
+    return {
+        'created': len(assets),
+        'codes': [asset.get_code() for asset in assets],
+        'created_lookups': created_lookups,
+        'errors': [],
+    }
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from asset_manager.models import Asset
+
+
+class Command(BaseCommand):
+    help = '''Fill the exchange count, the last exchange and its time of every
+    asset from the exchanges, chunk by chunk so the assets are not locked
+    for long.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-c', '--chunk-size', type=int, default=1000,
+            help='Number of assets updated per transaction. Default: 1000')
+
+    def handle(self, *args, **options):
+        asset_ids = list(Asset.objects.order_by('pk').values_list('pk', flat=True))
+        self.rows_affected = 0
+        for i in range(0, len(asset_ids), options['chunk_size']):
+            with transaction.atomic():
+                self.rows_affected += Asset.update_exchange_fields(asset_ids[i:i + options['chunk_size']])
+            if options['verbosity'] > 1:
+                self.stdout.write('Updated %d/%d assets' % (self.rows_affected, len(asset_ids)))
+        self.stdout.write(self.style.SUCCESS('Updated the exchange fields of %d assets' % self.rows_affected))
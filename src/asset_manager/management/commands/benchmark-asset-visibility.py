@@ -0,0 +1,103 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from asset_manager.models import Asset, Location, LocationVisibility, Office, Type
+
+
+class Command(BaseCommand):
+    help = '''Compare the scope filters of the asset changelist on synthetic data:
+    the OR of held and managed assets against the UNION of indexed lookups.
+    The data is created in a transaction which is rolled back at the end,
+    run it against a copy of the database.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--assets', type=int, default=500000,
+            help='Number of assets. Default: 500000')
+        parser.add_argument(
+            '--locations', type=int, default=300,
+            help='Number of locations. Default: 300')
+        parser.add_argument(
+            '--users', type=int, default=200,
+            help='Number of users. Default: 200')
+        parser.add_argument(
+            '--managers', type=int, default=2,
+            help='Number of managers per location. Default: 2')
+        parser.add_argument(
+            '--samples', type=int, default=20,
+            help='Number of users whose changelist is queried. Default: 20')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed. Default: 0')
+
+    def populate(self, rnd, **options):
+        prefix = 'benchmark-%d' % options['seed']
+        office = Office.objects.create(name=prefix, address='')
+        asset_type = Type.objects.create(name=prefix, kitting_required=False)
+        Location.objects.bulk_create([
+            Location(office=office, name='%s-%d' % (prefix, i)) for i in range(options['locations'])])
+        location_ids = list(Location.objects.filter(office=office).values_list('pk', flat=True))
+        User.objects.bulk_create([
+            User(username='%s-%d' % (prefix, i)) for i in range(options['users'])])
+        user_ids = list(User.objects.filter(username__startswith=prefix + '-').values_list('pk', flat=True))
+
+        Location.managers.through.objects.bulk_create([
+            Location.managers.through(location_id=location_id, user_id=user_id)
+            for location_id in location_ids
+            for user_id in rnd.sample(user_ids, min(options['managers'], len(user_ids)))
+        ], batch_size=1000)
+        LocationVisibility.rebuild()
+
+        batch = []
+        for i in range(options['assets']):
+            batch.append(Asset(
+                name='%s-%d' % (prefix, i), asset_type=asset_type,
+                assigned=rnd.random() < 0.8, holder_id=rnd.choice(user_ids),
+                location_id=rnd.choice(location_ids)))
+            if len(batch) == 5000:
+                Asset.objects.bulk_create(batch)
+                batch = []
+        Asset.objects.bulk_create(batch)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        return user_ids
+
+    def time_changelist(self, qs):
+        """Time what a changelist page runs: the count and the first page."""
+        started = time.time()
+        count = qs.count()
+        list(qs.order_by('-pk').values_list('pk', flat=True)[:100])
+        return time.time() - started, count
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            started = time.time()
+            user_ids = self.populate(rnd, **options)
+            self.stdout.write('Created %d assets in %.1fs' % (options['assets'], time.time() - started))
+
+            totals = {'or': 0, 'union': 0}
+            for user in User.objects.filter(pk__in=rnd.sample(user_ids, min(options['samples'], len(user_ids)))):
+                old = Asset.objects.filter(
+                    Q(assigned=False, holder=user) |
+                    Q(location__in=user.managing_locations.all()))
+                new = Asset.objects.filter(pk__in=Asset.get_visible_ids(user))
+                old_time, old_count = self.time_changelist(old)
+                new_time, new_count = self.time_changelist(new)
+                if old_count != new_count:
+                    self.stderr.write('%s: %d assets with OR, %d with UNION' % (user, old_count, new_count))
+                totals['or'] += old_time
+                totals['union'] += new_time
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s: %d assets, OR %.3fs, UNION %.3fs' % (user, new_count, old_time, new_time))
+
+            samples = min(options['samples'], len(user_ids))
+            self.stdout.write('Average per changelist: OR %.3fs, UNION %.3fs' % (
+                totals['or'] / samples, totals['union'] / samples))
+            transaction.set_rollback(True)
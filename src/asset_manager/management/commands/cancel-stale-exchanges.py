@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from asset_manager.exchanges import end_exchanges
+from asset_manager.models import Exchange
+
+
+class Command(BaseCommand):
+    help = '''Cancel the exchanges pending for longer than --days, as the system
+    user. Their senders and receivers are notified by send-notifications.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-d', '--days', type=int, default=14,
+            help='Age in days of the pending exchanges to cancel. Default: 14')
+        parser.add_argument(
+            '--system-user', type=str, default='system',
+            help='Username the exchanges are cancelled by, created inactive if missing. Default: system')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print the number of stale exchanges without cancelling them.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        stale = Exchange.objects.filter(status=Exchange.STATUS_PENDING, started_at__lt=before)
+        if options['dry_run']:
+            self.stdout.write('%d exchanges pending since before %s' % (stale.count(), before))
+            return
+
+        system_user, _ = User.objects.get_or_create(
+            username=options['system_user'], defaults={'is_active': False})
+        cancelled = end_exchanges(
+            list(stale.values_list('pk', flat=True)), Exchange.STATUS_CANCELLED, system_user)
+        self.rows_affected = len(cancelled)
+        self.stdout.write(self.style.SUCCESS('Cancelled %d stale exchanges' % len(cancelled)))
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from asset_manager.importer import import_assets, read_rows
+
+
+class Command(BaseCommand):
+    help = '''Import assets from a CSV or XLSX file with the columns: name, type,
+    old_code, manufacturer, supplier, office, location, purchased_date,
+    warranty_start_date, warranty_end_date, origin, status, note.
+    Only name, type, office and location are required. Nothing is imported
+    if any row is invalid.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', type=str, help='CSV or XLSX file')
+        parser.add_argument(
+            '--create-missing', action='store_true',
+            help='Create the unknown types, manufacturers, suppliers and locations')
+        parser.add_argument(
+            '-c', '--chunk-size', type=int, default=1000,
+            help='Number of assets inserted per query. Default: 1000')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Check the file and roll back the import.')
+        parser.add_argument(
+            '-o', '--output', type=str,
+            help='Write the codes of the imported assets into this file, one per line')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        try:
+            with open(options['file'], 'rb') as f:
+                result = import_assets(
+                    read_rows(f, options['file']),
+                    create_missing=options['create_missing'],
+                    chunk_size=options['chunk_size'],
+                    dry_run=options['dry_run'])
+        except IOError as e:
+            raise CommandError('Cannot read %s: %s' % (options['file'], e))
+
+        if result['errors']:
+            for line, error in result['errors']:
+                self.stderr.write('Line %d: %s' % (line, error))
+            raise CommandError('%d errors, nothing was imported' % len(result['errors']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.writelines(code + '\n' for code in result['codes'])
+        for key, count in sorted(result['created_lookups'].items()):
+            if count:
+                self.stdout.write('Created %d %s' % (count, key))
+        self.rows_affected = 0 if options['dry_run'] else result['created']
+        self.stdout.write(self.style.SUCCESS('%s %d assets in %.1fs' % (
+            'Checked' if options['dry_run'] else 'Imported', result['created'], time.time() - started)))
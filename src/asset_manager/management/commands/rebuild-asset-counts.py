@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from asset_manager.models import AssetCount
+
+
+class Command(BaseCommand):
+    help = '''Rebuild the asset counts per location, type and status from the
+    assets, eg: after changes made outside of the ORM.'''
+
+    def handle(self, *args, **options):
+        self.rows_affected = AssetCount.rebuild()
+        self.stdout.write(self.style.SUCCESS('Rebuilt %d asset counts' % self.rows_affected))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from asset_manager.models import LocationVisibility
+
+
+class Command(BaseCommand):
+    help = '''Rebuild the asset visibility of users from the location managers,
+    eg: after managers were changed without signals (raw SQL, fixtures).
+    migrate fills it by itself when it is empty.'''
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            LocationVisibility.rebuild()
+        self.rows_affected = LocationVisibility.objects.count()
+        self.stdout.write(self.style.SUCCESS('Rebuilt %d location visibility rows' % self.rows_affected))
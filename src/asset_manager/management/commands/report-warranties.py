@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from asset_manager.models import Asset
+from asset_manager.warranty import WARNING_DAYS, get_expiring_assets, get_expiring_warranties
+
+
+class Command(BaseCommand):
+    help = '''List the assets whose warranty ends within a number of days,
+    grouped by location and supplier. The send-reports command mails the
+    same groups with the license reports.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-d', '--days', type=int, default=WARNING_DAYS,
+            help='Warranties ending within this number of days. Default: %d' % WARNING_DAYS)
+        parser.add_argument(
+            '-a', '--assets', action='store_true', help='List the assets of every group')
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        groups = get_expiring_warranties(today, options['days'])
+        assets = {}
+        if options['assets']:
+            rows = (get_expiring_assets(today, options['days'])
+                        .values_list('location_id', 'supplier_id', 'pk', 'name', 'warranty_end_date')
+                        .order_by('warranty_end_date', 'pk'))
+            for location_id, supplier_id, pk, name, ended_date in rows:
+                assets.setdefault((location_id, supplier_id), []).append(
+                    '    %s %s %s' % (ended_date, Asset(pk=pk).get_code(), name))
+        self.rows_affected = 0
+        for group in groups:
+            self.rows_affected += group['count']
+            self.stdout.write('%s - %s\t%s\t%s\t%d assets' % (
+                group['first_ended_date'], group['last_ended_date'], group['location'] or 'No location',
+                group['supplier__name'] or 'No supplier', group['count']))
+            for line in assets.get((group['location_id'], group['supplier_id']), []):
+                self.stdout.write(line)
+        self.stdout.write(self.style.SUCCESS(
+            '%d assets have a warranty ending within %d days' % (self.rows_affected, options['days'])))
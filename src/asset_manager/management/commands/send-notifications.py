@@ -0,0 +1,89 @@
+import logging
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.template.loader import get_template
+from django.utils import timezone
+
+from asset_manager.models import Notification
+
+FILE_EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '''Send the queued notifications as one digest email per recipient
+    over a single connection, and delete the old sent ones.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-f', '--from', type=str, default='lms@punch.local',
+            help='Email address of the sender. Default: lms@punch.local')
+        parser.add_argument(
+            '--keep-days', type=int, default=30,
+            help='Delete the notifications sent before this number of days. Default: 30')
+        parser.add_argument(
+            '--email-dir', type=str,
+            help='Write the emails as files into this directory instead of sending them')
+
+    def get_connection(self, **options):
+        if options['email_dir']:
+            return get_connection(FILE_EMAIL_BACKEND, file_path=options['email_dir'])
+        return get_connection()
+
+    def get_digests(self):
+        """Return the pending notifications grouped by recipient."""
+        digests = {}
+        for pk, recipient_id, username, email, message, created_at in (
+                Notification.objects
+                            .filter(sent_at__isnull=True)
+                            .values_list('pk', 'recipient_id', 'recipient__username', 'recipient__email',
+                                         'message', 'created_at')
+                            .order_by('recipient_id', 'pk')):
+            digest = digests.setdefault(recipient_id, {
+                'username': username, 'email': email, 'ids': [], 'notifications': []})
+            digest['ids'].append(pk)
+            digest['notifications'].append({'message': message, 'created_at': created_at})
+        return digests
+
+    def handle(self, *args, **options):
+        t = get_template('email/notifications.txt')
+        connection = self.get_connection(**options)
+        done_ids = []
+        sent = skipped = failed = 0
+        connection.open()
+        try:
+            for digest in self.get_digests().values():
+                if not digest['email']:
+                    # nowhere to send them, do not retry forever
+                    done_ids.extend(digest['ids'])
+                    skipped += 1
+                    continue
+                message = EmailMessage(
+                    '%d new notifications' % len(digest['notifications']),
+                    t.render(digest),
+                    options['from'],
+                    [digest['email']],
+                    connection=connection)
+                try:
+                    message.send()
+                except Exception:
+                    # keep them queued for the next run
+                    logger.exception('Failed to send notifications to %s', digest['email'])
+                    failed += 1
+                    continue
+                done_ids.extend(digest['ids'])
+                sent += 1
+        finally:
+            connection.close()
+
+        now = timezone.now()
+        for i in range(0, len(done_ids), 1000):
+            Notification.objects.filter(pk__in=done_ids[i:i + 1000]).update(sent_at=now)
+        deleted, _ = Notification.objects.filter(sent_at__lt=now - timedelta(days=options['keep_days'])).delete()
+        self.rows_affected = len(done_ids)
+        self.stdout.write(self.style.SUCCESS(
+            'Sent %d digests of %d notifications, %d recipients without email, %d failed, deleted %d old' % (
+                sent, len(done_ids), skipped, failed, deleted)))
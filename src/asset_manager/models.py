@@ -1,21 +1,63 @@
+from collections import Counter
+
 from django.db import models
 from django.db import IntegrityError
+from django.db import transaction
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 from django.contrib.postgres.fields import HStoreField
 from django.contrib.auth.models import User
+from django.db.models.functions import Coalesce
 
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     location = models.ForeignKey('Office', on_delete=models.PROTECT)
+    default_location = models.ForeignKey(
+        'Location', blank=True, null=True,
+        on_delete=models.SET_NULL, related_name='+',
+        help_text='Location within the office where the assets of the user are kept.',
+    )
 
     def __str__(self):
         return self.user.username
 
 
+class DirectoryMapping(models.Model):
+    org_unit_path = models.CharField(
+        max_length=200, blank=True,
+        help_text='GSuite organization unit path (eg: /punch-staff/hanoi), also applies to its sub units.')
+    building_id = models.CharField(
+        max_length=100, blank=True,
+        help_text='Building ID of the user location in GSuite. Takes precedence over organization units.')
+    office = models.ForeignKey('Office', on_delete=models.PROTECT)
+    location = models.ForeignKey(
+        'Location', blank=True, null=True,
+        on_delete=models.PROTECT,
+    )
+
+    def __str__(self):
+        return '%s -> %s' % (self.building_id or self.org_unit_path, self.location or self.office)
+
+    def clean(self):
+        validation_errors = {}
+        if not self.org_unit_path and not self.building_id:
+            validation_errors['org_unit_path'] = ValidationError(
+                _('Either organization unit path or building ID is required'),
+            )
+        if self.location_id and self.office_id and self.location.office_id != self.office_id:
+            validation_errors['location'] = ValidationError(
+                _('Location must belong to the office'),
+            )
+        if validation_errors:
+            raise ValidationError(validation_errors)
+
+    class Meta:
+        unique_together = (('org_unit_path', 'building_id'),)
+
+
 class Supplier(models.Model):
     name = models.CharField(max_length=100, unique=True)
     contact = models.TextField(blank=True)
@@ -64,6 +106,31 @@ class Location(models.Model):
         unique_together = (('office', 'name'),)
 
 
+class LocationVisibility(models.Model):
+    """Locations whose assets a user can see, kept in sync with
+    ``Location.managers`` by ``asset_manager.signals``. Unlike the managers
+    table it is indexed by user first. It is filled from the existing
+    managers after migrate when empty.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    location = models.ForeignKey('Location', on_delete=models.CASCADE, related_name='+')
+
+    @classmethod
+    def rebuild(cls):
+        """Replace all rows with the current location managers."""
+        rows = Location.managers.through.objects.values_list('user_id', 'location_id')
+        cls.objects.all().delete()
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, location_id=location_id) for user_id, location_id in rows],
+            batch_size=1000)
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.location_id)
+
+    class Meta:
+        unique_together = (('user', 'location'),)
+
+
 class Office(models.Model):
     name = models.CharField(max_length=100, unique=True)
     address = models.CharField(max_length=100)
@@ -72,6 +139,57 @@ class Office(models.Model):
         return self.name
 
 
+class AssetQuerySet(models.QuerySet):
+    """Keeps AssetCount up to date through bulk inserts, updates and deletes."""
+    # update() keyword -> AssetCount key field
+    ROLLUP_FIELDS = {
+        'location': 'location_id', 'location_id': 'location_id',
+        'asset_type': 'asset_type_id', 'asset_type_id': 'asset_type_id',
+        'status': 'status',
+    }
+
+    def count_rollup_keys(self):
+        return Counter({
+            (location_id, asset_type_id, status): count
+            for location_id, asset_type_id, status, count in
+            self.order_by().values_list('location_id', 'asset_type_id', 'status').annotate(count=models.Count('pk'))
+        })
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super(AssetQuerySet, self).bulk_create(objs, *args, **kwargs)
+            AssetCount.apply_deltas(Counter(obj.get_rollup_key() for obj in objs))
+        return objs
+
+    def update(self, **kwargs):
+        """Count the changed assets with one grouped query before the update.
+        Rollup fields must be set to values, not expressions.
+        """
+        changes = {
+            self.ROLLUP_FIELDS[key]: getattr(value, 'pk', value)
+            for key, value in kwargs.items() if key in self.ROLLUP_FIELDS
+        }
+        if not changes:
+            return super(AssetQuerySet, self).update(**kwargs)
+        with transaction.atomic(using=self.db):
+            before = self.count_rollup_keys()
+            rows = super(AssetQuerySet, self).update(**kwargs)
+            deltas = Counter()
+            for key, count in before.items():
+                values = dict(zip(AssetCount.KEY_FIELDS, key), **changes)
+                deltas[key] -= count
+                deltas[tuple(values[field] for field in AssetCount.KEY_FIELDS)] += count
+            AssetCount.apply_deltas(deltas)
+        return rows
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            before = self.count_rollup_keys()
+            result = super(AssetQuerySet, self).delete()
+            AssetCount.apply_deltas(Counter({key: -count for key, count in before.items()}))
+        return result
+
+
 class Asset(models.Model):
     EXCELLENCE = 1
     GOOD = 3
@@ -135,37 +253,87 @@ class Asset(models.Model):
         'Location', blank=False, null=True,
         on_delete=models.PROTECT,
     )
-    # logging
-    # exchange_count = models.PositiveIntegerField(blank=True, default=0)
-    # last_exchange = models.OneToOneField(
-    #     'Exchange', blank=True, null=True,
-    #     on_delete=models.PROTECT, related_name='+',
-    # )
+    # logging, kept up to date by Asset.update_exchange_fields
+    exchange_count = models.PositiveIntegerField(blank=True, default=0, editable=False)
+    last_exchange = models.OneToOneField(
+        'Exchange', blank=True, null=True, editable=False,
+        on_delete=models.SET_NULL, related_name='+',
+    )
+    last_exchanged_at = models.DateTimeField(blank=True, null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     available_at = models.DateField(editable=False, null=True)
     note = models.TextField(blank=True)
 
+    objects = AssetQuerySet.as_manager()
+
+    def __init__(self, *args, **kwargs):
+        super(Asset, self).__init__(*args, **kwargs)
+        self.original_rollup_key = self.get_rollup_key()
+
     def __str__(self):
         return self.name
 
+    def get_rollup_key(self):
+        """Return the AssetCount key of the asset, None if a field is deferred."""
+        if any(field not in self.__dict__ for field in AssetCount.KEY_FIELDS):
+            return None
+        return tuple(self.__dict__[field] for field in AssetCount.KEY_FIELDS)
+
+    def save(self, *args, **kwargs):
+        """Save and move the asset between the AssetCount rows."""
+        with transaction.atomic():
+            original = self.original_rollup_key
+            if self.pk and (self._state.adding or original is None):
+                original = Asset.objects.filter(pk=self.pk).values_list(*AssetCount.KEY_FIELDS).first()
+            elif self._state.adding:
+                original = None
+            super(Asset, self).save(*args, **kwargs)
+            key = self.get_rollup_key()
+            if key is None:
+                key = Asset.objects.filter(pk=self.pk).values_list(*AssetCount.KEY_FIELDS).get()
+            if key != original:
+                deltas = Counter({key: 1})
+                if original:
+                    deltas[original] -= 1
+                AssetCount.apply_deltas(deltas)
+            self.original_rollup_key = key
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            key = Asset.objects.filter(pk=self.pk).values_list(*AssetCount.KEY_FIELDS).first()
+            result = super(Asset, self).delete(*args, **kwargs)
+            if key:
+                AssetCount.apply_deltas({key: -1})
+        return result
+
+    @staticmethod
+    def check_dates(purchased_date, warranty_start_date, warranty_end_date):
+        """Return the errors of the dates of an asset by field name, shared by
+        ``clean`` and the importer. Missing dates are not compared.
+        """
+        errors = {}
+        if warranty_start_date and warranty_end_date and warranty_end_date <= warranty_start_date:
+            errors['warranty_end_date'] = _('Warranty end date must be greater than warranty start date')
+        if purchased_date and warranty_start_date and warranty_start_date < purchased_date:
+            errors['warranty_start_date'] = _('Warranty start date must be greater than or equal purchased date')
+        return errors
+
     def clean(self):
-        validation_errors = {}
-        if self.warranty_end_date <= self.warranty_start_date:
-            validation_errors['warranty_end_date'] = ValidationError(
-                _('Warranty end date must be greater than warranty start date'),
-            )
-        if self.warranty_start_date < self.purchased_date:
-            validation_errors['warranty_start_date'] = ValidationError(
-                _('Warranty start date must be greater than or equal purchased date'),
-            )
+        validation_errors = {
+            field: ValidationError(message)
+            for field, message in self.check_dates(
+                self.purchased_date, self.warranty_start_date, self.warranty_end_date).items()
+        }
         if validation_errors:
             raise ValidationError(validation_errors)
 
     def is_recently_exchanged(self):
         fresh_period = timezone.timedelta(minutes=5)
-        return (self.last_exchange and
-                timezone.now() - self.last_exchange.ended_at < fresh_period)
+        return bool(self.last_exchanged_at and
+                    timezone.now() - self.last_exchanged_at < fresh_period)
+    is_recently_exchanged.boolean = True
+    is_recently_exchanged.short_description = 'Recently exchanged'
 
     def get_holder(self):
         if self.holder:
@@ -177,10 +345,105 @@ class Asset(models.Model):
         return "%s%05d" % (settings.AMS_ASSET_ID_PREFIX, self.id)
     get_code.short_description = 'Code'
 
+    @staticmethod
+    def parse_code(code):
+        """Return the id of an asset code like ``get_code`` formats it, or None."""
+        code = code.strip().upper()
+        prefix = settings.AMS_ASSET_ID_PREFIX.upper()
+        if code.startswith(prefix) and code[len(prefix):].isdigit():
+            return int(code[len(prefix):])
+        return None
+
+    @classmethod
+    def get_visible_ids(cls, user):
+        """Return a subquery of the ids of the assets visible to a user: the
+        unassigned ones they hold and the ones in the locations they manage.
+        Each side of the UNION is an indexed lookup, unlike an OR of both.
+        """
+        held = cls.objects.filter(holder=user, assigned=False).values('pk')
+        managed = cls.objects.filter(
+            location__in=LocationVisibility.objects.filter(user=user).values('location_id')).values('pk')
+        return held.union(managed)
+
+    @classmethod
+    def update_exchange_fields(cls, asset_ids):
+        """Recompute the exchange count, the last exchange and its time, which is
+        when it ended or else started, of the given assets with one update.
+        Call it in the transaction which creates or ends their exchanges.
+        """
+        exchanges = Exchange.objects.filter(asset=models.OuterRef('pk')).order_by()
+        last = exchanges.order_by('-started_at', '-pk')[:1]
+        return cls.objects.filter(pk__in=asset_ids).update(
+            exchange_count=Coalesce(models.Subquery(
+                exchanges.values('asset').annotate(count=models.Count('pk')).values('count'),
+                output_field=models.PositiveIntegerField()), 0),
+            last_exchange=models.Subquery(last.values('pk')),
+            last_exchanged_at=models.Subquery(
+                last.annotate(at=Coalesce('ended_at', 'started_at')).values('at'),
+                output_field=models.DateTimeField()),
+        )
+
     class Meta:
         permissions = (
             ('assign_asset', 'Can assign asset to user or location'),
         )
+        indexes = [
+            models.Index(fields=['holder', 'assigned']),
+            # exact legacy code lookups, the text search has its own index, see asset_manager.search
+            models.Index(fields=['old_code']),
+            # date range reports, see asset_manager.warranty
+            models.Index(fields=['warranty_end_date']),
+            models.Index(fields=['purchased_date']),
+        ]
+
+
+class AssetCount(models.Model):
+    """Number of assets per location, type and status. Kept up to date by
+    ``Asset`` and ``AssetQuerySet``, rebuilt by the rebuild-asset-counts
+    command.
+    """
+    KEY_FIELDS = ('location_id', 'asset_type_id', 'status')
+
+    location = models.ForeignKey('Location', blank=True, null=True, on_delete=models.CASCADE, related_name='+')
+    asset_type = models.ForeignKey('Type', on_delete=models.CASCADE, related_name='+')
+    status = models.IntegerField(choices=Asset.STATUSES_ALL)
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def apply_deltas(cls, deltas):
+        """Add ``{(location_id, asset_type_id, status): delta}`` to the counts,
+        one query per changed key.
+        """
+        for key, delta in deltas.items():
+            if not delta:
+                continue
+            rows = cls.objects.filter(**dict(zip(cls.KEY_FIELDS, key)))
+            if rows.update(count=models.F('count') + delta):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(count=delta, **dict(zip(cls.KEY_FIELDS, key)))
+            except IntegrityError:
+                # created meanwhile
+                rows.update(count=models.F('count') + delta)
+
+    @classmethod
+    def rebuild(cls):
+        """Replace all rows with counts of the assets."""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([
+                cls(location_id=location_id, asset_type_id=asset_type_id, status=status, count=count)
+                for (location_id, asset_type_id, status), count in Asset.objects.all().count_rollup_keys().items()
+            ], batch_size=1000)
+        return cls.objects.count()
+
+    def __str__(self):
+        return '%s %s %s: %d' % (self.location_id, self.asset_type_id, self.status, self.count)
+
+    class Meta:
+        unique_together = (('location', 'asset_type', 'status'),)
+        verbose_name = 'asset count'
 
 
 class Exchange(models.Model):
@@ -241,6 +504,10 @@ class Exchange(models.Model):
 
     status = models.PositiveIntegerField(
         choices=STATUSES, default=STATUS_PENDING)
+    assigned = models.BooleanField(
+        default=False,
+        help_text='Whether the receiver uses the asset or keeps it in stock once taken.',
+    )
     started_at = models.DateTimeField(auto_now_add=True)
     ended_at = models.DateTimeField(blank=True, null=True)
     ended_by = models.ForeignKey(
@@ -262,6 +529,13 @@ class Exchange(models.Model):
             ('kitting_asset', 'Can update kitting due date, comment, assignee, status.'),
             ('change_kitting_due_date', 'Can update kitting due date.'),
         )
+        indexes = [
+            # the pending exchanges of assets, and the stale ones by age
+            models.Index(fields=['asset', 'status']),
+            models.Index(fields=['status', 'started_at']),
+            # the kitting queue: open kittings by due date
+            models.Index(fields=['kitting_required', 'kitting_completed_at', 'kitting_dued_at']),
+        ]
 
     def is_fresh(self):
         fresh_period = timezone.timedelta(minutes=5)
@@ -274,32 +548,61 @@ class Exchange(models.Model):
     get_asset_name.admin_order_field = 'asset__name'
 
     def get_asset_id(self):
-        return self.asset.get_id()
+        return self.asset.get_code()
     get_asset_id.short_description = 'Asset ID'
     get_asset_id.admin_order_field = 'asset__id'
 
     def get_sender(self):
         return self.sender.username
     get_sender.short_description = 'From'
-    get_sender.admin_order_field = ('sender.name',)
+    get_sender.admin_order_field = 'sender__username'
 
     def get_receiver(self):
         return self.receiver.username
     get_receiver.short_description = 'To'
-    get_receiver.admin_order_field = ('receiver.name',)
-
-    # def next_status(self, request, next_status):
-    #     if self.pk and next_status > self.status:
-    #         self.status = next_status
-    #         self.ended_at = timezone.now()
-    #         self.ended_by = request.user
-    #         if next_status == self.TAKEN:
-    #             if self.to_group:
-    #                 self.asset.group_holder = self.to_group
-    #                 self.asset.holder = None
-    #             if self.to_user:
-    #                 self.asset.holder = self.to_user
-    #                 self.asset.group_holder = None
-    #             self.asset.last_exchange = self
-    #             self.asset.save()
-    #         self.save()
+    get_receiver.admin_order_field = 'receiver__username'
+
+
+class Notification(models.Model):
+    """Outbox of the notification emails. Rows are written in the transaction
+    of the change and sent as one digest per recipient by the
+    send-notifications command.
+    """
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def queue(cls, messages):
+        """Add ``(user_id, message)`` pairs to the outbox with a single insert."""
+        return cls.objects.bulk_create(
+            [cls(recipient_id=user_id, message=message[:255]) for user_id, message in messages],
+            batch_size=1000)
+
+    def __str__(self):
+        return self.message
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent_at', 'recipient']),
+        ]
+
+
+class Stocktake(models.Model):
+    """Applied audit of a location: the scanned codes reconciled with the
+    assets expected there by ``asset_manager.stocktake``.
+    """
+    location = models.ForeignKey('Location', on_delete=models.PROTECT)
+    created_by = models.ForeignKey(User, on_delete=models.PROTECT, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    scanned = models.PositiveIntegerField(default=0)
+    found = models.PositiveIntegerField(default=0)
+    missing = models.PositiveIntegerField(default=0)
+    misplaced = models.PositiveIntegerField(default=0)
+    unknown = models.PositiveIntegerField(default=0)
+    # JSON of the report, see asset_manager.stocktake.reconcile
+    report = models.TextField(blank=True)
+
+    def __str__(self):
+        return '%s %s' % (self.location, timezone.localtime(self.created_at).strftime('%d/%m/%Y %H:%M'))
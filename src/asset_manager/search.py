@@ -0,0 +1,151 @@
+"""Asset search by code, legacy code and name.
+
+Printed codes (``Asset.get_code``) are parsed into primary key lookups.
+Legacy codes and names are matched by substring, through a trigram index
+on PostgreSQL and a FTS5 table with the trigram tokenizer on SQLite, created
+after migrations by ``create_search_index`` since neither can be declared in
+``Meta.indexes``. Without them, eg: a database user not allowed to create
+extensions or an SQLite without FTS5 or older than 3.34, the search falls
+back to unindexed ``icontains`` filters.
+
+The pg_trgm extension needs a superuser, if the database user of the site is
+not one a DBA has to run ``CREATE EXTENSION pg_trgm`` once beforehand.
+"""
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections, transaction
+from django.db.models import Q
+
+from .models import Asset
+
+CHUNK_SIZE = 500
+# the trigram tokenizer cannot match shorter words
+FTS_MIN_WORD_LENGTH = 3
+
+logger = logging.getLogger(__name__)
+
+POSTGRESQL_INDEX_SQL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS asset_manager_asset_name_trgm '
+    'ON asset_manager_asset USING gin (UPPER(name::text) gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS asset_manager_asset_old_code_trgm '
+    'ON asset_manager_asset USING gin (UPPER(old_code::text) gin_trgm_ops)',
+)
+
+SQLITE_FTS_TABLE = 'asset_manager_asset_fts'
+SQLITE_INDEX_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+    "name, old_code, content='asset_manager_asset', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON asset_manager_asset BEGIN "
+    "INSERT INTO {fts}(rowid, name, old_code) VALUES (new.id, new.name, new.old_code); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON asset_manager_asset BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, name, old_code) VALUES ('delete', old.id, old.name, old.old_code); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF name, old_code ON asset_manager_asset BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, name, old_code) VALUES ('delete', old.id, old.name, old.old_code); "
+    "INSERT INTO {fts}(rowid, name, old_code) VALUES (new.id, new.name, new.old_code); END",
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+)
+
+
+def create_search_index(using=DEFAULT_DB_ALIAS):
+    """Create the text index of the assets if the database supports one."""
+    db = connections[using]
+    if db.vendor == 'postgresql':
+        statements = POSTGRESQL_INDEX_SQL
+    elif db.vendor == 'sqlite':
+        statements = [sql.format(fts=SQLITE_FTS_TABLE) for sql in SQLITE_INDEX_SQL]
+    else:
+        return
+    try:
+        with transaction.atomic(using=using), db.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+    except DatabaseError as e:
+        logger.warning('Could not create the asset search index, searching without it: %s', e)
+
+
+def split_terms(search_term):
+    """Return the ids of the asset codes of ``search_term`` and its other words."""
+    ids = []
+    words = []
+    for word in search_term.split():
+        pk = Asset.parse_code(word)
+        if pk is None:
+            words.append(word)
+        else:
+            ids.append(pk)
+    return ids, words
+
+
+def has_fts_table():
+    return connection.vendor == 'sqlite' and SQLITE_FTS_TABLE in connection.introspection.table_names()
+
+
+def get_text_filter(words):
+    """Return the filter of the assets whose name or legacy code contain all the words."""
+    text_filter = Q()
+    if has_fts_table():
+        fts_words = [word for word in words if len(word) >= FTS_MIN_WORD_LENGTH]
+        if fts_words:
+            # every word as a quoted substring, eg: "dell" "7450"
+            query = ' '.join('"%s"' % word.replace('"', '""') for word in fts_words)
+            # a queryset rather than RawSQL, which pk__in would wrap in a second
+            # pair of parentheses that SQLite reads as a single value
+            text_filter = Q(pk__in=Asset.objects.extra(
+                where=['id IN (SELECT rowid FROM {fts} WHERE {fts} MATCH %s)'.format(fts=SQLITE_FTS_TABLE)],
+                params=[query]).values('pk'))
+        words = [word for word in words if len(word) < FTS_MIN_WORD_LENGTH]
+    for word in words:
+        text_filter &= Q(name__icontains=word) | Q(old_code__icontains=word)
+    return text_filter
+
+
+def search_assets(queryset, search_term):
+    """Filter ``queryset`` by asset codes, legacy codes and names: the assets
+    of the codes of the term, or the ones matching its other words.
+    """
+    ids, words = split_terms(search_term)
+    search_filter = Q()
+    if ids:
+        search_filter |= Q(pk__in=ids)
+    if words:
+        search_filter |= Q(old_code__iexact=' '.join(words)) | get_text_filter(words)
+    return queryset.filter(search_filter) if search_filter else queryset
+
+
+def lookup_codes(codes):
+    """Return the assets of many codes at once, printed or legacy ones, as a
+    dict of the given codes to asset dicts, and the codes of no asset.
+    """
+    ids = {}
+    old_codes = {}
+    for code in codes:
+        if not code.strip():
+            continue
+        pk = Asset.parse_code(code)
+        if pk is None:
+            old_codes[code.strip().upper()] = code
+        else:
+            ids[pk] = code
+    fields = ('pk', 'name', 'old_code', 'status', 'assigned', 'holder__username',
+              'location__office__name', 'location__name')
+    assets = []
+    id_list = sorted(ids)
+    for i in range(0, len(id_list), CHUNK_SIZE):
+        assets.extend(Asset.objects.filter(pk__in=id_list[i:i + CHUNK_SIZE]).values(*fields))
+    old_code_list = sorted(old_codes)
+    for i in range(0, len(old_code_list), CHUNK_SIZE // 3):
+        # legacy codes are stored as typed, exact matches of the usual cases keep to the btree index
+        chunk = old_code_list[i:i + CHUNK_SIZE // 3]
+        variants = set(chunk) | {code.lower() for code in chunk} | {old_codes[code].strip() for code in chunk}
+        assets.extend(Asset.objects.filter(old_code__in=variants).values(*fields))
+
+    results = {}
+    for asset in assets:
+        asset['code'] = Asset(pk=asset['pk']).get_code()
+        if asset['pk'] in ids:
+            results[ids[asset['pk']]] = asset
+        if asset['old_code'].upper() in old_codes:
+            results[old_codes[asset['old_code'].upper()]] = asset
+    unknown = [code for code in codes if code not in results]
+    return results, unknown
@@ -0,0 +1,52 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Asset, Exchange, Location, LocationVisibility
+
+
+@receiver(m2m_changed, sender=Location.managers.through)
+def update_location_visibility(sender, instance, action, reverse, pk_set, **kwargs):
+    """Mirror changes of ``Location.managers`` from both sides into LocationVisibility."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # forward: instance is a location and pk_set users, reverse: the opposite
+    own_field, other_field = ('user_id', 'location_id') if reverse else ('location_id', 'user_id')
+    rows = LocationVisibility.objects.filter(**{own_field: instance.pk})
+    if action == 'post_clear':
+        rows.delete()
+    elif action == 'post_remove':
+        rows.filter(**{other_field + '__in': pk_set}).delete()
+    else:
+        existing = set(rows.filter(**{other_field + '__in': pk_set}).values_list(other_field, flat=True))
+        LocationVisibility.objects.bulk_create([
+            LocationVisibility(**{own_field: instance.pk, other_field: pk})
+            for pk in pk_set if pk not in existing
+        ])
+
+
+@receiver(post_save, sender=Exchange)
+@receiver(post_delete, sender=Exchange)
+def update_asset_exchange_fields(sender, instance, **kwargs):
+    """Keep the exchange fields of the asset in sync, bulk paths call
+    ``Asset.update_exchange_fields`` themselves.
+    """
+    Asset.update_exchange_fields([instance.asset_id])
+
+
+def create_asset_search_index(sender, using, **kwargs):
+    """Create the text index of the assets, which migrations cannot declare."""
+    from .search import create_search_index
+    create_search_index(using)
+
+
+def fill_location_visibility(sender, using, **kwargs):
+    """Build LocationVisibility from the existing location managers when it is
+    empty, eg: right after the table was added, so managers keep seeing the
+    assets of their locations.
+    """
+    if LocationVisibility.objects.using(using).exists():
+        return
+    if Location.managers.through.objects.using(using).exists():
+        with transaction.atomic(using=using):
+            LocationVisibility.rebuild()
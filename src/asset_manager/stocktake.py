@@ -0,0 +1,129 @@
+"""Stocktake of a location: reconcile the scanned asset codes with the assets
+expected there.
+
+The assets of the location are loaded with one query and the scanned ones with
+one query per chunk of ids. The diff is made with set operations, and the
+missing and misplaced assets are updated with one query per chunk, so the
+number of queries stays bounded for tens of thousands of scans.
+"""
+import json
+import re
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Asset, Stocktake
+
+CHUNK_SIZE = 500
+# assets which are not expected anywhere anymore
+GONE_STATUSES = (Asset.LOST, Asset.DISPOSED, Asset.AUCTIONED)
+
+
+def split_codes(text):
+    """Split the text of a scan, eg: one code per line, into codes."""
+    return [code for code in re.split(r'[\s,;]+', text) if code]
+
+
+def parse_codes(codes):
+    """Return the set of asset ids of the codes and the sorted codes which are
+    not asset codes.
+    """
+    ids = set()
+    invalid = set()
+    for code in codes:
+        pk = Asset.parse_code(code)
+        if pk is None:
+            invalid.add(code.strip())
+        else:
+            ids.add(pk)
+    return ids, sorted(invalid)
+
+
+def chunks(ids):
+    ids = sorted(ids)
+    for i in range(0, len(ids), CHUNK_SIZE):
+        yield ids[i:i + CHUNK_SIZE]
+
+
+def get_row(asset):
+    return {
+        'pk': asset['pk'],
+        'code': Asset(pk=asset['pk']).get_code(),
+        'name': asset['name'],
+    }
+
+
+def reconcile(location, codes):
+    """Return the report of a stocktake of ``location``, a dict of:
+
+    - ``scanned``: the number of distinct scanned codes
+    - ``found``: the expected assets which were scanned
+    - ``missing``: the expected assets which were not scanned
+    - ``misplaced``: the scanned assets of other locations, with their location
+    - ``recovered``: the scanned assets marked as not found
+    - ``unknown``: the scanned codes which are not assets
+    """
+    ids, invalid = parse_codes(codes)
+    located = {
+        asset['pk']: asset for asset in
+        Asset.objects.filter(location=location).values('pk', 'name', 'status')
+    }
+    expected = {pk for pk, asset in located.items() if asset['status'] not in GONE_STATUSES}
+    scanned = {}
+    for chunk in chunks(ids - set(located)):
+        scanned.update(
+            (asset['pk'], asset) for asset in
+            Asset.objects
+                 .filter(pk__in=chunk)
+                 .values('pk', 'name', 'status', 'location__office__name', 'location__name'))
+
+    found = ids & set(located)
+    missing = expected - ids
+    misplaced = set(scanned)
+    unknown = ids - found - misplaced
+    report = {
+        'scanned': len(ids) + len(invalid),
+        'found': [get_row(located[pk]) for pk in sorted(found)],
+        'missing': [dict(get_row(located[pk]), marked=located[pk]['status'] != Asset.NOT_FOUND)
+                    for pk in sorted(missing)],
+        'misplaced': [
+            dict(get_row(scanned[pk]), location='%s - %s' % (
+                scanned[pk]['location__office__name'], scanned[pk]['location__name'])
+                if scanned[pk]['location__name'] else '')
+            for pk in sorted(misplaced)
+        ],
+        'recovered': [
+            get_row(asset) for asset in
+            [located[pk] for pk in sorted(found)] + [scanned[pk] for pk in sorted(misplaced)]
+            if asset['status'] == Asset.NOT_FOUND
+        ],
+        'unknown': [Asset(pk=pk).get_code() for pk in sorted(unknown)] + invalid,
+    }
+    return report
+
+
+@transaction.atomic
+def apply_stocktake(location, codes, user):
+    """Reconcile the scan and apply it: the missing assets are marked not found,
+    the misplaced ones moved to ``location`` and the recovered ones marked
+    good again. Return the saved Stocktake and the report.
+    """
+    report = reconcile(location, codes)
+    now = timezone.now()
+    for chunk in chunks(row['pk'] for row in report['missing'] if row['marked']):
+        Asset.objects.filter(pk__in=chunk).update(status=Asset.NOT_FOUND, updated_at=now)
+    for chunk in chunks(row['pk'] for row in report['misplaced']):
+        Asset.objects.filter(pk__in=chunk).update(location=location, updated_at=now)
+    for chunk in chunks(row['pk'] for row in report['recovered']):
+        Asset.objects.filter(pk__in=chunk).update(status=Asset.GOOD, updated_at=now)
+    stocktake = Stocktake.objects.create(
+        location=location,
+        created_by=user,
+        scanned=report['scanned'],
+        found=len(report['found']),
+        missing=len(report['missing']),
+        misplaced=len(report['misplaced']),
+        unknown=len(report['unknown']),
+        report=json.dumps(report),
+    )
+    return stocktake, report
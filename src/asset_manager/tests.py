@@ -1,3 +1,504 @@
+import json
+from io import StringIO
+
+from django.contrib.auth.models import Permission, User
+from django.core import mail
+from django.core.management import call_command, load_command_class
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import signals
+from .exchanges import load_assets, start_exchanges, end_exchanges
+from .importer import import_assets
+from .models import (
+    Asset, AssetCount, Exchange, Location, LocationVisibility, Notification, Office, Stocktake, Type)
+from .search import has_fts_table, search_assets
+from .stocktake import apply_stocktake, reconcile
+
+
+class ExchangeNotificationTest(TestCase):
+    """Outbox rows written by the exchange workflows."""
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        self.location = Location.objects.create(office=office, name='Stock')
+        self.asset_type = Type.objects.create(name='Laptop', kitting_required=False)
+        self.sender = User.objects.create(username='sender', email='sender@punch.vn')
+        self.receiver = User.objects.create(username='receiver', email='receiver@punch.vn')
+        self.assets = [
+            Asset.objects.create(
+                name='Latitude %d' % i, asset_type=self.asset_type, location=self.location, holder=self.sender)
+            for i in range(3)]
+
+    def start(self, **kwargs):
+        start_exchanges(
+            load_assets([asset.pk for asset in self.assets]), self.sender, self.receiver,
+            Exchange.REASON_EXCHANGE, **kwargs)
+        return list(Exchange.objects.values_list('pk', flat=True))
+
+    def test_start_notifies_receiver(self):
+        self.start()
+        notifications = Notification.objects.order_by('pk')
+        self.assertEqual([n.recipient_id for n in notifications], [self.receiver.pk] * 3)
+        self.assertIn('sender sent you %s Latitude 0' % self.assets[0].get_code(), notifications[0].message)
+
+    def test_taken_right_away_is_not_notified(self):
+        self.start(take=True)
+        self.assertFalse(Notification.objects.exists())
+
+    def test_accept_notifies_sender(self):
+        exchange_ids = self.start()
+        Notification.objects.all().delete()
+        self.assertEqual(sorted(end_exchanges(exchange_ids, Exchange.STATUS_TAKEN, self.receiver)),
+                         sorted(exchange_ids))
+        messages = list(Notification.objects.filter(recipient=self.sender).values_list('message', flat=True))
+        self.assertEqual(len(messages), 3)
+        self.assertIn('receiver accepted the exchange of %s Latitude 0' % self.assets[0].get_code(), messages)
+        self.assertFalse(Notification.objects.filter(recipient=self.receiver).exists())
+        self.assertEqual(Asset.objects.filter(holder=self.receiver).count(), 3)
+
+    def test_stale_cancel_notifies_both(self):
+        exchange_ids = self.start()
+        Notification.objects.all().delete()
+        admin = User.objects.create(username='admin')
+        end_exchanges(exchange_ids, Exchange.STATUS_CANCELLED, admin)
+        self.assertEqual(Notification.objects.filter(recipient=self.sender).count(), 3)
+        self.assertEqual(Notification.objects.filter(recipient=self.receiver).count(), 3)
+
+        # already ended exchanges are left alone
+        self.assertEqual(end_exchanges(exchange_ids, Exchange.STATUS_TAKEN, self.receiver), [])
+        self.assertEqual(Notification.objects.count(), 6)
+
+
+class SendNotificationsTest(TestCase):
+    """send-notifications against the locmem email backend of the tests."""
+
+    def setUp(self):
+        self.john = User.objects.create(username='john', email='john@punch.vn')
+        self.jane = User.objects.create(username='jane', email='jane@punch.vn')
+        self.nobody = User.objects.create(username='nobody')
+        Notification.queue([
+            (self.john.pk, 'first'), (self.john.pk, 'second'), (self.jane.pk, 'third'), (self.nobody.pk, 'lost')])
+
+    def send_notifications(self):
+        command = load_command_class('asset_manager', 'send-notifications')
+        out = StringIO()
+        call_command(command, stdout=out)
+        return command, out.getvalue()
+
+    def test_sends_one_digest_per_recipient(self):
+        command, out = self.send_notifications()
+        self.assertIn('Sent 2 digests of 4 notifications, 1 recipients without email', out)
+        self.assertEqual(command.rows_affected, 4)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['jane@punch.vn', 'john@punch.vn'])
+        john = [message for message in mail.outbox if message.to == ['john@punch.vn']][0]
+        self.assertEqual(john.subject, '2 new notifications')
+        self.assertIn('first', john.body)
+        self.assertIn('second', john.body)
+        self.assertFalse(Notification.objects.filter(sent_at__isnull=True).exists())
+
+    def test_delivers_each_notification_once(self):
+        self.send_notifications()
+        command, out = self.send_notifications()
+        self.assertEqual(command.rows_affected, 0)
+        self.assertEqual(len(mail.outbox), 2)
+
+        Notification.queue([(self.jane.pk, 'fourth')])
+        command, out = self.send_notifications()
+        self.assertEqual(command.rows_affected, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn('fourth', mail.outbox[-1].body)
+        self.assertNotIn('third', mail.outbox[-1].body)
+
+
+class ImportAssetsTest(TestCase):
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        Location.objects.create(office=office, name='Stock')
+        Type.objects.create(name='Laptop', kitting_required=False)
+
+    def test_returns_codes(self):
+        rows = [{'name': 'Latitude %d' % i, 'type': 'laptop', 'office': 'HN', 'location': 'stock'}
+                for i in range(5)]
+        result = import_assets(rows, chunk_size=2)
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['created'], 5)
+        self.assertEqual(
+            result['codes'], [asset.get_code() for asset in Asset.objects.order_by('pk')])
+        self.assertEqual(AssetCount.objects.get().count, 5)
+
+
+class SearchAssetsTest(TestCase):
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        location = Location.objects.create(office=office, name='Stock')
+        asset_type = Type.objects.create(name='Laptop', kitting_required=False)
+        self.latitude = Asset.objects.create(
+            name='Dell Latitude E7450', old_code='OLD-042', asset_type=asset_type, location=location)
+        self.thinkpad = Asset.objects.create(
+            name='Lenovo ThinkPad T480', old_code='OLD-043', asset_type=asset_type, location=location)
+
+    def search(self, search_term):
+        return list(search_assets(Asset.objects.order_by('pk'), search_term))
+
+    def test_index(self):
+        self.assertTrue(has_fts_table())
+
+    def test_matches_substrings(self):
+        self.assertEqual(self.search('7450'), [self.latitude])
+        self.assertEqual(self.search('dell e7450'), [self.latitude])
+        self.assertEqual(self.search('think t4'), [self.thinkpad])
+        self.assertEqual(self.search('old-04'), [self.latitude, self.thinkpad])
+        self.assertEqual(self.search('dell t480'), [])
+
+    def test_matches_codes(self):
+        self.assertEqual(self.search(self.thinkpad.get_code()), [self.thinkpad])
+        self.assertEqual(self.search('old-042'), [self.latitude])
+
+    def test_index_follows_changes(self):
+        self.thinkpad.name = 'Lenovo ThinkPad X1'
+        self.thinkpad.save()
+        self.assertEqual(self.search('t480'), [])
+        self.assertEqual(self.search('x1 lenovo'), [self.thinkpad])
+
+
+class LocationVisibilityTest(TestCase):
+    """The assets a user sees: the ones of the locations they manage."""
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        self.floor1 = Location.objects.create(office=office, name='Floor 1')
+        self.floor2 = Location.objects.create(office=office, name='Floor 2')
+        asset_type = Type.objects.create(name='Laptop', kitting_required=False)
+        holder = User.objects.create(username='holder')
+        self.assets = {
+            location: Asset.objects.create(
+                name='Latitude', asset_type=asset_type, location=location, holder=holder, assigned=True)
+            for location in (self.floor1, self.floor2)}
+        self.manager = User.objects.create_superuser('manager', 'manager@punch.vn', 'password')
+
+    def get_visible(self, user=None):
+        return set(Asset.objects.filter(pk__in=Asset.get_visible_ids(user or self.manager)))
+
+    def test_manager_sees_location_assets(self):
+        self.floor1.managers.add(self.manager)
+        self.assertEqual(self.get_visible(), {self.assets[self.floor1]})
+        self.client.force_login(self.manager)
+        response = self.client.get('/admin/asset_manager/asset/')
+        self.assertEqual(list(response.context['cl'].result_list), [self.assets[self.floor1]])
+
+    def test_forward_changes(self):
+        self.floor1.managers.add(self.manager)
+        self.floor2.managers.add(self.manager)
+        self.assertEqual(self.get_visible(), set(self.assets.values()))
+        self.floor1.managers.remove(self.manager)
+        self.assertEqual(self.get_visible(), {self.assets[self.floor2]})
+        self.floor2.managers.clear()
+        self.assertEqual(self.get_visible(), set())
+
+    def test_reverse_changes(self):
+        self.manager.managing_locations.add(self.floor1, self.floor2)
+        self.assertEqual(self.get_visible(), set(self.assets.values()))
+        self.manager.managing_locations.remove(self.floor2)
+        self.assertEqual(self.get_visible(), {self.assets[self.floor1]})
+        self.manager.managing_locations.clear()
+        self.assertEqual(self.get_visible(), set())
+
+    def test_filled_after_migrate(self):
+        self.floor1.managers.add(self.manager)
+        # managers set before the table existed
+        LocationVisibility.objects.all().delete()
+        self.assertEqual(self.get_visible(), set())
+        signals.fill_location_visibility(sender=None, using='default')
+        self.assertEqual(self.get_visible(), {self.assets[self.floor1]})
+
+        # rows in place are left alone
+        LocationVisibility.objects.filter(location=self.floor1).delete()
+        LocationVisibility.objects.create(user=self.manager, location=self.floor2)
+        signals.fill_location_visibility(sender=None, using='default')
+        self.assertEqual(self.get_visible(), {self.assets[self.floor2]})
+
+
+class ExchangeActionTest(TestCase):
+    """The bulk exchange actions of the asset and exchange admins."""
+    asset_url = '/admin/asset_manager/asset/'
+    exchange_url = '/admin/asset_manager/exchange/'
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        self.stock = Location.objects.create(office=office, name='Stock')
+        self.floor = Location.objects.create(office=office, name='Floor 1')
+        self.store = Location.objects.create(office=office, name='Store')
+        self.asset_type = Type.objects.create(name='Laptop', kitting_required=False)
+        self.admin = User.objects.create_superuser('admin', 'admin@punch.vn', 'password')
+        self.manager = User.objects.create_superuser('manager', 'manager@punch.vn', 'password')
+        self.staff = User.objects.create_user('staff', 'staff@punch.vn', 'password', is_staff=True)
+        self.staff.user_permissions.add(*Permission.objects.filter(
+            content_type__app_label='asset_manager', codename__in=['change_asset', 'change_exchange']))
+        self.stock.managers.add(self.admin)
+        self.store.managers.add(self.admin)
+        self.floor.managers.add(self.manager)
+        self.assets = self.create_assets(3)
+
+    def create_assets(self, count, holder=None, **kwargs):
+        return [
+            Asset.objects.create(
+                name='Latitude %d' % i, asset_type=self.asset_type, location=self.stock,
+                holder=holder or self.admin, **kwargs).pk
+            for i in range(count)]
+
+    def post_action(self, user, action, asset_ids, follow=True, **data):
+        self.client.force_login(user)
+        data.setdefault('reason', Exchange.REASON_EXCHANGE)
+        return self.client.post(self.asset_url, dict(
+            data, action=action, _selected_action=asset_ids, apply='1'), follow=follow)
+
+    def end_action(self, user, action, exchange_ids, follow=True):
+        self.client.force_login(user)
+        response = self.client.post(
+            self.exchange_url, {'action': action, '_selected_action': exchange_ids}, follow=follow)
+        return [str(message) for message in response.context['messages']] if follow else None
+
+    def assertStarted(self, response):
+        self.assertEqual(response.redirect_chain, [(self.asset_url, 302)])
+
+    def get_errors(self, response):
+        self.assertEqual(response.redirect_chain, [])
+        return response.context['form'].non_field_errors() + sum(response.context['form'].errors.values(), [])
+
+    def assign_to_floor(self, asset_ids, follow=True):
+        return self.post_action(
+            self.admin, 'assign_to_location', asset_ids, follow=follow,
+            location=self.floor.pk, receiver=self.manager.pk)
+
+    def test_assign_to_location(self):
+        response = self.assign_to_floor(self.assets)
+        self.assertStarted(response)
+        exchanges = Exchange.objects.filter(status=Exchange.STATUS_PENDING, receiver=self.manager)
+        self.assertEqual(exchanges.count(), 3)
+        self.assertEqual(set(exchanges.values_list('destination', flat=True)), {self.floor.pk})
+        # the assets wait for the receiver
+        self.assertEqual(Asset.objects.filter(holder=self.admin, location=self.stock).count(), 3)
+
+        response = self.assign_to_floor(self.assets[:1])
+        self.assertIn('1 assets already have a pending exchange: %s' % Asset(pk=self.assets[0]).get_code(),
+                      self.get_errors(response))
+        self.assertEqual(Exchange.objects.count(), 3)
+
+    def test_receiver_must_manage_location(self):
+        response = self.post_action(
+            self.admin, 'assign_to_location', self.assets, location=self.floor.pk, receiver=self.staff.pk)
+        self.assertIn('The receiver must be a manager of HN - Floor 1.', self.get_errors(response))
+        self.assertFalse(Exchange.objects.exists())
+
+    def test_assign_to_managed_location_is_taken(self):
+        response = self.post_action(
+            self.admin, 'assign_to_location', self.assets, location=self.store.pk, receiver=self.admin.pk)
+        self.assertStarted(response)
+        self.assertEqual(Exchange.objects.filter(status=Exchange.STATUS_TAKEN).count(), 3)
+        self.assertEqual(
+            set(Asset.objects.values_list('holder', 'location', 'assigned')), {(self.admin.pk, self.store.pk, False)})
+
+    def test_assign_to_user(self):
+        response = self.post_action(self.admin, 'assign_to_user', self.assets, receiver=self.admin.pk)
+        self.assertStarted(response)
+        self.assertEqual(
+            set(Asset.objects.values_list('holder', 'location', 'assigned')), {(self.admin.pk, self.stock.pk, True)})
+
+        # assets in use go back through hand over first
+        response = self.assign_to_floor(self.assets)
+        self.assertIn('3 assets are assigned to users, they must be handed over first', self.get_errors(response)[0])
+        response = self.post_action(self.admin, 'assign_to_user', self.assets, receiver=self.manager.pk)
+        self.assertIn('3 assets are assigned to users, they must be handed over first', self.get_errors(response)[0])
+        self.assertEqual(Exchange.objects.count(), 3)
+
+    def test_hand_over(self):
+        self.client.force_login(self.staff)
+        actions = self.client.get(self.asset_url).context['action_form'].fields['action'].choices
+        self.assertIn('hand_over', dict(actions))
+        self.assertNotIn('assign_to_user', dict(actions))
+
+        held = self.create_assets(2, holder=self.staff)
+        response = self.post_action(self.staff, 'hand_over', held, receiver=self.staff.pk)
+        self.assertIn('receiver', response.context['form'].errors)
+        response = self.post_action(self.staff, 'hand_over', held, receiver=self.manager.pk)
+        self.assertStarted(response)
+        self.assertEqual(Exchange.objects.filter(sender=self.staff, receiver=self.manager).count(), 2)
+
+    def test_hand_over_requires_held_assets(self):
+        # visible to a manager of their location, but not held
+        self.stock.managers.add(self.staff)
+        response = self.post_action(self.staff, 'hand_over', self.assets, receiver=self.manager.pk)
+        self.assertIn('3 assets are not held by you', self.get_errors(response)[0])
+
+    def test_accept(self):
+        self.assign_to_floor(self.assets)
+        exchange_ids = list(Exchange.objects.values_list('pk', flat=True))
+
+        # only the receiver accepts
+        messages = self.end_action(self.admin, 'accept_exchanges', exchange_ids)
+        self.assertEqual(messages, ['3 exchanges were not accepted, they are not pending or not yours'])
+        self.assertEqual(Exchange.objects.filter(status=Exchange.STATUS_PENDING).count(), 3)
+
+        messages = self.end_action(self.manager, 'accept_exchanges', exchange_ids[:2])
+        self.assertEqual(messages, ['Successfully accepted 2 exchanges'])
+        self.assertEqual(
+            set(Asset.objects.filter(pk__in=self.assets[:2]).values_list('holder', 'location', 'assigned')),
+            {(self.manager.pk, self.floor.pk, False)})
+        self.assertEqual(Asset.objects.get(pk=self.assets[2]).holder, self.admin)
+
+        messages = self.end_action(self.manager, 'reject_exchanges', exchange_ids)
+        self.assertEqual(messages, [
+            'Successfully rejected 1 exchanges', '2 exchanges were not rejected, they are not pending or not yours'])
+        self.assertEqual(Asset.objects.get(pk=self.assets[2]).holder, self.admin)
+
+    def test_cancel(self):
+        self.assign_to_floor(self.assets)
+        exchange_ids = list(Exchange.objects.values_list('pk', flat=True))
+        # only the sender cancels
+        messages = self.end_action(self.manager, 'cancel_exchanges', exchange_ids)
+        self.assertEqual(messages, ['3 exchanges were not cancelled, they are not pending or not yours'])
+        messages = self.end_action(self.admin, 'cancel_exchanges', exchange_ids)
+        self.assertEqual(messages, ['Successfully cancelled 3 exchanges'])
+        self.assertEqual(Asset.objects.filter(holder=self.admin, location=self.stock).count(), 3)
+
+    def count_queries(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            func(*args, follow=False, **kwargs)
+        return len(queries)
+
+    def test_start_queries_do_not_depend_on_assets(self):
+        # warm up the caches and the session, eg: content types
+        self.assign_to_floor(self.create_assets(1), follow=False)
+        queries = self.count_queries(self.assign_to_floor, self.assets)
+        assets = self.create_assets(20)
+        with self.assertNumQueries(queries):
+            self.assign_to_floor(assets, follow=False)
+        self.assertEqual(Exchange.objects.filter(status=Exchange.STATUS_PENDING).count(), 24)
+
+    def test_end_queries_do_not_depend_on_assets(self):
+        warm_up = self.create_assets(1)
+        assets = self.create_assets(20)
+        self.assign_to_floor(warm_up + self.assets + assets)
+        exchange_ids = [
+            list(Exchange.objects.filter(asset__in=batch).values_list('pk', flat=True))
+            for batch in (warm_up, self.assets, assets)]
+        self.end_action(self.manager, 'accept_exchanges', exchange_ids[0], follow=False)
+        queries = self.count_queries(self.end_action, self.manager, 'accept_exchanges', exchange_ids[1])
+        with self.assertNumQueries(queries):
+            self.end_action(self.manager, 'accept_exchanges', exchange_ids[2], follow=False)
+        self.assertEqual(Asset.objects.filter(holder=self.manager, location=self.floor).count(), 24)
+
+
+class AssetCountTest(TestCase):
+    """AssetCount follows every ORM path changing assets."""
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        self.stock = Location.objects.create(office=office, name='Stock')
+        self.floor = Location.objects.create(office=office, name='Floor 1')
+        self.laptop = Type.objects.create(name='Laptop', kitting_required=False)
+        self.monitor = Type.objects.create(name='Monitor', kitting_required=False)
+
+    def get_counts(self):
+        return {
+            (count.location_id, count.asset_type_id, count.status): count.count
+            for count in AssetCount.objects.all() if count.count}
+
+    def assertCountsRebuilt(self):
+        counts = self.get_counts()
+        call_command('rebuild-asset-counts', stdout=StringIO())
+        self.assertEqual(counts, self.get_counts())
+
+    def test_counts_follow_changes(self):
+        assets = [
+            Asset.objects.create(name='Latitude %d' % i, asset_type=self.laptop, location=self.stock)
+            for i in range(4)]
+        self.assertEqual(self.get_counts(), {(self.stock.pk, self.laptop.pk, Asset.EXCELLENCE): 4})
+
+        assets[0].location = self.floor
+        assets[0].save()
+        deferred = Asset.objects.only('name').get(pk=assets[1].pk)
+        deferred.status = Asset.LOST
+        deferred.save()
+        self.assertCountsRebuilt()
+
+        Asset.objects.filter(pk__in=[asset.pk for asset in assets[2:]]).update(location=self.floor)
+        Asset.objects.filter(location=self.floor).update(status=Asset.REPARING, asset_type_id=self.monitor.pk)
+        Asset.objects.filter(pk=assets[1].pk).update(name='Latitude E7450')
+        self.assertCountsRebuilt()
+
+        Asset.objects.bulk_create([
+            Asset(name='P2419H', asset_type=self.monitor, location=self.stock, status=Asset.GOOD)
+            for i in range(3)])
+        self.assertCountsRebuilt()
+
+        Asset.objects.get(pk=assets[0].pk).delete()
+        Asset.objects.filter(asset_type=self.monitor, location=self.stock).delete()
+        self.assertCountsRebuilt()
+        self.assertEqual(self.get_counts(), {
+            (self.stock.pk, self.laptop.pk, Asset.LOST): 1,
+            (self.floor.pk, self.monitor.pk, Asset.REPARING): 2,
+        })
+
+
+class StocktakeTest(TestCase):
+
+    def setUp(self):
+        office = Office.objects.create(name='HN', address='Hanoi')
+        self.stock = Location.objects.create(office=office, name='Stock')
+        self.floor = Location.objects.create(office=office, name='Floor 1')
+        self.user = User.objects.create(username='auditor')
+        asset_type = Type.objects.create(name='Laptop', kitting_required=False)
+
+        def create(name, location, status=Asset.GOOD):
+            return Asset.objects.create(name=name, asset_type=asset_type, location=location, status=status).pk
+
+        self.found = create('found', self.stock)
+        self.missing = create('missing', self.stock)
+        self.still_missing = create('still missing', self.stock, Asset.NOT_FOUND)
+        self.lost = create('lost', self.stock, Asset.LOST)
+        self.disposed = create('disposed', self.stock, Asset.DISPOSED)
+        self.misplaced = create('misplaced', self.floor)
+        self.recovered = create('recovered', self.stock, Asset.NOT_FOUND)
+        self.recovered_elsewhere = create('recovered elsewhere', self.floor, Asset.NOT_FOUND)
+        self.codes = [
+            Asset(pk=pk).get_code()
+            for pk in (self.found, self.found, self.disposed, self.misplaced, self.recovered, self.recovered_elsewhere)
+        ] + ['PVN99999', 'OLD-042']
+
+    def get_ids(self, rows):
+        return [row['pk'] for row in rows]
+
+    def test_reconcile(self):
+        report = reconcile(self.stock, self.codes)
+        self.assertEqual(report['scanned'], 7)
+        self.assertEqual(self.get_ids(report['found']), [self.found, self.disposed, self.recovered])
+        # gone assets are not expected anymore
+        self.assertEqual(self.get_ids(report['missing']), [self.missing, self.still_missing])
+        self.assertEqual([row['marked'] for row in report['missing']], [True, False])
+        self.assertEqual(self.get_ids(report['misplaced']), [self.misplaced, self.recovered_elsewhere])
+        self.assertEqual(report['misplaced'][0]['location'], 'HN - Floor 1')
+        self.assertEqual(self.get_ids(report['recovered']), [self.recovered, self.recovered_elsewhere])
+        self.assertEqual(report['unknown'], ['PVN99999', 'OLD-042'])
 
-# Create your tests here.
+    def test_apply(self):
+        stocktake, report = apply_stocktake(self.stock, self.codes, self.user)
+        self.assertEqual(
+            (stocktake.scanned, stocktake.found, stocktake.missing, stocktake.misplaced, stocktake.unknown),
+            (7, 3, 2, 2, 2))
+        self.assertEqual(Stocktake.objects.get().report, json.dumps(report))
+        self.assertEqual(dict(Asset.objects.values_list('pk', 'status')), {
+            self.found: Asset.GOOD,
+            self.missing: Asset.NOT_FOUND,
+            self.still_missing: Asset.NOT_FOUND,
+            self.lost: Asset.LOST,
+            self.disposed: Asset.DISPOSED,
+            self.misplaced: Asset.GOOD,
+            self.recovered: Asset.GOOD,
+            self.recovered_elsewhere: Asset.GOOD,
+        })
+        self.assertEqual(Asset.objects.filter(location=self.floor).count(), 0)
@@ -0,0 +1,43 @@
+"""Warranty expiry report of the assets.
+
+The assets whose warranty ends in a date range are counted per location and
+supplier with one grouped query on the indexed ``warranty_end_date``, the
+groups are small enough to be mailed by the send-reports command along with
+the expiring licenses.
+"""
+from datetime import timedelta
+
+from django.db.models import Count, Max, Min
+
+from .models import Asset
+from .stocktake import GONE_STATUSES
+
+WARNING_DAYS = 30
+
+
+def get_expiring_assets(today, warning_days=WARNING_DAYS, since=None):
+    """Return the assets whose warranty ends from ``since``, ``today`` by
+    default, until ``warning_days`` after today, not the lost or disposed ones.
+    """
+    return (Asset.objects
+                 .filter(warranty_end_date__gte=since or today,
+                         warranty_end_date__lt=today + timedelta(warning_days))
+                 .exclude(status__in=GONE_STATUSES))
+
+
+def get_expiring_warranties(today, warning_days=WARNING_DAYS, since=None):
+    """Return the expiring warranties grouped by location and supplier as dicts
+    with the number of assets, their first and last end dates and the
+    remaining days until the first one.
+    """
+    groups = list(
+        get_expiring_assets(today, warning_days, since)
+            .values('location_id', 'location__office__name', 'location__name', 'supplier_id', 'supplier__name')
+            .annotate(count=Count('pk'), first_ended_date=Min('warranty_end_date'),
+                      last_ended_date=Max('warranty_end_date'))
+            .order_by('first_ended_date', 'location__office__name', 'location__name', 'supplier__name'))
+    for group in groups:
+        group['location'] = ('%s - %s' % (group['location__office__name'], group['location__name'])
+                             if group['location_id'] else '')
+        group['remaining_days'] = (group['first_ended_date'] - today).days
+    return groups
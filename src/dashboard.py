@@ -16,9 +16,29 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
+from django.db.models import Max
+from django.utils import timezone
+
 from admin_tools.dashboard import modules, Dashboard, AppIndexDashboard
 from admin_tools.utils import get_admin_site_name
 
+from license_manager.models import JobRun
+
+
+def get_job_run_links():
+    """Return links to the last run of every scheduled job."""
+    last_ids = JobRun.objects.values('job').annotate(last_id=Max('pk')).values_list('last_id', flat=True)
+    links = []
+    for run in JobRun.objects.filter(pk__in=list(last_ids)).order_by('job'):
+        description = '%s, %s' % (run.get_status_display(), timezone.localtime(run.started_at).strftime('%Y-%m-%d %H:%M'))
+        if run.duration is not None:
+            description += ', %.1fs' % run.duration
+        links.append({
+            'title': '%s: %s' % (run.job, description),
+            'url': reverse('admin:license_manager_jobrun_change', args=(run.pk,)),
+        })
+    return links
+
 
 class CustomIndexDashboard(Dashboard):
     """
@@ -69,6 +89,11 @@ class CustomIndexDashboard(Dashboard):
         # append a recent actions module
         self.children.append(modules.RecentActions(_('Recent Actions'), 5))
 
+        self.children.append(modules.LinkList(
+            _('Scheduled Jobs'),
+            children=get_job_run_links(),
+        ))
+
         # # append a feed module
         # self.children.append(modules.Feed(
         #     _('Latest Django News'),
@@ -6,6 +6,8 @@ from django.db import router
 from django.template.response import TemplateResponse
 from django.utils.translation import gettext as _, gettext_lazy
 
+from .models import LicenseAssignmentHistory
+
 
 def delete_license_assignments(modeladmin, request, queryset):
     """
@@ -40,7 +42,9 @@ def delete_license_assignments(modeladmin, request, queryset):
         n = queryset.count()
         licenses = {}
         if n:
+            deleted_ids = []
             for obj in queryset:
+                deleted_ids.append(obj.pk)
                 obj_display = str(obj)
                 if obj.license_id:
                     if obj.license_id not in licenses:
@@ -48,6 +52,7 @@ def delete_license_assignments(modeladmin, request, queryset):
                     else:
                         licenses[obj.license_id]['count'] += 1
                 modeladmin.log_deletion(request, obj, obj_display)
+            LicenseAssignmentHistory.close(deleted_ids)
             queryset.delete()
             for val in licenses.values():
                 val['lic'].unassign(val['count'])
@@ -1,28 +1,42 @@
-from django.http import HttpResponseRedirect
+from datetime import datetime, timedelta
+
+from django.http import HttpResponseRedirect, Http404
 from django.core.urlresolvers import reverse
 from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib import messages
-from django.db.models import F, Q
+from django.db.models import F, Q, Count
 from django.db import transaction
 from django.contrib.auth.models import User
 from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator, InvalidPage
+from django.forms import modelformset_factory
+from django.shortcuts import get_object_or_404
 from django.template.response import SimpleTemplateResponse, TemplateResponse
+from django.utils import timezone
 from django.utils.html import format_html
+from django.utils.http import urlencode
 
+from dal import autocomplete
+from dal import forward
 from django_admin_listfilter_dropdown.filters import RelatedDropdownFilter
 
 import nested_admin
 
+from asset_manager.models import Notification
 from .models import (
     Supplier, SoftwareFamily, Software, LicenseImage, LicenseKey,
-    Platform, License, LicensedSoftware, LicenseAssignment, LicenseSummary)
+    Platform, License, LicensedSoftware, LicenseAssignment, LicenseSummary,
+    ArchivedLicenseAssignment, LicenseUsage, LicenseAssignmentHistory, JobRun)
 from .forms import (
-    SoftwareForm, LicenseForm, LicenseKeyForm,
+    SoftwareForm, LicenseForm, LicenseKeyForm, LicenseKeyFilterForm, BaseLicenseKeyFormSet,
     LicensedSoftwareForm, LicenseAssignmentForm, LicenseBulkAssignForm
 )
 from .actions import delete_license_assignments
+from .allocation import get_allocator_class, combine_pk
+from .usage import get_depletion_dates
 
 
 class SupplierAdmin(admin.ModelAdmin):
@@ -53,6 +67,12 @@ class LicenseKeyInline(nested_admin.NestedTabularInline):
     form = LicenseKeyForm
     extra = 1
     classes = ['collapse']
+    verbose_name_plural = 'new license keys'
+
+    def get_queryset(self, request):
+        # Existing keys are edited on the paginated license keys page,
+        # the inline is only used to add new ones.
+        return super(LicenseKeyInline, self).get_queryset(request).none()
 
 
 class LicensedSoftwareInline(nested_admin.NestedStackedInline):
@@ -61,6 +81,22 @@ class LicensedSoftwareInline(nested_admin.NestedStackedInline):
     min_num = 1
     extra = 1
     inlines = [LicenseKeyInline]
+    readonly_fields = ['get_license_keys']
+
+    def get_queryset(self, request):
+        qs = super(LicensedSoftwareInline, self).get_queryset(request)
+        return qs.annotate(key_count=Count('licensekey'))
+
+    def get_license_keys(self, obj):
+        if not obj.pk:
+            return '-'
+        opts = License._meta
+        url = reverse(
+            'admin:%s_%s_license_keys' % (opts.app_label, opts.model_name),
+            args=[obj.license_id, obj.pk]
+        )
+        return format_html('<a href="{}">Manage {} license keys</a>', url, getattr(obj, 'key_count', 0))
+    get_license_keys.short_description = 'License keys'
 
 
 class LicenseImageInline(nested_admin.NestedTabularInline):
@@ -93,6 +129,23 @@ class LicenseAdmin(nested_admin.NestedModelAdmin):
     )
     search_fields = ['description']
     autocomplete_fields = ['supplier', 'software_family']
+    license_keys_per_page = 50
+    usage_periods = {
+        'week': (LicenseUsage.PERIOD_WEEK, 52 * 7),
+        'month': (LicenseUsage.PERIOD_MONTH, 36 * 31),
+    }
+    usage_chart_size = (600, 120)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urlpatterns = super(LicenseAdmin, self).get_urls()
+        my_urls = [
+            url(r'^usage/$', self.admin_site.admin_view(self.usage_view), name='%s_%s_usage' % info),
+            url(r'^(\d+)/softwares/(\d+)/keys/$',
+                self.admin_site.admin_view(self.license_keys_view),
+                name='%s_%s_license_keys' % info)
+        ]
+        return my_urls + urlpatterns
 
     def get_fieldsets(self, request, obj):
         basic_fieldset = ()
@@ -160,6 +213,184 @@ class LicenseAdmin(nested_admin.NestedModelAdmin):
     linked_used_total.short_description = 'used total'
     linked_used_total.admin_order_field = 'used_total'
 
+    def get_license_keys_queryset(self, licensed_software, filters):
+        """Return license keys of a licensed software, filtered by serial key
+        and availability (a single key is unavailable once it is assigned).
+        """
+        qs = LicenseKey.objects.filter(licensed_software=licensed_software)
+        if filters.get('q'):
+            qs = qs.filter(serial_key__icontains=filters['q'])
+        available = filters.get('available')
+        if available:
+            used_ids = LicenseAssignment.objects.filter(
+                license_key__licensed_software=licensed_software,
+                license_key__activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE,
+            ).values('license_key_id')
+            if available == '1':
+                qs = qs.exclude(pk__in=used_ids)
+            else:
+                qs = qs.filter(pk__in=used_ids)
+        return qs.prefetch_related('platforms').order_by('pk')
+
+    def license_keys_view(self, request, object_id, licensed_software_id):
+        obj = self.get_object(request, object_id)
+        if obj is None:
+            raise Http404
+        if not self.has_change_permission(request, obj):
+            raise PermissionDenied
+        licensed_software = get_object_or_404(
+            LicensedSoftware.objects.select_related('software'),
+            pk=licensed_software_id, license=obj)
+        opts = self.model._meta
+
+        filter_form = LicenseKeyFilterForm(request.GET)
+        filters = filter_form.cleaned_data if filter_form.is_valid() else {}
+        queryset = self.get_license_keys_queryset(licensed_software, filters)
+        paginator = Paginator(queryset, self.license_keys_per_page)
+        try:
+            page = paginator.page(request.GET.get('p', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+
+        LicenseKeyFormSet = modelformset_factory(
+            LicenseKey,
+            form=LicenseKeyForm,
+            formset=BaseLicenseKeyFormSet,
+            fields=('serial_key', 'activation_type', 'platforms'),
+            extra=0,
+            can_delete=True,
+            widgets={
+                'platforms': autocomplete.ModelSelect2Multiple(
+                    url='platform_autocomplete',
+                    forward=[forward.Const(licensed_software.software_id, 'software')],
+                ),
+            }
+        )
+        if request.method == 'POST':
+            # only the submitted keys are loaded, unchanged ones skip validation
+            submitted_ids = [
+                value for key, value in request.POST.items()
+                if key.startswith('form-') and key.endswith('-id') and value.isdigit()]
+            formset = LicenseKeyFormSet(
+                request.POST,
+                queryset=self.get_license_keys_queryset(licensed_software, {}).filter(pk__in=submitted_ids))
+            if formset.is_valid():
+                with transaction.atomic():
+                    formset.save()
+                    count = len(formset.changed_objects) + len(formset.deleted_objects)
+                    if count:
+                        self.log_change(
+                            request, obj,
+                            "Changed %d license keys of %s" % (count, licensed_software))
+                self.message_user(
+                    request,
+                    "Successfully saved %d license keys" % count,
+                    messages.SUCCESS
+                )
+                return HttpResponseRedirect(request.get_full_path())
+        else:
+            formset = LicenseKeyFormSet(queryset=page.object_list)
+
+        key_ids = [form.instance.pk for form in formset.forms if form.instance.pk]
+        key_users = {}
+        for key_id, username in (LicenseAssignment.objects
+                                                  .filter(license_key__in=key_ids)
+                                                  .values_list('license_key_id', 'user__username')):
+            key_users.setdefault(key_id, []).append(username)
+        for form in formset.forms:
+            form.instance.assigned_users = key_users.get(form.instance.pk, [])
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'License keys of %s' % licensed_software,
+            'original': obj,
+            'licensed_software': licensed_software,
+            'filter_form': filter_form,
+            'filter_query': urlencode({k: v for k, v in filters.items() if v}),
+            'formset': formset,
+            'page': page,
+            'paginator': paginator,
+            'opts': opts,
+            'media': self.media + formset.media,
+            'has_change_permission': True,
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/license_keys.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
+    def get_usage_charts(self, rows):
+        """Return one chart per software family with the SVG points of its
+        total and used seats, from rows ordered by family and date.
+        """
+        width, height = self.usage_chart_size
+        series = {}
+        for family, date, total, used_total, peak_used in rows:
+            series.setdefault(family, []).append((date, total, used_total, peak_used))
+        charts = []
+        for family, values in sorted(series.items()):
+            top = max(total for date, total, used_total, peak_used in values) or 1
+            step = width / max(len(values) - 1, 1)
+
+            def points(index):
+                return ' '.join(
+                    '%.1f,%.1f' % (i * step, height - value[index] * height / top)
+                    for i, value in enumerate(values))
+
+            charts.append({
+                'family': family,
+                'total_points': points(1),
+                'used_points': points(2),
+                'peak_points': points(3),
+                'first': values[0],
+                'last': values[-1],
+            })
+        return charts
+
+    def usage_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        today = timezone.now().date()
+        period_name = request.GET.get('period')
+        if period_name not in self.usage_periods:
+            period_name = 'week'
+        period, days = self.usage_periods[period_name]
+
+        # rollups of the software families only, assignments are never read
+        rows = (LicenseUsage.objects
+                            .filter(period=period, license__isnull=True, date__gte=today - timedelta(days))
+                            .values_list('software_family__name', 'date', 'total', 'used_total', 'peak_used')
+                            .order_by('software_family__name', 'date'))
+        projections = get_depletion_dates(today)
+        depletions = []
+        for pk, description, total, used_total in (License.objects
+                                                          .filter(pk__in=projections.keys())
+                                                          .values_list('pk', 'description', 'total', 'used_total')):
+            depletions.append(dict(projections[pk], pk=pk, description=description, total=total,
+                                   used_total=used_total))
+        depletions.sort(key=lambda row: row['date'])
+
+        width, height = self.usage_chart_size
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'License usage',
+            'opts': opts,
+            'period': period_name,
+            'periods': sorted(self.usage_periods),
+            'charts': self.get_usage_charts(rows),
+            'chart_width': width,
+            'chart_height': height,
+            'depletions': depletions,
+            'has_change_permission': True,
+        }
+        return TemplateResponse(
+            request,
+            "admin/%s/%s/usage.html" % (opts.app_label, opts.model_name),
+            context
+        )
+
 
 class LicenseAssignmentAdmin(admin.ModelAdmin):
     form = LicenseAssignmentForm
@@ -240,7 +471,7 @@ class LicenseAssignmentAdmin(admin.ModelAdmin):
         query = Q(software__in=softwares, remaining__gt=0)
         if licenses:
             query &= Q(license__in=licenses)
-        rels = (
+        rels = list(
             LicensedSoftware.objects
             .select_related('license')
             .annotate(remaining=F('license__total') - F('license__used_total'))
@@ -262,19 +493,38 @@ class LicenseAssignmentAdmin(admin.ModelAdmin):
                 obj.license.remaining = obj.remaining
                 license_lut[obj.license_id] = obj.license
 
-            # populate the license keys lookup dict
-            # a key is a combination of software_id and license_id
-            # a value is license keys queryset corresponding to the software and the license
-            combined_pk = "{}_{}".format(obj.software_id, obj.license_id)
-            license_key_lut[combined_pk] = list(
-                LicenseKey.objects
-                .filter(
-                    licensed_software=obj.pk,
-                    platforms=platform)
-                .order_by('activation_type')
-            )
+        # populate the license keys lookup dict
+        # a key is a combination of software_id and license_id
+        # a value is a list of the keys available on the platform,
+        # single keys already assigned to someone are left out
+        used_key_ids = LicenseAssignment.objects.filter(
+            license_key__licensed_software__in=rels,
+            license_key__activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE,
+        ).values('license_key_id')
+        keys = (
+            LicenseKey.objects
+            .select_related('licensed_software')
+            .filter(licensed_software__in=rels, platforms=platform)
+            .exclude(pk__in=used_key_ids)
+            .order_by('activation_type', 'pk')
+        )
+        for key in keys:
+            combined_pk = combine_pk(key.licensed_software.software_id, key.licensed_software.license_id)
+            license_key_lut.setdefault(combined_pk, []).append(key)
         return software_license_lut, license_lut, license_key_lut
 
+    def get_existing_assignments(self, users, softwares, platform):
+        """Map (user_id, software_id) to an existing assignment on the platform.
+        An assignment without license is preferred so it could be filled.
+        """
+        existing = {}
+        qs = LicenseAssignment.objects.filter(user__in=users, software__in=softwares, platform=platform)
+        for obj in qs.order_by('pk'):
+            key = (obj.user_id, obj.software_id)
+            if key not in existing or (existing[key].license_id and not obj.license_id):
+                existing[key] = obj
+        return existing
+
     def bulk_assign_view(self, request):
         if not self.has_add_permission(request):
             raise PermissionDenied
@@ -293,68 +543,66 @@ class LicenseAssignmentAdmin(admin.ModelAdmin):
                 licenses = form.cleaned_data['licenses']
 
                 maps, licenses, license_keys = self.get_lookup_tables(platform, softwares, licenses)
-                assignments = []
+                existing_assignments = self.get_existing_assignments(
+                    form.cleaned_data['users'], softwares, platform)
+                pairs = []
                 for user in form.cleaned_data['users']:
                     for sw in softwares:
-                        lic = None
-                        lic_key = None
-                        duplicate = False
-                        assignment_pk = None
-                        if sw.id in maps:
-                            # loop through the licenses of the software until found a valid one
-                            while maps[sw.id]:
-                                lic_id = maps[sw.id][0]
-                                if lic_id in licenses and licenses[lic_id].remaining > 0:
-                                    lic = licenses[lic_id]
-                                    break
-                                else:
-                                    # delete invalid license to avoid it in next loop
-                                    del maps[sw.id][0]
-                                    continue
-
-                        skip = True if not lic and skip_not_enough else False
-                        existing_assignment = (
-                            LicenseAssignment
-                            .objects
-                            .filter(
-                                user=user, software=sw, platform=platform)
-                            .order_by('-license')
-                            .first()
-                        )
-                        if existing_assignment:
-                            # if user has been assigned software but not license
-                            # try to assign a license to the user
-                            if not existing_assignment.license and lic:
-                                assignment_pk = existing_assignment.pk
-                            elif avoid_duplicates:
-                                # otherwise we should skip to avoid duplicate records
-                                lic = None
-                                duplicate = True
-                                skip = True
-
-                        if lic and not skip:
-                            lic.remaining -= 1
-
-                        if lic and not skip_license_key:
-                            # try to find a license key
-                            combined_pk = "{}_{}".format(sw.id, lic.id)
-                            if combined_pk in license_keys and license_keys[combined_pk]:
-                                lic_key = license_keys[combined_pk][0]
-                                if lic_key.activation_type == LicenseKey.ACTIVATION_TYPE_SINGLE:
-                                    del license_keys[combined_pk][0]
-
-                        assignments.append({
-                            'pk': assignment_pk,
-                            'user': user,
-                            'software': sw,
-                            'license': lic,
-                            'license_key': lic_key,
-                            'skip': skip,
-                            'duplicate': duplicate,
-                        })
+                        existing_assignment = existing_assignments.get((user.pk, sw.pk))
+                        # a licensed duplicate never needs a license
+                        needs_license = not (
+                            avoid_duplicates and existing_assignment and existing_assignment.license_id)
+                        pairs.append((user, sw, existing_assignment, needs_license))
+
+                # solve the whole batch at once
+                allocator = get_allocator_class()(maps, licenses, license_keys, skip_license_key)
+                allocated = iter(allocator.allocate([sw.pk for user, sw, e, needs in pairs if needs]))
+
+                assignments = []
+                for user, sw, existing_assignment, needs_license in pairs:
+                    lic = None
+                    lic_key = None
+                    duplicate = False
+                    assignment_pk = None
+                    if needs_license:
+                        lic_id = next(allocated)
+                        if lic_id:
+                            lic = licenses[lic_id]
+
+                    skip = True if not lic and skip_not_enough else False
+                    if existing_assignment:
+                        # if user has been assigned software but not license
+                        # try to assign a license to the user
+                        if not existing_assignment.license_id and lic:
+                            assignment_pk = existing_assignment.pk
+                        elif avoid_duplicates:
+                            # otherwise we should skip to avoid duplicate records
+                            lic = None
+                            duplicate = True
+                            skip = True
+
+                    if lic and not skip_license_key:
+                        # try to find a license key
+                        combined_pk = combine_pk(sw.id, lic.id)
+                        if combined_pk in license_keys and license_keys[combined_pk]:
+                            lic_key = license_keys[combined_pk][0]
+                            if lic_key.activation_type == LicenseKey.ACTIVATION_TYPE_SINGLE:
+                                del license_keys[combined_pk][0]
+
+                    assignments.append({
+                        'pk': assignment_pk,
+                        'user': user,
+                        'software': sw,
+                        'license': lic,
+                        'license_key': lic_key,
+                        'skip': skip,
+                        'duplicate': duplicate,
+                    })
 
                 if '_confirmed' in request.POST:
                     with transaction.atomic():
+                        saved = []
+                        notifications = []
                         for assignment in assignments:
                             if assignment['skip']:
                                 continue
@@ -369,12 +617,21 @@ class LicenseAssignmentAdmin(admin.ModelAdmin):
                                 'license_key_id': license_key.pk if license_key else None
                             }
                             obj = LicenseAssignment(**kwargs)
-                            obj.save()
+                            if assignment['pk']:
+                                # the existing assignment had no license, let save() count the seat
+                                obj.original_license_id = None
+                            obj.save(record_history=False, notify=False)
+                            saved.append(obj)
+                            notifications.append((
+                                assignment['user'].pk,
+                                LicenseAssignment.NOTIFICATION % assignment['software'].get_full_name()))
                             log_message = "Assigned a %s license for %s via bulk assign" % (assignment['software'].get_full_name(), assignment['user'].username)
                             if assignment['pk']:
                                 self.log_change(request, obj, log_message)
                             else:
                                 self.log_addition(request, obj, log_message)
+                        LicenseAssignmentHistory.record(saved)
+                        Notification.queue(notifications)
                     post_url = reverse(
                         'admin:%s_%s_changelist' % (opts.app_label, opts.model_name),
                         current_app=self.admin_site.name,
@@ -455,6 +712,81 @@ class LicenseSummaryAdmin(admin.ModelAdmin):
         response.context_data['license_summary'] = License.get_license_summary(qs)
         return response
 
+
+class ArchivedLicenseAssignmentAdmin(admin.ModelAdmin):
+    list_display = ['user', 'software', 'platform', 'license', 'reason', 'archived_at']
+    list_select_related = ['user', 'software', 'platform', 'license', 'software__software_family']
+    list_filter = (
+        ('user', RelatedDropdownFilter),
+        ('software', RelatedDropdownFilter),
+        'reason', 'archived_at',
+    )
+    search_fields = ['user__username', 'software__name', 'license__description']
+
+    def has_add_permission(self, request):
+        return False
+
+
+class AsOfFilter(admin.SimpleListFilter):
+    """Show the assignment intervals valid at the end of a day, any
+    YYYY-MM-DD value is accepted besides the listed ones.
+    """
+    title = 'as of'
+    parameter_name = 'as_of'
+    template = 'admin/license_manager/as_of_filter.html'
+
+    def lookups(self, request, model_admin):
+        today = timezone.now().date()
+        end_of_last_month = today.replace(day=1) - timedelta(1)
+        end_of_last_year = today.replace(month=1, day=1) - timedelta(1)
+        return (
+            (today.isoformat(), 'Today'),
+            (end_of_last_month.isoformat(), 'End of last month'),
+            (end_of_last_year.isoformat(), 'End of last year'),
+        )
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            date = datetime.strptime(self.value(), '%Y-%m-%d').date()
+        except ValueError:
+            raise IncorrectLookupParameters('Invalid date %s' % self.value())
+        return queryset.as_of(date)
+
+
+class LicenseAssignmentHistoryAdmin(admin.ModelAdmin):
+    list_display = ['user', 'software', 'platform', 'license', 'license_key', 'valid_from', 'valid_to']
+    list_select_related = ['user', 'software', 'platform', 'license', 'license_key', 'software__software_family']
+    list_filter = (
+        AsOfFilter,
+        ('software', RelatedDropdownFilter),
+        ('license', RelatedDropdownFilter),
+    )
+    search_fields = ['user__username', 'software__name', 'license__description']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+
+class JobRunAdmin(admin.ModelAdmin):
+    list_display = ['job', 'status', 'started_at', 'duration', 'rows']
+    list_filter = ('job', 'status', 'started_at')
+    date_hierarchy = 'started_at'
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+
 admin.site.register(Supplier, SupplierAdmin)
 admin.site.register(SoftwareFamily, SoftwareFamilyAdmin)
 admin.site.register(Software, SoftwareAdmin)
@@ -462,3 +794,6 @@ admin.site.register(Platform, PlatformAdmin)
 admin.site.register(License, LicenseAdmin)
 admin.site.register(LicenseAssignment, LicenseAssignmentAdmin)
 admin.site.register(LicenseSummary, LicenseSummaryAdmin)
+admin.site.register(ArchivedLicenseAssignment, ArchivedLicenseAssignmentAdmin)
+admin.site.register(LicenseAssignmentHistory, LicenseAssignmentHistoryAdmin)
+admin.site.register(JobRun, JobRunAdmin)
@@ -0,0 +1,378 @@
+"""License allocation engines used by the bulk assign view.
+
+An allocator receives the seats requested in a bulk assign batch (one
+software id per seat) together with the lookup tables built by
+``LicenseAssignmentAdmin.get_lookup_tables`` and returns the license id
+chosen for every seat (or None when no license is left).
+
+The engine is selected with the ``LICENSE_ALLOCATOR`` setting.
+"""
+import heapq
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import License, LicenseKey
+
+DEFAULT_ALLOCATOR = 'license_manager.allocation.MinCostAllocator'
+
+
+def get_allocator_class():
+    return import_string(getattr(settings, 'LICENSE_ALLOCATOR', DEFAULT_ALLOCATOR))
+
+
+def combine_pk(software_id, license_id):
+    return "{}_{}".format(software_id, license_id)
+
+
+class BaseAllocator(object):
+    def __init__(self, software_license_lut, license_lut, license_key_lut, skip_license_key=False, today=None):
+        """
+        software_license_lut: software id -> license ids, ordered by remaining
+        license_lut: license id -> License annotated with ``remaining``
+        license_key_lut: "<software_id>_<license_id>" -> available keys on the platform
+        """
+        self.software_license_lut = software_license_lut
+        self.license_lut = license_lut
+        self.license_key_lut = license_key_lut
+        self.skip_license_key = skip_license_key
+        self.today = today or timezone.now().date()
+
+    def allocate(self, requests):
+        """Return a list of license ids (or None) aligned with ``requests``,
+        a list of software ids, one item per requested seat.
+        """
+        raise NotImplementedError
+
+
+class GreedyAllocator(BaseAllocator):
+    """Walk the seats in order and take the first license with capacity,
+    licenses with the least remaining seats first.
+    """
+    def allocate(self, requests):
+        remaining = {pk: lic.remaining for pk, lic in self.license_lut.items()}
+        maps = {sw_id: list(ids) for sw_id, ids in self.software_license_lut.items()}
+        result = []
+        for sw_id in requests:
+            lic_id = None
+            candidates = maps.get(sw_id, [])
+            while candidates:
+                if remaining.get(candidates[0], 0) > 0:
+                    lic_id = candidates[0]
+                    break
+                # drop the exhausted license to avoid it in next loop
+                del candidates[0]
+            if lic_id:
+                remaining[lic_id] -= 1
+            result.append(lic_id)
+        return result
+
+
+class MinCostAllocator(BaseAllocator):
+    """Solve the whole batch at once as a min-cost max-flow problem.
+
+    Seats of the same software are interchangeable, so the batch is a
+    transportation problem: softwares supply the requested seats, licenses
+    consume at most ``remaining`` of them. As many seats as possible are
+    licensed first, then the total cost is minimized.
+
+    Cost of giving one seat of software ``s`` a seat of license ``l``:
+
+    - expiry: subscriptions cost their days until ``ended_date``, capped at
+      ``EXPIRY_HORIZON``; other licenses cost ``EXPIRY_HORIZON``. Soon
+      expiring subscriptions are used first. Expired subscriptions are
+      never allocated.
+    - fragmentation: ``FRESH_LICENSE_COST`` when nobody uses the license yet,
+      plus up to ``FILL_COST`` proportional to its free ratio, so partially
+      used licenses are filled before whole ones are opened.
+    - keys: nothing while free SINGLE keys of the license remain on the
+      platform, ``REUSABLE_KEY_COST`` when only volume or server keys are left
+      and ``NO_KEY_COST`` when the seat would get no key at all. The SINGLE
+      key capacity is modeled as a separate edge so it is exact.
+
+    Key costs are ignored when license keys are skipped.
+    """
+    EXPIRY_HORIZON = 365
+    FRESH_LICENSE_COST = 1000
+    FILL_COST = 100
+    REUSABLE_KEY_COST = 50
+    NO_KEY_COST = 2000
+
+    def get_license_cost(self, lic):
+        if lic.license_type == License.LICENSE_SUBSCRIPTION and lic.ended_date:
+            cost = min((lic.ended_date - self.today).days, self.EXPIRY_HORIZON)
+        else:
+            cost = self.EXPIRY_HORIZON
+        if not lic.used_total:
+            cost += self.FRESH_LICENSE_COST
+        if lic.total:
+            cost += self.FILL_COST * lic.remaining // lic.total
+        return cost
+
+    def is_expired(self, lic):
+        return (lic.license_type == License.LICENSE_SUBSCRIPTION and
+                lic.ended_date is not None and lic.ended_date < self.today)
+
+    def get_key_edges(self, software_id, license_id, capacity):
+        """Return (capacity, extra cost) pairs of the edges between a software
+        and a license, split by the kind of key the seats would get.
+        """
+        if self.skip_license_key:
+            return [(capacity, 0)]
+        keys = self.license_key_lut.get(combine_pk(software_id, license_id), [])
+        singles = sum(1 for key in keys if key.activation_type == LicenseKey.ACTIVATION_TYPE_SINGLE)
+        reusable = len(keys) > singles
+        edges = []
+        if singles:
+            edges.append((min(singles, capacity), 0))
+        if capacity > singles:
+            edges.append((capacity - singles, self.REUSABLE_KEY_COST if reusable else self.NO_KEY_COST))
+        return edges
+
+    def allocate(self, requests):
+        demand = {}
+        for sw_id in requests:
+            demand[sw_id] = demand.get(sw_id, 0) + 1
+
+        capacities = {
+            lic_id: lic.remaining for lic_id, lic in self.license_lut.items()
+            if lic.remaining > 0 and not self.is_expired(lic)
+        }
+        problem = TransportationProblem(demand, capacities)
+        for sw_id, count in demand.items():
+            for lic_id in self.software_license_lut.get(sw_id, []):
+                if lic_id not in capacities:
+                    continue
+                lic = self.license_lut[lic_id]
+                cost = self.get_license_cost(lic)
+                for cap, key_cost in self.get_key_edges(sw_id, lic_id, min(count, lic.remaining)):
+                    problem.add_arc(sw_id, lic_id, cap, cost + key_cost)
+
+        problem.solve()
+
+        allocated = {}
+        for sw_id, lic_id, flow in problem.get_flows():
+            allocated.setdefault(sw_id, []).extend([lic_id] * flow)
+        result = []
+        for sw_id in requests:
+            ids = allocated.get(sw_id)
+            result.append(ids.pop() if ids else None)
+        return result
+
+
+class TransportationProblem(object):
+    """Min-cost max-flow from softwares (supplies) to licenses (capacities)
+    with successive shortest paths.
+
+    A batch has few softwares and possibly thousands of licenses, so the
+    shortest paths are searched on the software nodes only: an arc between
+    two softwares stands for the cheapest way through a shared license,
+    forward on the arc of the first one and backward on a used arc of the
+    second one. The candidates of every such pair, and of every software to
+    the sink, are kept in heaps which are only refreshed for the licenses
+    of the last augmenting path. An augmentation costs O(softwares^2) plus
+    the arcs of the licenses it touches, whatever the number of licenses.
+
+    Shortest paths use Dijkstra with node potentials, which requires the
+    arc costs to be non-negative. After each search, every path of zero
+    reduced cost is augmented before searching again.
+    """
+    def __init__(self, supplies, capacities):
+        """supplies: source key -> units, capacities: license key -> units."""
+        self.sources = list(supplies)
+        self.index = {key: i for i, key in enumerate(self.sources)}
+        self.supply = [supplies[key] for key in self.sources]
+        self.capacity = dict(capacities)
+        self.arc_source = []
+        self.arc_license = []
+        self.arc_cap = []
+        self.arc_flow = []
+        self.arc_cost = []
+        self.license_arcs = {}
+
+    def add_arc(self, source, lic, cap, cost):
+        """Add an arc of capacity ``cap`` and unit ``cost``, return its index."""
+        index = len(self.arc_cap)
+        self.arc_source.append(self.index[source])
+        self.arc_license.append(lic)
+        self.arc_cap.append(cap)
+        self.arc_flow.append(0)
+        self.arc_cost.append(cost)
+        self.license_arcs.setdefault(lic, []).append(index)
+        return index
+
+    def get_flows(self):
+        """Yield (source, license, flow) of the arcs carrying flow."""
+        for index, flow in enumerate(self.arc_flow):
+            if flow:
+                yield self.sources[self.arc_source[index]], self.arc_license[index], flow
+
+    def push_candidates(self, lic):
+        """Add the usable moves through ``lic`` to the heaps."""
+        arc_source, arc_cap, arc_flow, arc_cost = self.arc_source, self.arc_cap, self.arc_flow, self.arc_cost
+        arcs = self.license_arcs[lic]
+        for i in arcs:
+            if not arc_cap[i]:
+                continue
+            a = arc_source[i]
+            if self.capacity[lic]:
+                heapq.heappush(self.sink_heaps[a], (arc_cost[i], i))
+            for j in arcs:
+                b = arc_source[j]
+                if arc_flow[j] and b != a:
+                    heapq.heappush(self.pair_heaps[a][b], (arc_cost[i] - arc_cost[j], i, j))
+
+    def get_best(self, a, b):
+        """Return the cheapest valid candidate from software ``a`` to software
+        ``b``, or to the sink when ``b`` is None, dropping the stale ones.
+        """
+        arc_cap, arc_flow = self.arc_cap, self.arc_flow
+        if b is None:
+            heap = self.sink_heaps[a]
+            while heap and not (arc_cap[heap[0][1]] and self.capacity[self.arc_license[heap[0][1]]]):
+                heapq.heappop(heap)
+        else:
+            heap = self.pair_heaps[a][b]
+            while heap and not (arc_cap[heap[0][1]] and arc_flow[heap[0][2]]):
+                heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def update_best(self, best, a, targets):
+        """Refresh the cheapest moves from ``a`` to ``targets`` and the sink."""
+        row = best[a]
+        for b in targets:
+            if b != a:
+                move = self.get_best(a, b)
+                if move is None:
+                    row.pop(b, None)
+                else:
+                    row[b] = move
+        move = self.get_best(a, None)
+        if move is None:
+            row.pop(len(self.sources), None)
+        else:
+            row[len(self.sources)] = move
+
+    def solve(self):
+        """Return (flow, cost) after pushing the maximum flow at minimum cost."""
+        size = len(self.sources)
+        sink = size
+        self.sink_heaps = [[] for a in range(size)]
+        self.pair_heaps = [[[] for b in range(size)] for a in range(size)]
+        for lic in self.license_arcs:
+            self.push_candidates(lic)
+        # best[a][b]: cheapest move from a to b, b == sink for the licenses
+        best = [{} for a in range(size)]
+        for a in range(size):
+            self.update_best(best, a, range(size))
+
+        potential = [0] * (size + 1)
+        total_flow = total_cost = 0
+        while True:
+            # Dijkstra from a virtual source linked to the softwares having supply
+            dist = [None] * (size + 1)
+            parent = [None] * (size + 1)
+            done = [False] * (size + 1)
+            heap = []
+            for a in range(size):
+                if self.supply[a]:
+                    dist[a] = -potential[a]
+                    heap.append((dist[a], a))
+            heapq.heapify(heap)
+            while heap:
+                d, u = heapq.heappop(heap)
+                if done[u]:
+                    continue
+                done[u] = True
+                if u == sink:
+                    break
+                pu = potential[u] + d
+                for v, move in best[u].items():
+                    if not done[v]:
+                        nd = pu + move[0] - potential[v]
+                        if dist[v] is None or nd < dist[v]:
+                            dist[v] = nd
+                            parent[v] = u
+                            heapq.heappush(heap, (nd, v))
+            if not done[sink]:
+                return total_flow, total_cost
+            # keep the reduced costs non-negative, unsettled nodes are
+            # at least as far as the sink
+            limit = dist[sink]
+            for node in range(size + 1):
+                potential[node] += dist[node] if done[node] else limit
+
+            path = []
+            v = sink
+            while v is not None:
+                path.append(v)
+                v = parent[v]
+            path.reverse()
+            # augment along every path of zero reduced cost before searching again
+            while path:
+                push = self.augment(best, path)
+                total_flow += push
+                total_cost += push * potential[sink]
+                path = self.find_admissible_path(best, potential)
+
+    def augment(self, best, path):
+        """Push the bottleneck of ``path``, a list of software indexes ending
+        with the sink, refresh the moves of its licenses and return the flow pushed.
+        """
+        sink = len(self.sources)
+        push = self.supply[path[0]]
+        for a, b in zip(path, path[1:]):
+            move = best[a][b]
+            push = min(push, self.arc_cap[move[1]])
+            if b == sink:
+                push = min(push, self.capacity[self.arc_license[move[1]]])
+            else:
+                push = min(push, self.arc_flow[move[2]])
+        self.supply[path[0]] -= push
+        touched = set()
+        for a, b in zip(path, path[1:]):
+            move = best[a][b]
+            i = move[1]
+            self.arc_cap[i] -= push
+            self.arc_flow[i] += push
+            touched.add(self.arc_license[i])
+            if b == sink:
+                self.capacity[self.arc_license[i]] -= push
+            else:
+                self.arc_cap[move[2]] += push
+                self.arc_flow[move[2]] -= push
+
+        softwares = set()
+        for lic in touched:
+            self.push_candidates(lic)
+            softwares.update(self.arc_source[i] for i in self.license_arcs[lic])
+        for a in softwares:
+            self.update_best(best, a, softwares)
+        return push
+
+    def find_admissible_path(self, best, potential):
+        """Return a path to the sink made of moves of zero reduced cost from a
+        software having supply, or None.
+        """
+        sink = len(self.sources)
+        visited = set()
+        for start in range(sink):
+            if not self.supply[start] or potential[start] or start in visited:
+                continue
+            visited.add(start)
+            path = [start]
+            stack = [iter(best[start].items())]
+            while stack:
+                for v, move in stack[-1]:
+                    if v not in visited and move[0] + potential[path[-1]] - potential[v] == 0:
+                        if v == sink:
+                            return path + [v]
+                        visited.add(v)
+                        path.append(v)
+                        stack.append(iter(best[v].items()))
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+        return None
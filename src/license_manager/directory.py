@@ -0,0 +1,92 @@
+import json
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+class FakeDirectoryService(object):
+    """Offline stand-in for the Admin SDK directory and reports services.
+
+    Users are read from a JSON file holding a list of directory user
+    resources (or a ``{"users": [...]}`` object), eg::
+
+        [{"primaryEmail": "john.doe@punch.vn", "suspended": false,
+          "orgUnitPath": "/punch-staff", "creationTime": "2018-01-01T00:00:00.000Z",
+          "lastChangeTime": "2018-06-01T00:00:00.000Z",
+          "name": {"givenName": "John", "familyName": "Doe", "fullName": "John Doe"}}]
+
+    ``lastChangeTime`` only exists in the fake, users changed at or after
+    the ``startTime`` of an activities request are reported as changed.
+
+    Only the calls made by sync-gsuite-users are supported:
+    ``users().list``, ``users().get`` and ``activities().list``, with paging.
+    """
+    def __init__(self, path, page_size=100):
+        with open(path) as f:
+            data = json.load(f)
+        self.directory_users = data['users'] if isinstance(data, dict) else data
+        self.page_size = page_size
+
+    def users(self):
+        return FakeUsersResource(self)
+
+    def activities(self):
+        return FakeActivitiesResource(self)
+
+    def paginate(self, items, key, pageToken=None, maxResults=None):
+        start = int(pageToken or 0)
+        end = start + (maxResults or self.page_size)
+        response = {key: items[start:end]}
+        if end < len(items):
+            response['nextPageToken'] = str(end)
+        return FakeRequest(response)
+
+
+class FakeUsersResource(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, domain=None, query=None, pageToken=None, maxResults=None, **kwargs):
+        users = self.service.directory_users
+        if query and query.startswith('orgUnitPath='):
+            path = query[len('orgUnitPath='):]
+            users = [user for user in users
+                     if user.get('orgUnitPath', path) == path or user.get('orgUnitPath', '').startswith(path + '/')]
+        if domain:
+            users = [user for user in users if user['primaryEmail'].endswith('@' + domain)]
+        return self.service.paginate(users, 'users', pageToken, maxResults)
+
+    def get(self, userKey, **kwargs):
+        for user in self.service.directory_users:
+            if user['primaryEmail'] == userKey:
+                return FakeRequest(user)
+        raise HttpError(httplib2.Response({'status': 404}), b'Resource Not Found: userKey')
+
+
+class FakeActivitiesResource(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userKey='all', applicationName='admin', startTime=None, pageToken=None, maxResults=None,
+             **kwargs):
+        items = [
+            {
+                'id': {'time': user['lastChangeTime'], 'applicationName': applicationName},
+                'events': [{
+                    'type': 'USER_SETTINGS',
+                    'name': 'CHANGE_USER',
+                    'parameters': [{'name': 'USER_EMAIL', 'value': user['primaryEmail']}],
+                }],
+            }
+            for user in self.service.directory_users
+            if user.get('lastChangeTime') and (not startTime or user['lastChangeTime'] >= startTime)
+        ]
+        return self.service.paginate(items, 'items', pageToken, maxResults)
+
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
@@ -44,6 +44,43 @@ class LicenseKeyForm(forms.ModelForm):
         }
 
 
+class LicenseKeyFilterForm(forms.Form):
+    AVAILABILITY_CHOICES = (
+        ('', 'All'),
+        ('1', 'Available'),
+        ('0', 'In use'),
+    )
+    q = forms.CharField(required=False, label='Serial key')
+    available = forms.ChoiceField(
+        required=False, choices=AVAILABILITY_CHOICES, label='Availability')
+
+
+class BaseLicenseKeyFormSet(forms.BaseModelFormSet):
+    """Formset for the paginated license key page.
+
+    Every form is built with ``empty_permitted`` so unchanged keys skip
+    validation entirely, only the keys the user touched are cleaned and saved.
+    """
+    def _construct_form(self, i, **kwargs):
+        kwargs['empty_permitted'] = True
+        return super(BaseLicenseKeyFormSet, self)._construct_form(i, **kwargs)
+
+    def clean(self):
+        super(BaseLicenseKeyFormSet, self).clean()
+        deleted_ids = [
+            form.instance.pk for form in self.forms
+            if form.instance.pk and self._should_delete_form(form)]
+        if not deleted_ids:
+            return
+        used_keys = (LicenseAssignment.objects
+                                      .filter(license_key__in=deleted_ids)
+                                      .values_list('license_key__serial_key', flat=True)
+                                      .distinct())
+        if used_keys:
+            raise forms.ValidationError(
+                "Could not delete license keys in use: %s" % ', '.join(used_keys))
+
+
 class LicensedSoftwareForm(forms.ModelForm):
     def clean_software(self):
         license = self.cleaned_data.get('license', None)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from license_manager.models import LicenseAssignment, LicenseAssignmentHistory
+
+
+class Command(BaseCommand):
+    help = '''Open a history interval for every license assignment without one,
+    eg: assignments created before the history existed.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--valid-from', type=str,
+            help='Start of the opened intervals (YYYY-MM-DD). Default: now')
+        parser.add_argument(
+            '-c', '--chunk-size', type=int, default=500,
+            help='Number of intervals opened per query. Default: 500')
+
+    def handle(self, *args, **options):
+        valid_from = timezone.now()
+        if options['valid_from']:
+            try:
+                valid_from = timezone.make_aware(datetime.strptime(options['valid_from'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('Invalid date %s, expected YYYY-MM-DD' % options['valid_from'])
+
+        recorded = set(LicenseAssignmentHistory.objects.current().values_list('assignment_id', flat=True))
+        assignments = [
+            obj for obj in (LicenseAssignment.objects
+                                             .only('user', 'software', 'platform', 'license', 'license_key')
+                                             .order_by('pk'))
+            if obj.pk not in recorded
+        ]
+        with transaction.atomic():
+            for i in range(0, len(assignments), options['chunk_size']):
+                LicenseAssignmentHistory.record(assignments[i:i + options['chunk_size']], at=valid_from)
+        self.stdout.write(self.style.SUCCESS('Opened %d history intervals' % len(assignments)))
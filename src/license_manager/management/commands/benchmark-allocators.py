@@ -0,0 +1,108 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from license_manager.allocation import GreedyAllocator, MinCostAllocator, combine_pk
+from license_manager.models import License, LicenseKey
+
+
+class Command(BaseCommand):
+    help = '''Compare license allocators of bulk assign on synthetic batches,
+    with few and with many licenses by default. Nothing is read from or
+    written to the database.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=500,
+            help='Number of users in the batch. Default: 500')
+        parser.add_argument(
+            '--softwares', type=int, default=20,
+            help='Number of softwares in the batch. Default: 20')
+        parser.add_argument(
+            '--licenses', type=int, nargs='+', default=[200, 2000],
+            help='Numbers of licenses, one batch per number. Default: 200 2000')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed. Default: 0')
+
+    def build_lookup_tables(self, license_count, **options):
+        rnd = random.Random(options['seed'])
+        today = timezone.now().date()
+        software_ids = list(range(1, options['softwares'] + 1))
+        seats = options['users'] * options['softwares']
+        software_license_lut = {}
+        license_lut = {}
+        license_key_lut = {}
+        for pk in range(1, license_count + 1):
+            license_type = rnd.choice([License.LICENSE_PERPETUAL, License.LICENSE_SUBSCRIPTION])
+            total = rnd.randint(1, 2 * seats // license_count + 1)
+            lic = License(
+                pk=pk, total=total,
+                used_total=rnd.choice([0, 0, rnd.randint(0, total)]),
+                license_type=license_type,
+                ended_date=today + timedelta(rnd.randint(-30, 700)) if license_type == License.LICENSE_SUBSCRIPTION else None,
+            )
+            lic.remaining = lic.total - lic.used_total
+            if not lic.remaining:
+                continue
+            license_lut[pk] = lic
+            for sw_id in rnd.sample(software_ids, rnd.randint(1, min(3, len(software_ids)))):
+                software_license_lut.setdefault(sw_id, []).append(pk)
+                keys = [LicenseKey(activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE)
+                        for i in range(rnd.randint(0, lic.remaining))]
+                if rnd.random() < 0.3:
+                    keys.append(LicenseKey(activation_type=LicenseKey.ACTIVATION_TYPE_VOLUME))
+                license_key_lut[combine_pk(sw_id, pk)] = keys
+        for ids in software_license_lut.values():
+            ids.sort(key=lambda pk: license_lut[pk].remaining)
+        requests = [sw_id for i in range(options['users']) for sw_id in software_ids]
+        return requests, software_license_lut, license_lut, license_key_lut
+
+    def evaluate(self, requests, result, license_lut, license_key_lut):
+        """Score an allocation with the cost model of MinCostAllocator."""
+        model = MinCostAllocator({}, license_lut, license_key_lut)
+        counts = {}
+        for sw_id, lic_id in zip(requests, result):
+            if lic_id:
+                counts[(sw_id, lic_id)] = counts.get((sw_id, lic_id), 0) + 1
+        cost = 0
+        keyless = 0
+        opened = set()
+        for (sw_id, lic_id), count in counts.items():
+            lic = license_lut[lic_id]
+            if not lic.used_total:
+                opened.add(lic_id)
+            for cap, key_cost in model.get_key_edges(sw_id, lic_id, count):
+                cost += cap * (model.get_license_cost(lic) + key_cost)
+                if key_cost == model.NO_KEY_COST:
+                    keyless += cap
+        return {
+            'licensed': sum(counts.values()),
+            'cost': cost,
+            'opened': len(opened),
+            'keyless': keyless,
+            'expired': sum(c for (sw_id, lic_id), c in counts.items() if model.is_expired(license_lut[lic_id])),
+        }
+
+    def handle(self, *args, **options):
+        for count in options['licenses']:
+            self.run_batch(count, **options)
+
+    def run_batch(self, count, **options):
+        requests, maps, licenses, license_keys = self.build_lookup_tables(count, **options)
+        self.stdout.write('%d seats, %d licenses with %d free seats' % (
+            len(requests), len(licenses), sum(lic.remaining for lic in licenses.values())))
+        for allocator_class in (GreedyAllocator, MinCostAllocator):
+            allocator = allocator_class(maps, licenses, license_keys)
+            started = time.time()
+            result = allocator.allocate(requests)
+            elapsed = time.time() - started
+            stats = self.evaluate(requests, result, licenses, license_keys)
+            self.stdout.write(
+                '%-18s %8.3fs  licensed: %d  cost: %d  fresh licenses opened: %d  '
+                'without key: %d  on expired licenses: %d' % (
+                    allocator_class.__name__, elapsed, stats['licensed'], stats['cost'],
+                    stats['opened'], stats['keyless'], stats['expired']))
@@ -0,0 +1,207 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from license_manager.models import (
+    License, LicensedSoftware, LicenseKey, LicenseAssignment, LicenseAssignmentHistory)
+
+
+class Command(BaseCommand):
+    help = '''Move license assignments between licenses of the same software family
+    so that as many licenses as possible become unused.
+    A license is only emptied if all of its assignments could be moved to
+    licenses having free seats and a license key for the same platform.
+    Expired subscriptions never receive assignments.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-f', '--family', type=str, nargs='+',
+            help='Only rebalance licenses of these software families (names).')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print the plan without moving anything.')
+
+    def load(self, **options):
+        """Load everything needed to plan the moves with a few bulk queries."""
+        licenses = (License.objects
+                           .filter(active=True)
+                           .exclude(license_type=License.LICENSE_OEM)
+                           .select_related('software_family'))
+        if options['family']:
+            licenses = licenses.filter(software_family__name__in=options['family'])
+        self.today = timezone.now().date()
+        self.licenses = {}
+        self.families = {}
+        for lic in licenses:
+            lic.free = lic.total - (lic.used_total or 0)
+            lic.assignments = []
+            self.licenses[lic.pk] = lic
+            self.families.setdefault(lic.software_family_id, []).append(lic)
+
+        # (license_id, software_id) -> licensed_software_id
+        self.licensed_softwares = {}
+        for pk, license_id, software_id in (LicensedSoftware.objects
+                                                            .filter(license__in=self.licenses.keys())
+                                                            .values_list('pk', 'license_id', 'software_id')):
+            self.licensed_softwares[(license_id, software_id)] = pk
+
+        used_keys = set()
+        assignments = (LicenseAssignment.objects
+                                        .filter(license__in=self.licenses.keys())
+                                        .values('pk', 'license_id', 'software_id', 'platform_id', 'license_key_id',
+                                                'license_key__activation_type', 'user__username',
+                                                'software__software_family__name', 'software__name')
+                                        .order_by('pk'))
+        for obj in assignments:
+            self.licenses[obj['license_id']].assignments.append(obj)
+            if obj['license_key__activation_type'] == LicenseKey.ACTIVATION_TYPE_SINGLE:
+                used_keys.add(obj['license_key_id'])
+
+        # (licensed_software_id, platform_id) -> {'single': [key ids], 'reusable': key id}
+        self.keys = {}
+        through = LicenseKey.platforms.through
+        rows = (through.objects
+                       .filter(licensekey__licensed_software__in=self.licensed_softwares.values())
+                       .values_list('licensekey_id', 'platform_id',
+                                    'licensekey__licensed_software_id', 'licensekey__activation_type')
+                       .order_by('licensekey_id'))
+        for key_id, platform_id, licensed_software_id, activation_type in rows:
+            keys = self.keys.setdefault((licensed_software_id, platform_id), {'single': [], 'reusable': None})
+            if activation_type != LicenseKey.ACTIVATION_TYPE_SINGLE:
+                if not keys['reusable']:
+                    keys['reusable'] = key_id
+            elif key_id not in used_keys:
+                keys['single'].append(key_id)
+
+    def get_expiry(self, lic):
+        """Return the end date of a subscription, date.max for other licenses."""
+        if lic.license_type == License.LICENSE_SUBSCRIPTION and lic.ended_date:
+            return lic.ended_date
+        return date.max
+
+    def find_target(self, assignment, source, excluded, taken_keys, reserved):
+        """Return (license, key_id) the assignment could move to, or None.
+
+        Expired subscriptions are left out. Licenses expiring no earlier
+        than the source are preferred, then the fullest ones to keep the
+        others emptiable. ``reserved`` counts the seats already planned on
+        every license for the source.
+        """
+        source_expiry = self.get_expiry(source)
+        candidates = sorted(
+            (lic for lic in self.families[source.software_family_id]
+             if lic.pk != source.pk and lic.pk not in excluded and lic.free > reserved.get(lic.pk, 0)
+             and self.get_expiry(lic) >= self.today),
+            key=lambda lic: (self.get_expiry(lic) < source_expiry, lic.free - reserved.get(lic.pk, 0), lic.pk))
+        for lic in candidates:
+            licensed_software_id = self.licensed_softwares.get((lic.pk, assignment['software_id']))
+            if not licensed_software_id:
+                continue
+            if not assignment['license_key_id']:
+                return lic, None
+            keys = self.keys.get((licensed_software_id, assignment['platform_id']))
+            if not keys:
+                continue
+            singles = [pk for pk in keys['single'] if pk not in taken_keys]
+            if assignment['license_key__activation_type'] == LicenseKey.ACTIVATION_TYPE_SINGLE:
+                options = singles[:1] + [keys['reusable']]
+            else:
+                options = [keys['reusable']] + singles[:1]
+            for key_id in options:
+                if key_id:
+                    return lic, key_id
+        return None
+
+    def plan(self):
+        """Return a list of (license, moves) where moves are (assignment, target, key_id).
+
+        Licenses with the fewest assignments are emptied first, so every
+        emptied license costs as few moves as possible.
+        """
+        plan = []
+        emptied = set()
+        targets = set()
+        taken_keys = set()
+        sources = sorted(
+            (lic for lic in self.licenses.values() if lic.assignments),
+            key=lambda lic: (len(lic.assignments), lic.ended_date is None, lic.ended_date, lic.pk))
+        for source in sources:
+            if source.pk in targets:
+                continue
+            moves = []
+            reserved = {}
+            reserved_keys = set()
+            for assignment in source.assignments:
+                target = self.find_target(assignment, source, emptied, taken_keys | reserved_keys, reserved)
+                if not target:
+                    break
+                lic, key_id = target
+                reserved[lic.pk] = reserved.get(lic.pk, 0) + 1
+                reserved_keys.add(key_id)
+                moves.append((assignment, lic, key_id))
+            if len(moves) < len(source.assignments):
+                # the license could not be emptied
+                continue
+            for pk, count in reserved.items():
+                self.licenses[pk].free -= count
+            source.free = source.total
+            emptied.add(source.pk)
+            targets.update(lic.pk for assignment, lic, key_id in moves)
+            taken_keys |= reserved_keys
+            plan.append((source, moves))
+        return plan
+
+    def print_plan(self, plan, **options):
+        for source, moves in plan:
+            self.stdout.write('%s: move %d assignments' % (source, len(moves)))
+            if options['verbosity'] > 1:
+                for assignment, lic, key_id in moves:
+                    self.stdout.write('    %s %s %s -> %s' % (
+                        assignment['user__username'], assignment['software__software_family__name'],
+                        assignment['software__name'], lic))
+        self.stdout.write('%d licenses could be emptied with %d moves' % (
+            len(plan), sum(len(moves) for source, moves in plan)))
+
+    @transaction.atomic
+    def apply_plan(self, plan):
+        deltas = {}
+        groups = {}
+        for source, moves in plan:
+            for assignment, lic, key_id in moves:
+                deltas[source.pk] = deltas.get(source.pk, 0) - 1
+                deltas[lic.pk] = deltas.get(lic.pk, 0) + 1
+                groups.setdefault((source.pk, lic.pk, key_id), []).append(assignment['pk'])
+
+        locked = License.objects.select_for_update().filter(pk__in=deltas.keys())
+        for pk, used_total in locked.values_list('pk', 'used_total'):
+            if used_total != self.licenses[pk].used_total:
+                raise CommandError('License %s changed while planning, please run again.' % self.licenses[pk])
+
+        for (source_id, license_id, key_id), ids in groups.items():
+            count = (LicenseAssignment.objects
+                                      .filter(pk__in=ids, license_id=source_id)
+                                      .update(license_id=license_id, license_key_id=key_id))
+            if count != len(ids):
+                raise CommandError('License assignments changed while planning, please run again.')
+        # the adjustments of all the licenses in one update
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        if deltas:
+            License.objects.filter(pk__in=deltas.keys()).update(used_total=F('used_total') + Case(
+                *[When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()],
+                default=Value(0), output_field=IntegerField()))
+        moved_ids = [pk for ids in groups.values() for pk in ids]
+        LicenseAssignmentHistory.record(
+            LicenseAssignment.objects.filter(pk__in=moved_ids).only('user', 'software', 'platform', 'license', 'license_key'))
+
+    def handle(self, *args, **options):
+        self.load(**options)
+        plan = self.plan()
+        self.print_plan(plan, **options)
+        if options['dry_run'] or not plan:
+            return
+        self.apply_plan(plan)
+        self.rows_affected = sum(len(moves) for source, moves in plan)
+        self.stdout.write(self.style.SUCCESS('Successfully rebalanced licenses'))
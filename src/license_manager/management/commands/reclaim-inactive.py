@@ -0,0 +1,133 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from asset_manager.models import Asset, Exchange, Notification
+from license_manager.models import (
+    License, LicenseKey, LicenseAssignment, ArchivedLicenseAssignment, LicenseAssignmentHistory)
+
+REASON = 'Deactivated user'
+
+
+class Command(BaseCommand):
+    help = '''Reclaim licenses of deactivated users:
+    - Archive and delete their license assignments
+    - Return the seats to the licenses, single license keys become available again
+    - Optionally hand their assets over to a receiver'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print a summary without changing anything.')
+        parser.add_argument(
+            '-c', '--chunk-size', type=int, default=500,
+            help='Number of assignments archived and deleted per query. Default: 500')
+        parser.add_argument(
+            '-r', '--asset-receiver', type=str,
+            help='Username of the user receiving the assets of deactivated users. '
+                 'Exchanges are only created when this is set.')
+
+    def get_assignments(self):
+        return list(
+            LicenseAssignment.objects
+                             .filter(user__is_active=False)
+                             .values('pk', 'user_id', 'software_id', 'platform_id', 'license_id',
+                                     'license_key_id', 'license_key__serial_key',
+                                     'license_key__activation_type', 'note', 'user__username')
+                             .order_by('pk'))
+
+    def get_assets(self):
+        return list(
+            Asset.objects
+                 .filter(holder__is_active=False, assigned=True)
+                 .exclude(exchange__status=Exchange.STATUS_PENDING)
+                 .values('pk', 'name', 'holder_id', 'holder__username', 'location_id', 'asset_type__kitting_required')
+                 .distinct())
+
+    def summarize(self, assignments, assets, **options):
+        users = {}
+        licenses = {}
+        single_keys = 0
+        for obj in assignments:
+            users.setdefault(obj['user__username'], 0)
+            users[obj['user__username']] += 1
+            if obj['license_id']:
+                licenses[obj['license_id']] = licenses.get(obj['license_id'], 0) + 1
+            if obj['license_key__activation_type'] == LicenseKey.ACTIVATION_TYPE_SINGLE:
+                single_keys += 1
+        if options['verbosity'] > 1:
+            for username, count in sorted(users.items()):
+                self.stdout.write('%s: %d license assignments' % (username, count))
+        self.stdout.write(
+            '%d license assignments of %d deactivated users, '
+            'returning %d seats to %d licenses and releasing %d single keys' % (
+                len(assignments), len(users), sum(licenses.values()), len(licenses), single_keys))
+        if options['asset_receiver']:
+            self.stdout.write('%d assets to hand over to %s' % (len(assets), options['asset_receiver']))
+        return licenses
+
+    def archive_assignments(self, assignments, chunk_size):
+        for i in range(0, len(assignments), chunk_size):
+            chunk = assignments[i:i + chunk_size]
+            ArchivedLicenseAssignment.objects.bulk_create([
+                ArchivedLicenseAssignment(
+                    user_id=obj['user_id'],
+                    software_id=obj['software_id'],
+                    platform_id=obj['platform_id'],
+                    license_id=obj['license_id'],
+                    license_key_id=obj['license_key_id'],
+                    serial_key=obj['license_key__serial_key'] or '',
+                    note=obj['note'],
+                    reason=REASON,
+                ) for obj in chunk
+            ])
+            ids = [obj['pk'] for obj in chunk]
+            LicenseAssignmentHistory.close(ids)
+            LicenseAssignment.objects.filter(pk__in=ids).delete()
+
+    def return_seats(self, licenses):
+        for pk, count in licenses.items():
+            License.objects.filter(pk=pk).update(used_total=Greatest(F('used_total') - count, 0))
+
+    def hand_over_assets(self, assets, receiver, chunk_size):
+        exchanges = [
+            Exchange(
+                asset_id=obj['pk'],
+                sender_id=obj['holder_id'],
+                receiver=receiver,
+                source_id=obj['location_id'],
+                reason=Exchange.REASON_RESIGNING,
+                kitting_required=obj['asset_type__kitting_required'],
+            ) for obj in assets
+        ]
+        Exchange.objects.bulk_create(exchanges, batch_size=chunk_size)
+        Notification.queue(
+            (receiver.pk, 'Reclaimed %s %s from deactivated user %s, accept or reject it in the exchanges' % (
+                Asset(pk=obj['pk']).get_code(), obj['name'], obj['holder__username']))
+            for obj in assets)
+        asset_ids = [obj['pk'] for obj in assets]
+        for i in range(0, len(asset_ids), chunk_size):
+            Asset.update_exchange_fields(asset_ids[i:i + chunk_size])
+
+    def handle(self, *args, **options):
+        receiver = None
+        if options['asset_receiver']:
+            receiver = User.objects.filter(username=options['asset_receiver'], is_active=True).first()
+            if not receiver:
+                raise CommandError('Active user %s does not exist' % options['asset_receiver'])
+
+        assignments = self.get_assignments()
+        assets = self.get_assets() if receiver else []
+        licenses = self.summarize(assignments, assets, **options)
+        if options['dry_run'] or not (assignments or assets):
+            return
+
+        with transaction.atomic():
+            self.archive_assignments(assignments, options['chunk_size'])
+            self.return_seats(licenses)
+            if receiver:
+                self.hand_over_assets(assets, receiver, options['chunk_size'])
+        self.rows_affected = len(assignments) + len(assets)
+        self.stdout.write(self.style.SUCCESS('Successfully reclaimed licenses of deactivated users'))
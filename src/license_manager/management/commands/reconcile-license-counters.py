@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from license_manager.models import License, LicenseAssignment
+
+
+class Command(BaseCommand):
+    help = '''Fix the used total of licenses which does not match the number of
+    license assignments, eg: after assignments were changed outside of the admin.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print the mismatched licenses without fixing them.')
+
+    def count_assignments(self, licenses=None):
+        qs = LicenseAssignment.objects.filter(license__isnull=False)
+        if licenses is not None:
+            qs = qs.filter(license__in=licenses)
+        return dict(qs.values('license_id').annotate(count=Count('pk')).order_by().values_list('license_id', 'count'))
+
+    def handle(self, *args, **options):
+        self.rows_affected = 0
+        counts = self.count_assignments()
+        mismatched = [
+            pk for pk, used_total in License.objects.values_list('pk', 'used_total')
+            if (used_total or 0) != counts.get(pk, 0)
+        ]
+        if mismatched and not options['dry_run']:
+            with transaction.atomic():
+                # count again with the licenses locked, assignments may have changed meanwhile
+                locked = list(License.objects.select_for_update().filter(pk__in=mismatched)
+                                     .values_list('pk', 'description', 'used_total'))
+                counts = self.count_assignments(mismatched)
+                for pk, description, used_total in locked:
+                    count = counts.get(pk, 0)
+                    if (used_total or 0) != count:
+                        License.objects.filter(pk=pk).update(used_total=count)
+                        self.rows_affected += 1
+                        self.stdout.write('%s: used total %s -> %d' % (description, used_total, count))
+        elif mismatched:
+            for pk, description, used_total in (License.objects.filter(pk__in=mismatched)
+                                                               .values_list('pk', 'description', 'used_total')):
+                self.stdout.write('%s: used total %s, %d assignments' % (description, used_total, counts.get(pk, 0)))
+        self.stdout.write('%d licenses with a mismatched used total' % len(mismatched))
@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from license_manager.models import LicenseUsage
+from license_manager.usage import record_daily_usage, rollup_usage, prune_usage
+
+
+class Command(BaseCommand):
+    help = '''Record the daily utilization of every license and software family,
+    refresh the weekly and monthly rollups of the day and delete the rows
+    older than the retention. Run it once a day.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-d', '--date', type=str,
+            help='Day to record (YYYY-MM-DD). Default: today')
+        parser.add_argument(
+            '--keep-days', type=int, default=180,
+            help='Number of days the daily rows are kept. Default: 180')
+        parser.add_argument(
+            '--keep-weeks', type=int, default=104,
+            help='Number of weeks the weekly rows are kept. Default: 104')
+        parser.add_argument(
+            '--keep-months', type=int, default=0,
+            help='Number of months the monthly rows are kept, 0 keeps them forever. Default: 0')
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        date = today
+        if options['date']:
+            try:
+                date = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date %s, expected YYYY-MM-DD' % options['date'])
+
+        recorded = record_daily_usage(date)
+        weekly = rollup_usage(date, LicenseUsage.PERIOD_WEEK)
+        monthly = rollup_usage(date, LicenseUsage.PERIOD_MONTH)
+        deleted = prune_usage(today, options['keep_days'], options['keep_weeks'], options['keep_months'] or None)
+        self.rows_affected = recorded + weekly + monthly + deleted
+        self.stdout.write('Recorded %d daily, %d weekly and %d monthly rows, deleted %d old rows' % (
+            recorded, weekly, monthly, deleted))
@@ -0,0 +1,76 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from license_manager.scheduler import get_jobs, get_owner, run_job
+
+
+class Command(BaseCommand):
+    help = '''Run the jobs of the SCHEDULED_JOBS setting on their schedules in one
+    long running process. Runs never overlap and are recorded as job runs.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-l', '--list', action='store_true',
+            help='List the jobs and exit')
+        parser.add_argument(
+            '-r', '--run', type=str, nargs='+', metavar='JOB',
+            help='Run these jobs now and exit')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run the jobs due this minute and exit')
+
+    def report(self, run):
+        message = '%s: %s' % (run.job, run.get_status_display())
+        if run.duration is not None:
+            message += ' in %.1fs' % run.duration
+        if run.rows is not None:
+            message += ', %d rows' % run.rows
+        self.stdout.write(message)
+        if run.error:
+            self.stderr.write(run.error)
+
+    def run_due_jobs(self, executor, jobs, now, owner):
+        due = [job for job in jobs if job.schedule.matches(now)]
+        for job in due:
+            future = executor.submit(run_job, job, owner)
+            future.add_done_callback(lambda future: self.report(future.result()))
+        return due
+
+    def handle(self, *args, **options):
+        try:
+            jobs = get_jobs()
+        except ValueError as e:
+            raise CommandError(e)
+        owner = get_owner()
+
+        if options['list']:
+            for job in jobs:
+                self.stdout.write('%s: %s %s (%s)' % (job.name, job.command, ' '.join(job.args), job.schedule))
+            return
+        if options['run']:
+            names = {job.name: job for job in jobs}
+            for name in options['run']:
+                if name not in names:
+                    raise CommandError('Unknown job %s' % name)
+            for name in options['run']:
+                self.report(run_job(names[name], owner))
+            return
+
+        with ThreadPoolExecutor(max_workers=getattr(settings, 'SCHEDULER_WORKERS', 4)) as executor:
+            if options['once']:
+                self.run_due_jobs(executor, jobs, timezone.localtime(), owner)
+                return
+            self.stdout.write('Scheduler %s started with %d jobs' % (owner, len(jobs)))
+            try:
+                while True:
+                    now = timezone.localtime()
+                    next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+                    time.sleep((next_minute - now).total_seconds())
+                    self.run_due_jobs(executor, jobs, next_minute, owner)
+            except KeyboardInterrupt:
+                self.stdout.write('Scheduler stopped, waiting for running jobs')
@@ -1,64 +1,167 @@
-from datetime import timedelta
-from django.db.models import F
-from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
+import json
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.utils import timezone
 from django.conf import settings
 from django.template.loader import get_template
-from license_manager.models import License, LicenseAssignment
+from license_manager.reports import (
+    build_license_report, filter_license_report, take_license_snapshot, get_last_license_snapshot,
+    save_license_snapshot, diff_license_snapshots)
+from asset_manager.warranty import WARNING_DAYS, get_expiring_warranties
+
+FILE_EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 
 
 class Command(BaseCommand):
     help = '''Send license reports to designated email addresses:
     - Licenses expiring soon
     - Licenses available to use
-    - Softwares using without licenses'''
-    today = timezone.now()
+    - Softwares using without licenses
+    - Asset warranties expiring soon, per location and supplier
+
+    With --config, the reports are computed once and every recipient gets
+    the part of them in their scope. The config file is a JSON object like:
+
+        {"recipients": [
+            {"to": ["it-hn@punch.vn"], "families": ["Adobe", "Autodesk"], "unlicensed": true},
+            {"to": ["it-manager@punch.vn"]}
+        ]}
+
+    Recipients without families get the full reports, add "warranties": false
+    to leave out the asset warranties.
+
+    With --changes, only what changed since the previous --changes run is
+    reported: licenses entering the warning window, running out of seats,
+    newly unlicensed usage, warranties entering the warning window...'''
 
     def add_arguments(self, parser):
-        default_subject = 'License Reports ' + self.today.strftime("%d %B, %Y %H:%M:%S")
         default_sender = 'lms@punch.local'
         parser.add_argument(
             '-s', '--subject', type=str,
-            default=default_subject,
-            help='Set subject of email')
+            help='Set subject of email. Default: License Reports and the current time')
         parser.add_argument(
-            '-t', '--to', type=str, nargs='+', required=True,
+            '-t', '--to', type=str, nargs='+',
             help='Email addresses to send the reports')
+        parser.add_argument(
+            '-c', '--config', type=str,
+            help='JSON file of recipients and their software families, replaces --to')
         parser.add_argument(
             '-f', '--from', type=str, default=default_sender,
             help='Email addresss of the sender. Default: %s' % default_sender)
         parser.add_argument(
             '-u', '--unlicensed', action='store_true', help='Include unlicensed softwares')
+        parser.add_argument(
+            '-w', '--warranty-days', type=int, default=WARNING_DAYS,
+            help='Report the asset warranties ending within this number of days, 0 to leave them out. '
+                 'Default: %d' % WARNING_DAYS)
+        parser.add_argument(
+            '--changes', action='store_true',
+            help='Only report the changes since the last report sent with --changes')
+        parser.add_argument(
+            '--keep-days', type=int, default=90,
+            help='Delete the snapshots of --changes older than this number of days. Default: 90')
+        parser.add_argument(
+            '--email-dir', type=str,
+            help='Write the emails as files into this directory instead of sending them')
+
+    def get_recipients(self, **options):
+        """Return a list of dicts with ``to``, ``families``, ``unlicensed`` and ``warranties``."""
+        if options['config']:
+            try:
+                with open(options['config']) as f:
+                    recipients = json.load(f)['recipients']
+            except (IOError, ValueError, KeyError) as e:
+                raise CommandError('Invalid config file %s: %s' % (options['config'], e))
+            for recipient in recipients:
+                if not recipient.get('to'):
+                    raise CommandError('Every recipient of %s requires "to" addresses' % options['config'])
+                recipient.setdefault('families', None)
+                recipient.setdefault('unlicensed', options['unlicensed'])
+                recipient.setdefault('warranties', True)
+            return recipients
+        if not options['to']:
+            raise CommandError('Either --to or --config is required')
+        return [{'to': options['to'], 'families': None, 'unlicensed': options['unlicensed'], 'warranties': True}]
+
+    def get_connection(self, **options):
+        if options['email_dir']:
+            return get_connection(FILE_EMAIL_BACKEND, file_path=options['email_dir'])
+        return get_connection()
+
+    def get_warranty_since(self, previous, today, **options):
+        """Return the first warranty end date to report: the end of the warning
+        window of the previous --changes run, so only the warranties entering
+        the window since then are reported.
+        """
+        if not previous or 'date' not in previous:
+            return None
+        previous_date = datetime.strptime(previous['date'], '%Y-%m-%d').date()
+        return max(previous_date + timedelta(options['warranty_days']), today)
 
     def handle(self, *args, **options):
-        WARNING_DAYS = 30
-        warning_date = timezone.now().date() + timedelta(WARNING_DAYS)
-        expiring_licenses = License.objects.filter(
-            license_type=License.LICENSE_SUBSCRIPTION,
-            ended_date__lt=warning_date)
-        available_licenses = (License.objects.annotate(remaining=F('total') - F('used_total'))
-                                             .filter(total__gt=F('used_total'))
-                                             .exclude(
-                                                license_type=License.LICENSE_SUBSCRIPTION,
-                                                ended_date__lt=timezone.now().date())
-                                             .order_by('description'))
-        if options['unlicensed']:
-            unlicensed_softwares = LicenseAssignment.get_unlicensed_softwares()
+        recipients = self.get_recipients(**options)
+        # the scheduler runs the command many times in one process, the time is the one of this run
+        now = timezone.now()
+        today = now.date()
+        subject = options['subject'] or 'License Reports ' + now.strftime("%d %B, %Y %H:%M:%S")
+        timings = []
+
+        started = time.time()
+        unlicensed = any(recipient['unlicensed'] for recipient in recipients)
+        snapshot = previous = None
+        if options['changes']:
+            snapshot = take_license_snapshot()
+            previous = get_last_license_snapshot()
+            if not previous:
+                self.stdout.write('No previous snapshot, sending the full reports')
+        if previous:
+            report = diff_license_snapshots(previous, snapshot, today=today)
+            report['changes'] = True
         else:
-            unlicensed_softwares = None
+            report = build_license_report(today=today, unlicensed=unlicensed)
+        warranties = None
+        if options['warranty_days'] > 0 and any(recipient['warranties'] for recipient in recipients):
+            warranties = get_expiring_warranties(
+                today, options['warranty_days'], since=self.get_warranty_since(previous, today, **options))
+        if snapshot:
+            snapshot['date'] = today.isoformat()
+        timings.append(('build', time.time() - started))
+
+        started = time.time()
         t = get_template('email/license_reports.html')
-        summary_html = t.render({
-            'today': self.today.strftime("%d %B, %Y"),
-            'expiring_licenses': expiring_licenses,
-            'available_licenses': available_licenses,
-            'unlicensed_softwares': unlicensed_softwares
-        })
-        send_mail(
-            options['subject'],
-            'Not support plain text reports',
-            options['from'],
-            options['to'],
-            html_message=summary_html,
-            fail_silently=False)
-        self.stdout.write(self.style.SUCCESS('Successfully sent email reports'))
+        connection = self.get_connection(**options)
+        messages = []
+        for recipient in recipients:
+            context = filter_license_report(report, recipient['families'])
+            if not recipient['unlicensed']:
+                context['unlicensed_softwares'] = None
+                context['resolved_softwares'] = None
+            context['expiring_warranties'] = warranties if recipient['warranties'] else None
+            context['warranty_days'] = options['warranty_days']
+            context['today'] = now.strftime("%d %B, %Y")
+            message = EmailMultiAlternatives(
+                subject,
+                'Not support plain text reports',
+                options['from'],
+                recipient['to'],
+                connection=connection)
+            message.attach_alternative(t.render(context), 'text/html')
+            messages.append(message)
+        timings.append(('render', time.time() - started))
+
+        started = time.time()
+        # one session for all the messages
+        sent = connection.send_messages(messages)
+        self.rows_affected = sent or 0
+        timings.append(('send', time.time() - started))
+
+        if snapshot:
+            save_license_snapshot(snapshot, keep_days=options['keep_days'])
+
+        if options['verbosity'] > 1:
+            for stage, seconds in timings:
+                self.stdout.write('%s: %.3fs' % (stage, seconds))
+        self.stdout.write(self.style.SUCCESS('Successfully sent %d email reports' % (sent or 0)))
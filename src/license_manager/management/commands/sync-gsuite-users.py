@@ -1,17 +1,44 @@
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, CharField, When, Value
+from django.db.models.functions import Lower
+from django.utils import timezone
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 
+from asset_manager.models import DirectoryMapping, Profile
+from license_manager.directory import FakeDirectoryService
+from license_manager.models import DirectorySyncState
+
 SERVICE_ACCOUNT_FILE = 'service-account-key.json'
 OAUTH_SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.readonly']
+REPORTS_SCOPE = 'https://www.googleapis.com/auth/admin.reports.audit.readonly'
 DELEGATED_SUBJECT = 'tung.vu@punch.vn'
 DOMAIN = 'punch.vn'
 ORGANIZATION_UNIT = 'punch-staff'
+# admin activities are kept this long by the Reports API
+ACTIVITY_RETENTION_DAYS = 180
+
+
+def in_org_unit(path, org_unit):
+    """Return True if the organization unit path is the given unit or one of its sub units."""
+    org_unit = org_unit.rstrip('/')
+    return path == org_unit or path.startswith(org_unit + '/')
 
 
 class Command(BaseCommand):
-    help = '''Sync users from GSuite domain'''
+    help = '''Sync users from GSuite domain.
+    Every page of users is saved while the next one is being fetched.
+    With --incremental only the users changed since the last sync are fetched,
+    using the admin activities of the Reports API (requires the %s scope).''' % REPORTS_SCOPE
+    first_name_length = User._meta.get_field('first_name').max_length
+    last_name_length = User._meta.get_field('last_name').max_length
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -28,12 +55,46 @@ class Command(BaseCommand):
             default=OAUTH_SCOPES,
             help='Scopes of oauth request.')
         parser.add_argument(
-            '-u', '--subject', type=str, required=True,
+            '-u', '--subject', type=str,
             help='The email address of the user to for which to request delegated access.')
         parser.add_argument(
             '-o', '--ou', type=str,
             default=ORGANIZATION_UNIT,
             help='Organization unit path of the users.')
+        parser.add_argument(
+            '-F', '--fake-directory', type=str,
+            help='Read directory users from a JSON file instead of GSuite (for testing).')
+        parser.add_argument(
+            '-c', '--chunk-size', type=int, default=500,
+            help='Number of users created or updated per query. Default: 500')
+        parser.add_argument(
+            '-p', '--page-size', type=int, default=500,
+            help='Number of users fetched per request. Default: 500')
+        parser.add_argument(
+            '-i', '--incremental', action='store_true',
+            help='Only sync users changed since the last sync. Falls back to a full sync on the first run '
+                 'and when the last sync is older than the admin activities (%d days).' % ACTIVITY_RETENTION_DAYS)
+        parser.add_argument(
+            '--overlap', type=int, default=60,
+            help='Minutes subtracted from the last sync time in incremental mode, '
+                 'activities may be reported late. Default: 60')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Print the changes without saving them.')
+        parser.add_argument(
+            '--reclaim', action='store_true',
+            help='Reclaim licenses of deactivated users after syncing (see reclaim-inactive).')
+
+    def get_credentials(self, **options):
+        if not options['subject']:
+            raise CommandError('--subject is required to access the GSuite directory')
+        scopes = list(options['scopes'])
+        if options['incremental'] and REPORTS_SCOPE not in scopes:
+            scopes.append(REPORTS_SCOPE)
+        return service_account.Credentials.from_service_account_file(
+            options['key'],
+            scopes=scopes,
+            subject=options['subject'])
 
     def create_directory_service(self, **options):
         """Build and returns an Admin SDK Directory service object authorized with the service accounts
@@ -42,61 +103,294 @@ class Command(BaseCommand):
         Returns:
           Admin SDK directory service object.
         """
-        credentials = service_account.Credentials.from_service_account_file(
-            options['key'],
-            scopes=options['scopes'],
-            subject=options['subject'])
+        if options['fake_directory']:
+            return FakeDirectoryService(options['fake_directory'])
+        return build('admin', 'directory_v1', credentials=self.get_credentials(**options))
 
-        return build('admin', 'directory_v1', credentials=credentials)
+    def create_reports_service(self, **options):
+        """Build and returns an Admin SDK Reports service object, used to find changed users."""
+        if options['fake_directory']:
+            return FakeDirectoryService(options['fake_directory'])
+        return build('admin', 'reports_v1', credentials=self.get_credentials(**options))
 
-    def get_gsuit_users(self, **options):
+    def iter_pages(self, fetch_page):
+        """Yield pages of users, the next page is fetched in background while
+        the current one is being saved.
+
+        fetch_page(page_token) returns a list of users and the next page token.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch_page, None)
+            while future:
+                users, next_page = future.result()
+                future = executor.submit(fetch_page, next_page) if next_page else None
+                yield users
+
+    def iter_gsuite_users(self, **options):
         service = self.create_directory_service(**options)
-        next_page = None
-        users = []
-        while True:
+
+        def fetch_page(page_token):
             request = service.users().list(
                 domain=options['domain'],
                 query="orgUnitPath=/%s" % options['ou'],
                 # showDeleted=True,
+                pageToken=page_token,
+                maxResults=options['page_size'],
+            )
+            response = request.execute()
+            return response.get('users', []), response.get('nextPageToken', None)
+
+        return self.iter_pages(fetch_page)
+
+    def get_changed_emails(self, since, **options):
+        """Return emails of the users having admin activities since the given time."""
+        service = self.create_reports_service(**options)
+        emails = set()
+        next_page = None
+        while True:
+            request = service.activities().list(
+                userKey='all',
+                applicationName='admin',
+                startTime=since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
                 pageToken=next_page,
             )
             response = request.execute()
+            for activity in response.get('items', []):
+                for event in activity.get('events', []):
+                    for param in event.get('parameters', []):
+                        if param.get('name') == 'USER_EMAIL':
+                            emails.add(param['value'])
             next_page = response.get('nextPageToken', None)
-            users += response.get('users', [])
             if not next_page:
                 break
-        return users
+        return sorted(emails)
 
-    def create_django_users(self, gsuite_users, **options):
+    def iter_changed_users(self, since, **options):
+        emails = self.get_changed_emails(since, **options)
+        service = self.create_directory_service(**options)
+        org_unit = '/%s' % options['ou']
+        if options['verbosity'] > 1:
+            self.stdout.write('%d users changed since %s' % (len(emails), since))
+
+        def fetch_page(page_token):
+            start = int(page_token or 0)
+            end = start + options['page_size']
+            users = []
+            for email in emails[start:end]:
+                try:
+                    user = service.users().get(userKey=email).execute()
+                except HttpError as e:
+                    # deleted users are not synced
+                    if e.resp.status == 404:
+                        continue
+                    raise
+                if in_org_unit(user.get('orgUnitPath', ''), org_unit):
+                    users.append(user)
+            return users, str(end) if end < len(emails) else None
+
+        return self.iter_pages(fetch_page)
+
+    def get_diff(self, gsuite_users, **options):
+        """Compare a page of directory users with the existing users,
+        loaded with one query by email.
+
+        Returns a dict of users to create, reactivate, deactivate and rename.
+        """
+        emails = [user['primaryEmail'].lower() for user in gsuite_users]
+        existing = {}
+        for user in (User.objects
+                         .annotate(email_lower=Lower('email'))
+                         .filter(email_lower__in=emails)
+                         .only('email', 'username', 'first_name', 'last_name', 'is_active')):
+            existing[user.email_lower] = user
+        usernames = set(
+            User.objects
+                .filter(username__in=[email[:email.index('@')] for email in emails])
+                .values_list('username', flat=True))
+
+        diff = {'create': [], 'reactivate': [], 'deactivate': [], 'rename': []}
         for user in gsuite_users:
             email = user['primaryEmail']
-            dj_user = User.objects.filter(email=email).first()
+            name = user['name']
+            first_name = name['givenName'][:self.first_name_length]
+            last_name = name['familyName'][:self.last_name_length]
+            dj_user = existing.get(email.lower())
 
             if dj_user:
-                if options['verbosity'] > 1:
-                    self.stdout.write(self.style.NOTICE('User with email %s already exists' % email))
-                if user['suspended'] and dj_user.is_active:
-                    dj_user.is_active = False
-                    dj_user.save()
-                    self.stdout.write(self.style.WARNING('User %s was deactivated' % email))
+                if user['suspended']:
+                    if dj_user.is_active:
+                        diff['deactivate'].append(dj_user)
+                    continue
+                if not dj_user.is_active:
+                    diff['reactivate'].append(dj_user)
+                if (dj_user.first_name, dj_user.last_name) != (first_name, last_name):
+                    dj_user.first_name = first_name
+                    dj_user.last_name = last_name
+                    diff['rename'].append(dj_user)
                 continue
 
             if user['suspended']:
                 continue
 
-            name = user['name']
-            first_name = name['givenName']
-            last_name = name['familyName']
-            creation_time = user['creationTime']
             username = email[:email.index('@')]
-            User.objects.create(
+            if username in usernames:
+                self.stdout.write(self.style.WARNING(
+                    'Skipped %s: username %s is used by another email' % (email, username)))
+                continue
+            usernames.add(username)
+            diff['create'].append(User(
                 first_name=first_name,
                 last_name=last_name,
                 username=username,
                 email=email,
-                date_joined=creation_time,
+                date_joined=user['creationTime'],
+            ))
+        return diff
+
+    def print_diff(self, diff, **options):
+        if options['verbosity'] > 1:
+            for user in diff['create']:
+                self.stdout.write(self.style.SUCCESS('Create user: %s' % user.email))
+            for user in diff['reactivate']:
+                self.stdout.write(self.style.SUCCESS('Reactivate user: %s' % user.email))
+            for user in diff['deactivate']:
+                self.stdout.write(self.style.WARNING('Deactivate user: %s' % user.email))
+            for user in diff['rename']:
+                self.stdout.write(self.style.NOTICE('Rename user: %s to %s' % (user.email, user.get_full_name())))
+
+    @transaction.atomic
+    def apply_diff(self, diff, chunk_size):
+        User.objects.bulk_create(diff['create'], batch_size=chunk_size)
+        for key, is_active in (('reactivate', True), ('deactivate', False)):
+            users = diff[key]
+            for i in range(0, len(users), chunk_size):
+                ids = [user.pk for user in users[i:i + chunk_size]]
+                User.objects.filter(pk__in=ids).update(is_active=is_active)
+        users = diff['rename']
+        for i in range(0, len(users), chunk_size):
+            chunk = users[i:i + chunk_size]
+            User.objects.filter(pk__in=[user.pk for user in chunk]).update(
+                first_name=Case(*[When(pk=user.pk, then=Value(user.first_name)) for user in chunk],
+                                output_field=CharField()),
+                last_name=Case(*[When(pk=user.pk, then=Value(user.last_name)) for user in chunk],
+                               output_field=CharField()),
             )
-            self.stdout.write(self.style.SUCCESS('Created user: %s' % name['fullName']))
+
+    def load_directory_mappings(self):
+        """Load the organization unit and building mappings with one query."""
+        self.building_mappings = {}
+        self.org_unit_mappings = []
+        for mapping in DirectoryMapping.objects.all():
+            if mapping.building_id:
+                self.building_mappings.setdefault(mapping.building_id, []).append(mapping)
+            else:
+                self.org_unit_mappings.append(mapping)
+        # the deepest organization unit wins
+        self.org_unit_mappings.sort(key=lambda mapping: len(mapping.org_unit_path), reverse=True)
+
+    def resolve_mapping(self, gsuite_user):
+        path = gsuite_user.get('orgUnitPath', '')
+        for location in gsuite_user.get('locations', []):
+            for mapping in self.building_mappings.get(location.get('buildingId'), []):
+                if not mapping.org_unit_path or in_org_unit(path, mapping.org_unit_path):
+                    return mapping
+        for mapping in self.org_unit_mappings:
+            if in_org_unit(path, mapping.org_unit_path):
+                return mapping
+        return None
+
+    def sync_profiles(self, gsuite_users, **options):
+        """Create or update the profiles of a page of users from the directory mappings.
+
+        Returns the numbers of created and updated profiles.
+        """
+        if not (self.building_mappings or self.org_unit_mappings):
+            return 0, 0
+        mappings = {}
+        for user in gsuite_users:
+            mapping = self.resolve_mapping(user)
+            if mapping:
+                mappings[user['primaryEmail'].lower()] = mapping
+        if not mappings:
+            return 0, 0
+
+        user_ids = dict(
+            User.objects
+                .annotate(email_lower=Lower('email'))
+                .filter(email_lower__in=mappings.keys())
+                .values_list('email_lower', 'pk'))
+        profiles = {
+            user_id: (pk, office_id, location_id)
+            for pk, user_id, office_id, location_id in (
+                Profile.objects
+                       .filter(user_id__in=user_ids.values())
+                       .values_list('pk', 'user_id', 'location_id', 'default_location_id'))
+        }
+        creates = []
+        updates = {}
+        for email, mapping in mappings.items():
+            user_id = user_ids.get(email)
+            if not user_id:
+                continue
+            if user_id not in profiles:
+                creates.append(Profile(
+                    user_id=user_id, location_id=mapping.office_id, default_location_id=mapping.location_id))
+                continue
+            pk, office_id, location_id = profiles[user_id]
+            # keep a location picked by hand unless the office changes
+            new_location_id = mapping.location_id
+            if not new_location_id and office_id == mapping.office_id:
+                new_location_id = location_id
+            if (office_id, location_id) != (mapping.office_id, new_location_id):
+                updates.setdefault((mapping.office_id, new_location_id), []).append(pk)
+
+        if not options['dry_run']:
+            with transaction.atomic():
+                Profile.objects.bulk_create(creates, batch_size=options['chunk_size'])
+                for (office_id, location_id), ids in updates.items():
+                    Profile.objects.filter(pk__in=ids).update(location_id=office_id, default_location_id=location_id)
+        return len(creates), sum(len(ids) for ids in updates.values())
+
+    def create_django_users(self, gsuite_users, **options):
+        diff = self.get_diff(gsuite_users, **options)
+        self.print_diff(diff, **options)
+        if not options['dry_run']:
+            self.apply_diff(diff, options['chunk_size'])
+        return diff
 
     def handle(self, *args, **options):
-        self.create_django_users(self.get_gsuit_users(**options), **options)
+        started_at = timezone.now()
+        state = DirectorySyncState.objects.filter(domain=options['domain'], org_unit=options['ou']).first()
+        since = None
+        if options['incremental'] and state:
+            since = state.synced_at - timedelta(minutes=options['overlap'])
+            if since < started_at - timedelta(ACTIVITY_RETENTION_DAYS):
+                self.stdout.write(self.style.WARNING(
+                    'Last sync at %s is older than the admin activities, running a full sync' % state.synced_at))
+                since = None
+        if since:
+            pages = self.iter_changed_users(since, **options)
+        else:
+            pages = self.iter_gsuite_users(**options)
+
+        self.load_directory_mappings()
+        totals = {'create': 0, 'reactivate': 0, 'deactivate': 0, 'rename': 0}
+        profiles_created = profiles_updated = 0
+        for gsuite_users in pages:
+            diff = self.create_django_users(gsuite_users, **options)
+            for key in totals:
+                totals[key] += len(diff[key])
+            created, updated = self.sync_profiles(gsuite_users, **options)
+            profiles_created += created
+            profiles_updated += updated
+        self.stdout.write('Created: %(create)d, reactivated: %(reactivate)d, '
+                          'deactivated: %(deactivate)d, renamed: %(rename)d' % totals)
+        self.stdout.write('Profiles created: %d, updated: %d' % (profiles_created, profiles_updated))
+        self.rows_affected = sum(totals.values()) + profiles_created + profiles_updated
+
+        if not options['dry_run']:
+            DirectorySyncState.objects.update_or_create(
+                domain=options['domain'], org_unit=options['ou'],
+                defaults={'synced_at': started_at})
+        if options['reclaim']:
+            call_command('reclaim-inactive', verbosity=options['verbosity'], stdout=self.stdout)
@@ -1,13 +1,17 @@
+import datetime
+
 from django.db import models
 from django.db import transaction
 from django.db import IntegrityError
-from django.db.models import F
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 
 from filer.fields.image import FilerImageField
 from filer.models.imagemodels import Image
 
+from asset_manager.models import Notification
+
 
 class Supplier(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -175,6 +179,12 @@ class License(models.Model):
     def __str__(self):
         return self.description
 
+    class Meta:
+        indexes = [
+            # expiring subscriptions, see license_manager.reports
+            models.Index(fields=['license_type', 'ended_date']),
+        ]
+
 
 class LicenseImage(models.Model):
     image = FilerImageField(on_delete=models.CASCADE)
@@ -259,9 +269,16 @@ class LicenseAssignment(models.Model):
         'LicenseKey', blank=True, null=True, on_delete=models.PROTECT)
     note = models.TextField(blank=True)
 
+    HISTORY_FIELDS = ('user_id', 'software_id', 'platform_id', 'license_id', 'license_key_id')
+    NOTIFICATION = 'You were assigned a %s license'
+
     def __init__(self, *args, **kwargs):
         super(LicenseAssignment, self).__init__(*args, **kwargs)
         self.original_license_id = self.license_id
+        self.original_history_state = self.get_history_state()
+
+    def get_history_state(self):
+        return tuple(getattr(self, field) for field in self.HISTORY_FIELDS)
 
     def get_unlicensed_softwares():
         summary = {}
@@ -278,7 +295,11 @@ class LicenseAssignment(models.Model):
                 summary[la.software_id]['count'] += 1
         return sorted(summary.items())
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, record_history=True, notify=True, **kwargs):
+        """Save and count the license seat. Callers saving many assignments can
+        pass ``record_history=False`` and ``notify=False`` and record them with
+        one ``LicenseAssignmentHistory.record()`` and ``Notification.queue()`` call.
+        """
         with transaction.atomic():
             is_new = True if not self.pk else False
             super(LicenseAssignment, self).save(*args, **kwargs)
@@ -291,9 +312,16 @@ class LicenseAssignment(models.Model):
                         License.objects.get(pk=self.original_license_id).unassign()
                     if self.license_id:
                         self.license.assign()
+            if record_history and (is_new or self.get_history_state() != self.original_history_state):
+                LicenseAssignmentHistory.record([self])
+            if notify and is_new:
+                Notification.queue([(self.user_id, self.NOTIFICATION % self.software.get_full_name())])
+            self.original_license_id = self.license_id
+            self.original_history_state = self.get_history_state()
 
     def delete(self):
         with transaction.atomic():
+            LicenseAssignmentHistory.close([self.pk])
             super(LicenseAssignment, self).delete()
             if self.license_id:
                 self.license.unassign()
@@ -302,6 +330,187 @@ class LicenseAssignment(models.Model):
         return "{} for {}".format(self.software.get_full_name(), self.user.get_username())
 
 
+class LicenseAssignmentHistoryQuerySet(models.QuerySet):
+    def as_of(self, when):
+        """Intervals valid at ``when``, a datetime or a date meaning the end of that day."""
+        if not isinstance(when, datetime.datetime):
+            when = timezone.make_aware(datetime.datetime.combine(when + datetime.timedelta(1), datetime.time.min))
+            return self.filter(Q(valid_to__isnull=True) | Q(valid_to__gte=when), valid_from__lt=when)
+        return self.filter(Q(valid_to__isnull=True) | Q(valid_to__gt=when), valid_from__lte=when)
+
+    def current(self):
+        return self.filter(valid_to__isnull=True)
+
+
+class LicenseAssignmentHistory(models.Model):
+    """Append-only intervals during which license assignments existed
+    unchanged. A change of an assignment closes its open interval and
+    opens a new one, a deletion only closes it.
+    """
+    assignment_id = models.PositiveIntegerField(db_index=True)
+    user = models.ForeignKey('auth.User', on_delete=models.PROTECT)
+    software = models.ForeignKey('Software', on_delete=models.PROTECT)
+    platform = models.ForeignKey('Platform', on_delete=models.PROTECT)
+    license = models.ForeignKey(
+        'License', blank=True, null=True, on_delete=models.SET_NULL)
+    license_key = models.ForeignKey(
+        'LicenseKey', blank=True, null=True, on_delete=models.SET_NULL)
+    valid_from = models.DateTimeField()
+    valid_to = models.DateTimeField(blank=True, null=True)
+
+    objects = LicenseAssignmentHistoryQuerySet.as_manager()
+
+    @classmethod
+    def close(cls, assignment_ids, at=None):
+        """Close the open intervals of the given assignments with one query."""
+        return (cls.objects
+                   .filter(assignment_id__in=list(assignment_ids), valid_to__isnull=True)
+                   .update(valid_to=at or timezone.now()))
+
+    @classmethod
+    def record(cls, assignments, at=None):
+        """Close the open intervals of the given saved assignments and open
+        new ones from their current state, with two queries.
+        """
+        at = at or timezone.now()
+        assignments = list(assignments)
+        cls.close([obj.pk for obj in assignments], at)
+        cls.objects.bulk_create([
+            cls(assignment_id=obj.pk, user_id=obj.user_id, software_id=obj.software_id,
+                platform_id=obj.platform_id, license_id=obj.license_id, license_key_id=obj.license_key_id,
+                valid_from=at)
+            for obj in assignments
+        ], batch_size=500)
+
+    def __str__(self):
+        return "{} for {} from {}".format(self.software, self.user, self.valid_from)
+
+    class Meta:
+        verbose_name_plural = 'License assignment history'
+        indexes = [
+            models.Index(fields=['software', 'valid_from']),
+            models.Index(fields=['user', 'valid_from']),
+            models.Index(fields=['license', 'valid_from']),
+        ]
+
+
+class ArchivedLicenseAssignment(models.Model):
+    """Copy of a license assignment removed by a maintenance command."""
+    user = models.ForeignKey('auth.User', on_delete=models.PROTECT)
+    software = models.ForeignKey('Software', on_delete=models.PROTECT)
+    platform = models.ForeignKey('Platform', on_delete=models.PROTECT)
+    license = models.ForeignKey(
+        'License', blank=True, null=True, on_delete=models.SET_NULL)
+    license_key = models.ForeignKey(
+        'LicenseKey', blank=True, null=True, on_delete=models.SET_NULL)
+    serial_key = models.CharField(max_length=200, blank=True)
+    note = models.TextField(blank=True)
+    reason = models.CharField(max_length=100, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} for {}".format(self.software.get_full_name(), self.user.get_username())
+
+
+class DirectorySyncState(models.Model):
+    """Watermark of the last successful GSuite users sync of an organization unit."""
+    domain = models.CharField(max_length=100)
+    org_unit = models.CharField(max_length=100)
+    synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return "{}/{}".format(self.domain, self.org_unit)
+
+    class Meta:
+        unique_together = ('domain', 'org_unit')
+
+
+class LicenseReportSnapshot(models.Model):
+    """State of the licenses when a report was sent, see ``license_manager.reports.take_license_snapshot``."""
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    data = models.TextField()
+
+    def __str__(self):
+        return "Snapshot {}".format(self.created_at)
+
+
+class LicenseUsage(models.Model):
+    """Utilization of a license, or of a whole software family when license
+    is empty, over a period. Recorded by record-license-usage, see
+    ``license_manager.usage``.
+    """
+    PERIOD_DAY = 1
+    PERIOD_WEEK = 2
+    PERIOD_MONTH = 3
+
+    PERIODS = (
+        (PERIOD_DAY, 'Day'),
+        (PERIOD_WEEK, 'Week'),
+        (PERIOD_MONTH, 'Month'),
+    )
+
+    period = models.PositiveSmallIntegerField(choices=PERIODS)
+    date = models.DateField(help_text='First day of the period.')
+    software_family = models.ForeignKey('SoftwareFamily', on_delete=models.CASCADE)
+    license = models.ForeignKey('License', blank=True, null=True, on_delete=models.CASCADE)
+    total = models.PositiveIntegerField()
+    used_total = models.PositiveIntegerField(help_text='Average over the period.')
+    peak_used = models.PositiveIntegerField()
+
+    def __str__(self):
+        return "{} {} {}".format(self.license or self.software_family, self.get_period_display(), self.date)
+
+    class Meta:
+        unique_together = ('period', 'date', 'software_family', 'license')
+        indexes = [
+            models.Index(fields=['period', 'software_family', 'date']),
+            models.Index(fields=['license', 'period', 'date']),
+        ]
+
+
+class JobRun(models.Model):
+    """A run of a job of the run-scheduler command."""
+    STATUS_RUNNING = 1
+    STATUS_SUCCESS = 2
+    STATUS_FAILED = 3
+    STATUS_SKIPPED = 4
+
+    STATUSES = (
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCESS, 'Success'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_SKIPPED, 'Skipped'),
+    )
+
+    job = models.CharField(max_length=100)
+    status = models.PositiveSmallIntegerField(choices=STATUSES, default=STATUS_RUNNING)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True, help_text='Seconds')
+    rows = models.PositiveIntegerField(blank=True, null=True, help_text='Rows changed, as reported by the command.')
+    output = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return "{} {}".format(self.job, self.started_at)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['job', 'started_at']),
+        ]
+
+
+class JobLock(models.Model):
+    """Lock preventing overlapping runs of a job, held by ``owner`` until ``locked_until``."""
+    job = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    locked_until = models.DateTimeField()
+
+    def __str__(self):
+        return self.job
+
+
 class LicenseSummary(License):
     class Meta:
         proxy = True
@@ -0,0 +1,222 @@
+"""Data stage of the license reports.
+
+``build_license_report`` collects everything the reports show into plain
+dicts with a fixed number of queries, so the same dataset can be rendered
+to an email, exported or compared without touching the database again.
+"""
+import json
+from datetime import datetime, timedelta
+
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import License, LicensedSoftware, LicenseAssignment, LicenseReportSnapshot
+
+WARNING_DAYS = 30
+
+
+def get_expiring_licenses(today, warning_days=WARNING_DAYS):
+    warning_date = today + timedelta(warning_days)
+    licenses = list(
+        License.objects
+               .filter(license_type=License.LICENSE_SUBSCRIPTION, ended_date__lt=warning_date)
+               .values('pk', 'description', 'total', 'used_total', 'ended_date', 'software_family__name')
+               .order_by('ended_date', 'description'))
+    users = {}
+    rows = (LicenseAssignment.objects
+                             .filter(license__in=[lic['pk'] for lic in licenses])
+                             .values_list('license_id', 'user__username')
+                             .order_by('user__username')
+                             .distinct())
+    for license_id, username in rows:
+        users.setdefault(license_id, []).append(username)
+    for lic in licenses:
+        lic['users'] = users.get(lic['pk'], [])
+        lic['remaining_days'] = max((lic['ended_date'] - today).days, 0)
+    return licenses
+
+
+def get_available_licenses(today):
+    licenses = list(
+        License.objects
+               .filter(total__gt=F('used_total'))
+               .exclude(license_type=License.LICENSE_SUBSCRIPTION, ended_date__lt=today)
+               .values('pk', 'description', 'total', 'used_total', 'remaining', 'software_family__name')
+               .order_by('description'))
+    softwares = {}
+    rows = (LicensedSoftware.objects
+                            .filter(license__in=[lic['pk'] for lic in licenses])
+                            .values_list('license_id', 'software__software_family__name', 'software__name')
+                            .order_by('software__software_family__name', 'software__name'))
+    for license_id, family_name, name in rows:
+        softwares.setdefault(license_id, []).append("{} {}".format(family_name, name))
+    for lic in licenses:
+        lic['softwares'] = softwares.get(lic['pk'], [])
+    return licenses
+
+
+def get_unlicensed_softwares():
+    """Same summary as ``LicenseAssignment.get_unlicensed_softwares`` in one query."""
+    summary = {}
+    rows = (LicenseAssignment.objects
+                             .filter(license__isnull=True)
+                             .values_list('software_id', 'software__software_family__name', 'software__name',
+                                          'user__username')
+                             .order_by('software_id', 'pk'))
+    for software_id, family_name, name, username in rows:
+        if software_id not in summary:
+            summary[software_id] = {
+                'software': "{} {}".format(family_name, name),
+                'software_family__name': family_name,
+                'users': [],
+                'count': 0,
+            }
+        summary[software_id]['users'].append(username)
+        summary[software_id]['count'] += 1
+    return [summary[pk] for pk in sorted(summary)]
+
+
+def build_license_report(today=None, unlicensed=False, warning_days=WARNING_DAYS):
+    """Return the license report dataset as plain dicts and lists:
+
+    - expiring_licenses: subscriptions ending within ``warning_days``, with users
+    - available_licenses: licenses having free seats, with licensed softwares
+    - unlicensed_softwares: softwares used without license (None unless requested)
+    """
+    today = today or timezone.now().date()
+    return {
+        'today': today,
+        'expiring_licenses': get_expiring_licenses(today, warning_days),
+        'available_licenses': get_available_licenses(today),
+        'unlicensed_softwares': get_unlicensed_softwares() if unlicensed else None,
+    }
+
+
+def filter_license_report(report, families=None):
+    """Return a copy of ``report`` limited to the given software family names.
+    Every list of rows is filtered, rows are shared with the original
+    report and nothing is queried.
+    """
+    if not families:
+        return dict(report)
+    families = set(families)
+    return {
+        key: [row for row in rows if row['software_family__name'] in families] if isinstance(rows, list) else rows
+        for key, rows in report.items()
+    }
+
+
+def take_license_snapshot():
+    """Return the compact state compared by ``diff_license_snapshots``, read with two queries:
+
+    - licenses: license id -> [description, family, total, used_total, ended_date],
+      ended_date is only kept for subscriptions
+    - unlicensed: software id -> [full name, family, unlicensed assignments]
+
+    Ids are strings and dates ISO formatted so the snapshot survives a JSON round trip.
+    """
+    licenses = {}
+    rows = License.objects.values_list('pk', 'description', 'software_family__name', 'total', 'used_total',
+                                       'license_type', 'ended_date')
+    for pk, description, family, total, used_total, license_type, ended_date in rows:
+        if license_type != License.LICENSE_SUBSCRIPTION or not ended_date:
+            ended_date = None
+        licenses[str(pk)] = [description, family, total, used_total or 0, ended_date and ended_date.isoformat()]
+    unlicensed = {
+        str(row['software_id']): [
+            "{} {}".format(row['software__software_family__name'], row['software__name']),
+            row['software__software_family__name'],
+            row['count'],
+        ]
+        for row in (LicenseAssignment.objects
+                                     .filter(license__isnull=True)
+                                     .values('software_id', 'software__software_family__name', 'software__name')
+                                     .annotate(count=Count('pk'))
+                                     .order_by())
+    }
+    return {'licenses': licenses, 'unlicensed': unlicensed}
+
+
+def get_last_license_snapshot():
+    snapshot = LicenseReportSnapshot.objects.order_by('-created_at').first()
+    return json.loads(snapshot.data) if snapshot else None
+
+
+def save_license_snapshot(snapshot, keep_days=None):
+    """Store the snapshot and delete the ones older than ``keep_days``."""
+    LicenseReportSnapshot.objects.create(data=json.dumps(snapshot, separators=(',', ':')))
+    if keep_days is not None:
+        LicenseReportSnapshot.objects.filter(created_at__lt=timezone.now() - timedelta(keep_days)).delete()
+
+
+def diff_license_snapshots(old, new, today=None, warning_days=WARNING_DAYS):
+    """Return the changes between two snapshots as lists of rows:
+
+    - new_licenses, removed_licenses
+    - expiring_licenses: subscriptions entering the warning window (or expiring)
+    - renewed_licenses: licenses leaving the warning window
+    - depleted_licenses: licenses having no free seats anymore
+    - replenished_licenses: licenses having free seats again
+    - unlicensed_softwares: softwares used without license for the first time or more than before
+    - resolved_softwares: softwares not used without license anymore
+    """
+    today = today or timezone.now().date()
+    warning_date = (today + timedelta(warning_days)).isoformat()
+    old_licenses, new_licenses = old['licenses'], new['licenses']
+
+    def license_row(state):
+        description, family, total, used_total, ended_date = state
+        row = {
+            'description': description,
+            'software_family__name': family,
+            'total': total,
+            'used_total': used_total,
+            'ended_date': None,
+            'remaining_days': None,
+        }
+        if ended_date:
+            row['ended_date'] = datetime.strptime(ended_date, '%Y-%m-%d').date()
+            row['remaining_days'] = max((row['ended_date'] - today).days, 0)
+        return row
+
+    def license_rows(ids, licenses):
+        rows = [license_row(licenses[pk]) for pk in ids]
+        return sorted(rows, key=lambda row: row['description'])
+
+    def expiring(licenses):
+        return {pk for pk, state in licenses.items() if state[4] and state[4] < warning_date}
+
+    def depleted(licenses):
+        return {pk for pk, state in licenses.items() if state[3] >= state[2]}
+
+    common = new_licenses.keys() & old_licenses.keys()
+    changes = {
+        'new_licenses': license_rows(new_licenses.keys() - old_licenses.keys(), new_licenses),
+        'removed_licenses': license_rows(old_licenses.keys() - new_licenses.keys(), old_licenses),
+        'expiring_licenses': license_rows(
+            expiring(new_licenses) - (expiring(old_licenses) & common), new_licenses),
+        'renewed_licenses': license_rows(
+            (expiring(old_licenses) & common) - expiring(new_licenses), new_licenses),
+        'depleted_licenses': license_rows(
+            depleted(new_licenses) - (depleted(old_licenses) & common), new_licenses),
+        'replenished_licenses': license_rows(
+            (depleted(old_licenses) & common) - depleted(new_licenses), new_licenses),
+    }
+
+    old_unlicensed, new_unlicensed = old['unlicensed'], new['unlicensed']
+    increased = {pk for pk, state in new_unlicensed.items()
+                 if pk not in old_unlicensed or state[2] > old_unlicensed[pk][2]}
+    changes['unlicensed_softwares'] = sorted((
+        {
+            'software': new_unlicensed[pk][0],
+            'software_family__name': new_unlicensed[pk][1],
+            'count': new_unlicensed[pk][2],
+            'previous_count': old_unlicensed[pk][2] if pk in old_unlicensed else 0,
+        } for pk in increased), key=lambda row: row['software'])
+    changes['resolved_softwares'] = sorted((
+        {
+            'software': old_unlicensed[pk][0],
+            'software_family__name': old_unlicensed[pk][1],
+            'previous_count': old_unlicensed[pk][2],
+        } for pk in old_unlicensed.keys() - new_unlicensed.keys()), key=lambda row: row['software'])
+    return changes
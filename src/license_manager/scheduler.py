@@ -0,0 +1,155 @@
+"""Jobs of the run-scheduler command.
+
+Jobs are management commands listed in the ``SCHEDULED_JOBS`` setting with
+a crontab schedule. Every run holds a lock row in ``JobLock`` so the same
+job never overlaps, even across processes or hosts, and is recorded in
+``JobRun`` with its duration, the rows reported by the command (its
+``rows_affected`` attribute) and its output or error.
+"""
+import io
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command, get_commands, load_command_class
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from .models import JobLock, JobRun
+
+DEFAULT_TIMEOUT = 60
+MAX_OUTPUT = 10000
+
+
+class CronSchedule(object):
+    """Crontab schedule: minute hour day-of-month month day-of-week.
+
+    Fields accept ``*``, numbers, ranges ``a-b``, steps ``*/n``, ``a-b/n`` or
+    ``a/n``, from ``a`` to the highest value, and lists of them. Sunday is 0 or 7. As in cron, when both days of month
+    and days of week are restricted, either of them matches.
+    """
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid schedule %r, expected 5 fields' % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = None
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-', 1)]
+            elif step:
+                # as in cron, 5/15 is 5-59/15
+                start, end = int(part), high
+            else:
+                start = end = int(part)
+            step = 1 if step is None else step
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError('Invalid schedule field %r' % field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, dt):
+        if dt.minute not in self.minutes or dt.hour not in self.hours or dt.month not in self.months:
+            return False
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def __str__(self):
+        return self.expression
+
+
+class Job(object):
+    def __init__(self, name, command, schedule, args=None, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.command = command
+        self.schedule = CronSchedule(schedule)
+        self.args = args or []
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.name
+
+
+def get_jobs():
+    """Return the jobs of the ``SCHEDULED_JOBS`` setting."""
+    jobs = []
+    for config in getattr(settings, 'SCHEDULED_JOBS', []):
+        job = Job(**config)
+        if job.command not in get_commands():
+            raise ValueError('Unknown command %s of job %s' % (job.command, job.name))
+        jobs.append(job)
+    return jobs
+
+
+def get_owner():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def acquire_lock(job, owner, timeout):
+    """Take the lock of a job for ``timeout`` minutes, return False if it is held.
+    The conditional update is atomic, only one process can win it.
+    """
+    now = timezone.now()
+    JobLock.objects.get_or_create(job=job, defaults={'locked_until': now})
+    return JobLock.objects.filter(job=job, locked_until__lte=now).update(
+        owner=owner, locked_at=now, locked_until=now + timedelta(minutes=timeout)) == 1
+
+
+def release_lock(job, owner):
+    JobLock.objects.filter(job=job, owner=owner).update(locked_until=timezone.now())
+
+
+def run_job(job, owner=None):
+    """Run a job now unless it is already running, return its JobRun."""
+    owner = owner or get_owner()
+    close_old_connections()
+    try:
+        if not acquire_lock(job.name, owner, job.timeout):
+            return JobRun.objects.create(
+                job=job.name, status=JobRun.STATUS_SKIPPED, started_at=timezone.now(),
+                error='Skipped, the previous run still holds the lock')
+
+        run = JobRun.objects.create(job=job.name, started_at=timezone.now())
+        started = time.time()
+        output = io.StringIO()
+        command = load_command_class(get_commands()[job.command], job.command)
+        try:
+            call_command(command, *job.args, stdout=output, stderr=output)
+            run.status = JobRun.STATUS_SUCCESS
+        except Exception:
+            run.status = JobRun.STATUS_FAILED
+            run.error = traceback.format_exc()
+        finally:
+            release_lock(job.name, owner)
+        run.finished_at = timezone.now()
+        run.duration = time.time() - started
+        run.rows = getattr(command, 'rows_affected', None)
+        run.output = output.getvalue()[-MAX_OUTPUT:]
+        run.save()
+        return run
+    finally:
+        # runs happen in worker threads, each with its own connection
+        connection.close()
@@ -1,3 +1,535 @@
-from django.test import TestCase
+import email
+import json
+import os
+import random
+import shutil
+import tempfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from .allocation import GreedyAllocator, MinCostAllocator, combine_pk
+from .models import (
+    ArchivedLicenseAssignment, DirectorySyncState, JobLock, JobRun, License, LicenseAssignment,
+    LicenseAssignmentHistory, LicensedSoftware, LicenseKey, LicenseReportSnapshot, Platform, Software,
+    SoftwareFamily)
+from .reports import get_last_license_snapshot, save_license_snapshot, take_license_snapshot
+from .scheduler import CronSchedule, Job, acquire_lock, release_lock, run_job
+
+
+def make_license(pk, total, used_total=0, ended_date=None):
+    lic = License(
+        pk=pk, total=total, used_total=used_total,
+        license_type=License.LICENSE_SUBSCRIPTION if ended_date else License.LICENSE_PERPETUAL,
+        ended_date=ended_date)
+    lic.remaining = total - used_total
+    return lic
+
+
+class AllocatorTest(SimpleTestCase):
+    today = date(2020, 1, 1)
+
+    def allocate(self, allocator_class, requests, maps, licenses, keys=None):
+        allocator = allocator_class(maps, licenses, keys or {}, today=self.today)
+        return allocator.allocate(requests)
+
+    def get_cost(self, requests, result, licenses, keys):
+        """Licensed seats and total cost of an allocation in the MinCostAllocator model."""
+        model = MinCostAllocator({}, licenses, keys, today=self.today)
+        counts = Counter((sw_id, lic_id) for sw_id, lic_id in zip(requests, result) if lic_id)
+        cost = 0
+        for (sw_id, lic_id), count in counts.items():
+            for cap, key_cost in model.get_key_edges(sw_id, lic_id, count):
+                cost += cap * (model.get_license_cost(licenses[lic_id]) + key_cost)
+        return sum(counts.values()), cost
+
+    def check_allocation(self, requests, result, maps, licenses):
+        self.assertEqual(len(result), len(requests))
+        used = Counter(lic_id for lic_id in result if lic_id)
+        for lic_id, count in used.items():
+            self.assertLessEqual(count, licenses[lic_id].remaining)
+        for sw_id, lic_id in zip(requests, result):
+            if lic_id:
+                self.assertIn(lic_id, maps[sw_id])
+
+    def test_prefers_soon_expiring_subscription(self):
+        licenses = {1: make_license(1, 5), 2: make_license(2, 5, ended_date=self.today + timedelta(10))}
+        result = self.allocate(MinCostAllocator, [1, 1], {1: [1, 2]}, licenses)
+        self.assertEqual(result, [2, 2])
+
+    def test_skips_expired_subscription(self):
+        licenses = {1: make_license(1, 5, ended_date=self.today - timedelta(1))}
+        self.assertEqual(self.allocate(GreedyAllocator, [1], {1: [1]}, licenses), [1])
+        self.assertEqual(self.allocate(MinCostAllocator, [1], {1: [1]}, licenses), [None])
+
+    def test_prefers_free_single_keys(self):
+        licenses = {1: make_license(1, 5, used_total=1), 2: make_license(2, 5, used_total=1)}
+        keys = {combine_pk(1, 2): [LicenseKey(activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE)]}
+        result = self.allocate(MinCostAllocator, [1, 1], {1: [1, 2]}, licenses, keys)
+        self.assertIn(2, result)
+
+    def test_licenses_more_seats_than_greedy(self):
+        # greedy gives the only license of software 2 to software 1
+        licenses = {1: make_license(1, 1), 2: make_license(2, 1)}
+        maps = {1: [1, 2], 2: [1]}
+        self.assertEqual(self.allocate(GreedyAllocator, [1, 2], maps, licenses), [1, None])
+        self.assertEqual(self.allocate(MinCostAllocator, [1, 2], maps, licenses), [2, 1])
+
+    def test_random_batches_against_greedy(self):
+        rnd = random.Random(0)
+        for i in range(50):
+            licenses = {}
+            maps = {}
+            keys = {}
+            for pk in range(1, rnd.randint(2, 30)):
+                total = rnd.randint(1, 10)
+                ended_date = self.today + timedelta(rnd.randint(0, 500)) if rnd.random() < 0.5 else None
+                licenses[pk] = make_license(pk, total, rnd.randint(0, total - 1), ended_date)
+                for sw_id in rnd.sample(range(1, 6), rnd.randint(1, 3)):
+                    maps.setdefault(sw_id, []).append(pk)
+                    keys[combine_pk(sw_id, pk)] = [
+                        LicenseKey(activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE)
+                        for j in range(rnd.randint(0, 3))]
+            for ids in maps.values():
+                ids.sort(key=lambda pk: licenses[pk].remaining)
+            requests = [rnd.choice(list(maps)) for j in range(rnd.randint(1, 80))]
+
+            greedy = self.allocate(GreedyAllocator, requests, maps, licenses, keys)
+            min_cost = self.allocate(MinCostAllocator, requests, maps, licenses, keys)
+            self.check_allocation(requests, greedy, maps, licenses)
+            self.check_allocation(requests, min_cost, maps, licenses)
+            greedy_seats, greedy_cost = self.get_cost(requests, greedy, licenses, keys)
+            seats, cost = self.get_cost(requests, min_cost, licenses, keys)
+            self.assertGreaterEqual(seats, greedy_seats)
+            if seats == greedy_seats:
+                self.assertLessEqual(cost, greedy_cost)
+
+
+def make_directory_user(email, suspended=False, org_unit='/punch-staff', changed_at='2018-06-01T00:00:00.000Z',
+                        name=None):
+    first_name, last_name = (name or email[:email.index('@')]).split('.')
+    return {
+        'primaryEmail': email,
+        'suspended': suspended,
+        'orgUnitPath': org_unit,
+        'creationTime': '2018-01-01T00:00:00.000Z',
+        'lastChangeTime': changed_at,
+        'name': {'givenName': first_name.title(), 'familyName': last_name.title()},
+    }
+
+
+class SyncGsuiteUsersTest(TestCase):
+    """sync-gsuite-users against the offline FakeDirectoryService."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def sync(self, directory_users, **options):
+        path = os.path.join(self.directory, 'users.json')
+        with open(path, 'w') as f:
+            json.dump({'users': directory_users}, f)
+        out = StringIO()
+        call_command('sync-gsuite-users', fake_directory=path, page_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_creates_users(self):
+        out = self.sync([
+            make_directory_user('john.doe@punch.vn'),
+            make_directory_user('jane.roe@punch.vn'),
+            make_directory_user('max.mustermann@punch.vn'),
+            make_directory_user('ann.other@punch.vn', org_unit='/contractors'),
+        ])
+        self.assertIn('Created: 3', out)
+        self.assertQuerysetEqual(
+            User.objects.order_by('username'), ['jane.roe', 'john.doe', 'max.mustermann'],
+            transform=lambda user: user.username)
+        user = User.objects.get(username='john.doe')
+        self.assertEqual((user.email, user.first_name, user.last_name), ('john.doe@punch.vn', 'John', 'Doe'))
+        self.assertTrue(DirectorySyncState.objects.filter(domain='punch.vn', org_unit='punch-staff').exists())
+
+    def test_skips_suspended_users(self):
+        User.objects.create(username='jane.roe', email='jane.roe@punch.vn')
+        out = self.sync([
+            make_directory_user('john.doe@punch.vn', suspended=True),
+            make_directory_user('jane.roe@punch.vn', suspended=True),
+        ])
+        self.assertIn('Created: 0, reactivated: 0, deactivated: 1', out)
+        self.assertFalse(User.objects.filter(username='john.doe').exists())
+        self.assertFalse(User.objects.get(username='jane.roe').is_active)
+
+    def test_renames_users(self):
+        for username in ('john.doe', 'jane.roe', 'max.mustermann'):
+            User.objects.create(username=username, email=username + '@punch.vn', first_name='Old', last_name='Name')
+        out = self.sync([
+            make_directory_user('john.doe@punch.vn'),
+            make_directory_user('jane.roe@punch.vn', name='jane.smith'),
+            make_directory_user('max.mustermann@punch.vn', name='old.name'),
+        ], chunk_size=1)
+        self.assertIn('Created: 0, reactivated: 0, deactivated: 0, renamed: 2', out)
+        self.assertQuerysetEqual(
+            User.objects.order_by('username'),
+            [('jane.roe', 'Jane', 'Smith'), ('john.doe', 'John', 'Doe'), ('max.mustermann', 'Old', 'Name')],
+            transform=lambda user: (user.username, user.first_name, user.last_name))
+
+    def test_incremental_sync(self):
+        DirectorySyncState.objects.create(
+            domain='punch.vn', org_unit='punch-staff', synced_at=timezone.now() - timedelta(1))
+        recent = (timezone.now() - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        out = self.sync([
+            make_directory_user('john.doe@punch.vn'),
+            make_directory_user('jane.roe@punch.vn', changed_at=recent),
+        ], incremental=True)
+        self.assertIn('Created: 1', out)
+        self.assertQuerysetEqual(User.objects.all(), ['jane.roe'], transform=lambda user: user.username)
+
+    def test_stale_incremental_sync_falls_back_to_full_sync(self):
+        state = DirectorySyncState.objects.create(
+            domain='punch.vn', org_unit='punch-staff', synced_at=timezone.now() - timedelta(365))
+        out = self.sync([
+            make_directory_user('john.doe@punch.vn'),
+            make_directory_user('jane.roe@punch.vn'),
+        ], incremental=True)
+        self.assertIn('running a full sync', out)
+        self.assertIn('Created: 2', out)
+        state.refresh_from_db()
+        self.assertGreater(state.synced_at, timezone.now() - timedelta(1))
+
+
+class SendReportsTest(TestCase):
+    """send-reports through the file email backend."""
+
+    def setUp(self):
+        self.family = SoftwareFamily.objects.create(name='Adobe')
+        License.objects.create(
+            software_family=self.family, total=5, license_type=License.LICENSE_SUBSCRIPTION,
+            ended_date=timezone.now().date() + timedelta(5))
+        self.email_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.email_dir)
+
+    def send_reports(self, *args):
+        """Run the command and return its output and the HTML of the emails
+        written to ``email_dir``.
+        """
+        for name in os.listdir(self.email_dir):
+            os.remove(os.path.join(self.email_dir, name))
+        out = StringIO()
+        call_command('send-reports', '--to', 'it@punch.vn', *args, stdout=out)
+        bodies = []
+        for name in sorted(os.listdir(self.email_dir)):
+            with open(os.path.join(self.email_dir, name)) as f:
+                # the file backend separates the messages with a line of dashes
+                for text in f.read().split('\n' + '-' * 79 + '\n'):
+                    if text.strip():
+                        message = email.message_from_string(text)
+                        self.assertEqual(message['To'], 'it@punch.vn')
+                        bodies.extend(
+                            part.get_payload(decode=True).decode('utf-8') for part in message.walk()
+                            if part.get_content_type() == 'text/html')
+        return out.getvalue(), bodies
+
+    def test_full_report(self):
+        # the backend chosen by settings when EMAIL_FILE_PATH is set
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend',
+                           EMAIL_FILE_PATH=self.email_dir):
+            out, bodies = self.send_reports()
+        self.assertIn('Successfully sent 1 email reports', out)
+        self.assertEqual(len(bodies), 1)
+        self.assertIn('Expiring Licenses', bodies[0])
+        self.assertIn('Adobe Subscription-based Licenses #001', bodies[0])
+
+    def test_changes_since_stored_snapshot(self):
+        save_license_snapshot(take_license_snapshot())
+        License.objects.create(software_family=self.family, total=10)
+        out, bodies = self.send_reports('--changes', '--email-dir', self.email_dir)
+        self.assertEqual(len(bodies), 1)
+        self.assertIn('New Licenses', bodies[0])
+        self.assertIn('Adobe Perpetual Licenses #001', bodies[0])
+        self.assertNotIn('No changes since the last report', bodies[0])
+        self.assertEqual(LicenseReportSnapshot.objects.count(), 2)
+
+        out, bodies = self.send_reports('--changes', '--email-dir', self.email_dir)
+        self.assertEqual(len(bodies), 1)
+        self.assertIn('No changes since the last report', bodies[0])
+        self.assertNotIn('New Licenses', bodies[0])
+
+    def test_each_run_uses_its_own_time(self):
+        # the scheduler runs the command many times in one process
+        License.objects.create(
+            software_family=SoftwareFamily.objects.create(name='Autodesk'), total=5,
+            license_type=License.LICENSE_SUBSCRIPTION, ended_date=timezone.now().date() + timedelta(50))
+        first = timezone.now()
+        with mock.patch('django.utils.timezone.now', return_value=first):
+            out, bodies = self.send_reports('--changes', '--email-dir', self.email_dir)
+        expiring = bodies[0][:bodies[0].index('Available licenses')]
+        self.assertIn('Adobe Subscription-based Licenses #001', expiring)
+        self.assertNotIn('Autodesk', expiring)
+        self.assertIn(first.strftime('%d %B, %Y'), bodies[0])
+        self.assertEqual(get_last_license_snapshot()['date'], first.date().isoformat())
+
+        second = first + timedelta(30)
+        with mock.patch('django.utils.timezone.now', return_value=second):
+            out, bodies = self.send_reports('--email-dir', self.email_dir)
+        expiring = bodies[0][:bodies[0].index('Available licenses')]
+        self.assertIn('Autodesk Subscription-based Licenses #001', expiring)
+        self.assertIn(second.strftime('%d %B, %Y'), bodies[0])
+        with open(os.path.join(self.email_dir, os.listdir(self.email_dir)[0])) as f:
+            self.assertIn('Subject: License Reports ' + second.strftime('%d %B, %Y'), f.read())
+
+
+class CronScheduleTest(SimpleTestCase):
+
+    def parse(self, field, low=0, high=59):
+        return sorted(CronSchedule.parse_field(field, low, high))
+
+    def test_fields(self):
+        self.assertEqual(self.parse('*', 1, 12), list(range(1, 13)))
+        self.assertEqual(self.parse('5'), [5])
+        self.assertEqual(self.parse('1-3,10'), [1, 2, 3, 10])
+        self.assertEqual(self.parse('*/15'), [0, 15, 30, 45])
+        self.assertEqual(self.parse('10-30/10'), [10, 20, 30])
+        # like cron, a start with a step runs to the highest value
+        self.assertEqual(self.parse('5/15'), [5, 20, 35, 50])
+        self.assertEqual(self.parse('2/1', 0, 4), [2, 3, 4])
+
+    def test_invalid_fields(self):
+        for field in ('60', '5-1', '*/0', '5/0', 'x', '1-'):
+            with self.assertRaises(ValueError):
+                CronSchedule.parse_field(field, 0, 59)
+        with self.assertRaises(ValueError):
+            CronSchedule('* * * *')
+
+    def test_matches(self):
+        schedule = CronSchedule('30 2 * * *')
+        self.assertTrue(schedule.matches(datetime(2020, 1, 1, 2, 30)))
+        self.assertFalse(schedule.matches(datetime(2020, 1, 1, 2, 31)))
+        self.assertFalse(schedule.matches(datetime(2020, 1, 1, 3, 30)))
+
+    def test_sunday(self):
+        sunday = datetime(2020, 1, 5, 8, 0)
+        self.assertTrue(CronSchedule('0 8 * * 0').matches(sunday))
+        self.assertTrue(CronSchedule('0 8 * * 7').matches(sunday))
+        self.assertTrue(CronSchedule('0 8 * * 5-7').matches(sunday))
+        self.assertFalse(CronSchedule('0 8 * * 1-5').matches(sunday))
+
+    def test_day_of_month_or_day_of_week(self):
+        # the 1st and 15th of the month, and every Monday
+        schedule = CronSchedule('0 8 1,15 * 1')
+        self.assertTrue(schedule.matches(datetime(2020, 1, 1, 8, 0)))  # Wednesday
+        self.assertTrue(schedule.matches(datetime(2020, 1, 6, 8, 0)))  # Monday
+        self.assertFalse(schedule.matches(datetime(2020, 1, 7, 8, 0)))
+        # with one of them unrestricted, the other one must match
+        self.assertFalse(CronSchedule('0 8 * * 1').matches(datetime(2020, 1, 1, 8, 0)))
+        self.assertFalse(CronSchedule('0 8 15 * *').matches(datetime(2020, 1, 1, 8, 0)))
+        self.assertTrue(CronSchedule('0 8 1 * *').matches(datetime(2020, 1, 1, 8, 0)))
+
+
+class JobLockTest(TestCase):
+
+    def test_single_holder(self):
+        self.assertTrue(acquire_lock('job', 'host:1', 30))
+        self.assertFalse(acquire_lock('job', 'host:2', 30))
+        self.assertFalse(acquire_lock('job', 'host:1', 30))
+        # another owner cannot release it
+        release_lock('job', 'host:2')
+        self.assertFalse(acquire_lock('job', 'host:2', 30))
+        release_lock('job', 'host:1')
+        self.assertTrue(acquire_lock('job', 'host:2', 30))
+        self.assertEqual(JobLock.objects.get().owner, 'host:2')
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertTrue(acquire_lock('job', 'host:1', 30))
+        JobLock.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(acquire_lock('job', 'host:2', 30))
+        self.assertEqual(JobLock.objects.get().owner, 'host:2')
+        self.assertGreater(JobLock.objects.get().locked_until, timezone.now() + timedelta(minutes=29))
+
+    # run_job closes the connection of its worker thread, not the one of the test
+    @mock.patch('license_manager.scheduler.close_old_connections')
+    @mock.patch('license_manager.scheduler.connection')
+    def test_run_job(self, connection, close_old_connections):
+        job = Job('sessions', 'clearsessions', '* * * * *')
+        acquire_lock('sessions', 'host:1', 30)
+        run = run_job(job, owner='host:2')
+        self.assertEqual(run.status, JobRun.STATUS_SKIPPED)
+
+        release_lock('sessions', 'host:1')
+        run = run_job(job, owner='host:2')
+        self.assertEqual(run.status, JobRun.STATUS_SUCCESS)
+        self.assertIsNotNone(run.finished_at)
+        # released after the run
+        self.assertTrue(acquire_lock('sessions', 'host:3', 30))
+
+
+class LicenseAssignmentHistoryTest(TestCase):
+
+    def setUp(self):
+        family = SoftwareFamily.objects.create(name='Adobe')
+        self.software = Software.objects.create(software_family=family, name='Photoshop')
+        self.platform = Platform.objects.create(name='Windows')
+        self.user = User.objects.create(username='john.doe')
+        self.first = License.objects.create(software_family=family, total=5)
+        self.second = License.objects.create(software_family=family, total=5)
+        patcher = mock.patch('django.utils.timezone.now', return_value=timezone.now())
+        self.now = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def at(self, day, hour=10):
+        """Set the clock to ``hour`` o'clock of the ``day`` of January 2020."""
+        self.now.return_value = timezone.make_aware(datetime(2020, 1, day, hour))
+
+    def get_licenses(self, when):
+        return list(LicenseAssignmentHistory.objects.as_of(when).values_list('license_id', flat=True))
+
+    def test_history(self):
+        self.at(1)
+        assignment = LicenseAssignment(
+            user=self.user, software=self.software, platform=self.platform, license=self.first)
+        assignment.save()
+        self.assertEqual(LicenseAssignmentHistory.objects.current().get().license_id, self.first.pk)
+
+        self.at(3)
+        assignment.note = 'not recorded'
+        assignment.save()
+        self.assertEqual(LicenseAssignmentHistory.objects.count(), 1)
+        assignment.license = self.second
+        assignment.save()
+        first_day, third_day = [timezone.make_aware(datetime(2020, 1, day, 10)) for day in (1, 3)]
+        self.assertEqual(
+            list(LicenseAssignmentHistory.objects.order_by('pk').values_list('license_id', 'valid_from', 'valid_to')),
+            [(self.first.pk, first_day, third_day), (self.second.pk, third_day, None)])
+        self.assertEqual(
+            list(License.objects.order_by('pk').values_list('used_total', flat=True)), [0, 1])
+
+        self.at(5)
+        assignment.delete()
+        self.assertFalse(LicenseAssignmentHistory.objects.current().exists())
+        self.assertEqual(LicenseAssignmentHistory.objects.count(), 2)
+
+    def test_recorded_by_caller(self):
+        assignment = LicenseAssignment(
+            user=self.user, software=self.software, platform=self.platform, license=self.first)
+        assignment.save(record_history=False, notify=False)
+        self.assertFalse(LicenseAssignmentHistory.objects.exists())
+        LicenseAssignmentHistory.record([assignment])
+        self.assertEqual(LicenseAssignmentHistory.objects.current().get().assignment_id, assignment.pk)
+
+    def test_as_of(self):
+        self.at(1)
+        assignment = LicenseAssignment(
+            user=self.user, software=self.software, platform=self.platform, license=self.first)
+        assignment.save()
+        self.at(3)
+        assignment.license = self.second
+        assignment.save()
+        self.at(5)
+        assignment.delete()
+
+        # a date is the end of that day
+        self.assertEqual(self.get_licenses(date(2019, 12, 31)), [])
+        self.assertEqual(self.get_licenses(date(2020, 1, 1)), [self.first.pk])
+        self.assertEqual(self.get_licenses(date(2020, 1, 2)), [self.first.pk])
+        self.assertEqual(self.get_licenses(date(2020, 1, 3)), [self.second.pk])
+        self.assertEqual(self.get_licenses(date(2020, 1, 4)), [self.second.pk])
+        self.assertEqual(self.get_licenses(date(2020, 1, 5)), [])
+        self.assertEqual(self.get_licenses(timezone.make_aware(datetime(2020, 1, 3, 9))), [self.first.pk])
+        self.assertEqual(self.get_licenses(timezone.make_aware(datetime(2020, 1, 3, 10))), [self.second.pk])
+
+
+class RebalanceLicensesTest(TestCase):
+
+    def setUp(self):
+        family = SoftwareFamily.objects.create(name='Adobe')
+        self.software = Software.objects.create(software_family=family, name='Photoshop')
+        self.platform = Platform.objects.create(name='Windows')
+        self.big = License.objects.create(software_family=family, total=5)
+        self.small = License.objects.create(software_family=family, total=3)
+        self.volume_key = self.add_key(self.big, 'VOLUME', LicenseKey.ACTIVATION_TYPE_VOLUME)
+        self.single_key = self.add_key(self.small, 'SINGLE', LicenseKey.ACTIVATION_TYPE_SINGLE)
+        for username, lic, key in (('john.doe', self.big, self.volume_key),
+                                   ('jane.roe', self.big, self.volume_key),
+                                   ('max.mustermann', self.small, self.single_key)):
+            LicenseAssignment(
+                user=User.objects.create(username=username), software=self.software, platform=self.platform,
+                license=lic, license_key=key).save()
+        self.moved = LicenseAssignment.objects.get(user__username='max.mustermann')
+
+    def add_key(self, lic, serial_key, activation_type):
+        licensed_software = LicensedSoftware.objects.create(license=lic, software=self.software)
+        key = LicenseKey.objects.create(
+            licensed_software=licensed_software, serial_key=serial_key, activation_type=activation_type)
+        key.platforms.add(self.platform)
+        return key
+
+    def get_used_totals(self):
+        return list(License.objects.order_by('pk').values_list('used_total', flat=True))
+
+    def test_rebalance(self):
+        out = StringIO()
+        call_command('rebalance-licenses', stdout=out)
+        self.assertIn('1 licenses could be emptied with 1 moves', out.getvalue())
+        self.assertEqual(self.get_used_totals(), [3, 0])
+        self.moved.refresh_from_db()
+        self.assertEqual((self.moved.license_id, self.moved.license_key_id), (self.big.pk, self.volume_key.pk))
+        self.assertQuerysetEqual(
+            LicenseAssignmentHistory.objects.filter(assignment_id=self.moved.pk).order_by('pk'),
+            [(self.small.pk, self.single_key.pk, False), (self.big.pk, self.volume_key.pk, True)],
+            transform=lambda history: (history.license_id, history.license_key_id, history.valid_to is None))
+        self.assertEqual(LicenseAssignmentHistory.objects.current().filter(license=self.big).count(), 3)
+        self.assertFalse(ArchivedLicenseAssignment.objects.exists())
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('rebalance-licenses', dry_run=True, stdout=out)
+        self.assertIn('1 licenses could be emptied with 1 moves', out.getvalue())
+        self.assertEqual(self.get_used_totals(), [2, 1])
+        self.assertEqual(LicenseAssignment.objects.get(pk=self.moved.pk).license_id, self.small.pk)
+        self.assertEqual(LicenseAssignmentHistory.objects.count(), 3)
+
+
+class ReclaimInactiveTest(TestCase):
+
+    def setUp(self):
+        family = SoftwareFamily.objects.create(name='Adobe')
+        software = Software.objects.create(software_family=family, name='Photoshop')
+        platform = Platform.objects.create(name='Windows')
+        self.license = License.objects.create(software_family=family, total=5)
+        self.key = LicenseKey.objects.create(
+            licensed_software=LicensedSoftware.objects.create(license=self.license, software=software),
+            serial_key='SINGLE', activation_type=LicenseKey.ACTIVATION_TYPE_SINGLE)
+        self.active = User.objects.create(username='john.doe')
+        self.inactive = User.objects.create(username='jane.roe')
+        for user, lic, key in ((self.active, self.license, None),
+                               (self.inactive, self.license, self.key),
+                               (self.inactive, None, None)):
+            LicenseAssignment(user=user, software=software, platform=platform, license=lic, license_key=key).save()
+        self.inactive.is_active = False
+        self.inactive.save()
+
+    def test_reclaim(self):
+        reclaimed = list(LicenseAssignment.objects.filter(user=self.inactive).values_list('pk', flat=True))
+        out = StringIO()
+        call_command('reclaim-inactive', chunk_size=1, stdout=out)
+        self.assertIn('2 license assignments of 1 deactivated users, '
+                      'returning 1 seats to 1 licenses and releasing 1 single keys', out.getvalue())
+        self.license.refresh_from_db()
+        self.assertEqual(self.license.used_total, 1)
+        self.assertTrue(self.key.is_available())
+        self.assertQuerysetEqual(
+            LicenseAssignment.objects.all(), [self.active.pk], transform=lambda assignment: assignment.user_id)
+        self.assertQuerysetEqual(
+            ArchivedLicenseAssignment.objects.order_by('pk'),
+            [(self.inactive.pk, self.license.pk, self.key.pk, 'SINGLE', 'Deactivated user'),
+             (self.inactive.pk, None, None, '', 'Deactivated user')],
+            transform=lambda archived: (archived.user_id, archived.license_id, archived.license_key_id,
+                                        archived.serial_key, archived.reason))
+        history = LicenseAssignmentHistory.objects.filter(assignment_id__in=reclaimed)
+        self.assertEqual(history.count(), 2)
+        self.assertFalse(history.current().exists())
+        self.assertEqual(LicenseAssignmentHistory.objects.current().get().user_id, self.active.pk)
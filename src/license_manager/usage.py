@@ -0,0 +1,123 @@
+"""License utilization time series.
+
+``record_daily_usage`` stores one ``LicenseUsage`` row per license and per
+software family for a day, ``rollup_usage`` aggregates the day rows into
+weekly and monthly rows and ``prune_usage`` applies the retention. Readers
+(charts, projections) only use these rows, never the assignments.
+"""
+import math
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Avg, Max
+
+from .models import License, LicenseUsage
+
+
+def get_period_start(date, period):
+    if period == LicenseUsage.PERIOD_WEEK:
+        return date - timedelta(date.weekday())
+    if period == LicenseUsage.PERIOD_MONTH:
+        return date.replace(day=1)
+    return date
+
+
+def get_period_end(start, period):
+    """Return the first day after the period starting at ``start``."""
+    if period == LicenseUsage.PERIOD_WEEK:
+        return start + timedelta(7)
+    if period == LicenseUsage.PERIOD_MONTH:
+        return (start + timedelta(32)).replace(day=1)
+    return start + timedelta(1)
+
+
+@transaction.atomic
+def record_daily_usage(date):
+    """Record the current utilization of every license as the usage of ``date``."""
+    rows = []
+    families = {}
+    for pk, family_id, total, used_total in License.objects.values_list(
+            'pk', 'software_family_id', 'total', 'used_total'):
+        used_total = used_total or 0
+        rows.append(LicenseUsage(
+            period=LicenseUsage.PERIOD_DAY, date=date, software_family_id=family_id, license_id=pk,
+            total=total, used_total=used_total, peak_used=used_total))
+        family_total, family_used = families.get(family_id, (0, 0))
+        families[family_id] = (family_total + total, family_used + used_total)
+    for family_id, (total, used_total) in families.items():
+        rows.append(LicenseUsage(
+            period=LicenseUsage.PERIOD_DAY, date=date, software_family_id=family_id,
+            total=total, used_total=used_total, peak_used=used_total))
+
+    LicenseUsage.objects.filter(period=LicenseUsage.PERIOD_DAY, date=date).delete()
+    LicenseUsage.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+@transaction.atomic
+def rollup_usage(date, period):
+    """Aggregate the day rows of the period containing ``date`` into one row per license and family."""
+    start = get_period_start(date, period)
+    end = get_period_end(start, period)
+    rows = (LicenseUsage.objects
+                        .filter(period=LicenseUsage.PERIOD_DAY, date__gte=start, date__lt=end)
+                        .values('software_family_id', 'license_id')
+                        .annotate(max_total=Max('total'), avg_used=Avg('used_total'), max_used=Max('peak_used'))
+                        .order_by())
+    rollups = [
+        LicenseUsage(
+            period=period, date=start, software_family_id=row['software_family_id'], license_id=row['license_id'],
+            total=row['max_total'], used_total=int(round(row['avg_used'])), peak_used=row['max_used'])
+        for row in rows
+    ]
+    LicenseUsage.objects.filter(period=period, date=start).delete()
+    LicenseUsage.objects.bulk_create(rollups, batch_size=500)
+    return len(rollups)
+
+
+def prune_usage(today, keep_days, keep_weeks, keep_months=None):
+    """Delete the rows older than the retention of their period, None keeps them forever."""
+    deleted = 0
+    retention = (
+        (LicenseUsage.PERIOD_DAY, keep_days and today - timedelta(keep_days)),
+        (LicenseUsage.PERIOD_WEEK, keep_weeks and today - timedelta(weeks=keep_weeks)),
+        (LicenseUsage.PERIOD_MONTH, keep_months and today - timedelta(keep_months * 31)),
+    )
+    for period, limit in retention:
+        if limit:
+            count, _ = LicenseUsage.objects.filter(period=period, date__lt=limit).delete()
+            deleted += count
+    return deleted
+
+
+def get_depletion_dates(today, window=30, licenses=None):
+    """Project when licenses run out of seats from their daily usage over the last ``window`` days.
+
+    Returns license id -> dict of ``rate`` (seats per day), ``remaining`` and
+    ``date``, only for licenses whose usage grew over the window.
+    """
+    rows = (LicenseUsage.objects
+                        .filter(period=LicenseUsage.PERIOD_DAY, license__isnull=False,
+                                date__gte=today - timedelta(window))
+                        .values_list('license_id', 'date', 'total', 'used_total')
+                        .order_by('license_id', 'date'))
+    if licenses is not None:
+        rows = rows.filter(license__in=licenses)
+    bounds = {}
+    for license_id, date, total, used_total in rows:
+        first, last = bounds.get(license_id, (None, None))
+        bounds[license_id] = (first or (date, used_total), (date, used_total, total))
+
+    projections = {}
+    for license_id, ((first_date, first_used), (last_date, last_used, total)) in bounds.items():
+        days = (last_date - first_date).days
+        if not days or last_used <= first_used:
+            continue
+        rate = (last_used - first_used) / days
+        remaining = max(total - last_used, 0)
+        projections[license_id] = {
+            'rate': rate,
+            'remaining': remaining,
+            'date': last_date + timedelta(int(math.ceil(remaining / rate))),
+        }
+    return projections
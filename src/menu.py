@@ -26,18 +26,21 @@ class CustomMenu(Menu):
             items.Bookmarks(),
             items.AppList(
                 _('Administration'),
-                models=('django.contrib.*', 'filer.*', )
+                models=('django.contrib.*', 'filer.*', 'license_manager.models.JobRun', 'asset_manager.models.Notification')
             ),
             items.ModelList(
                 _('Asset Manager'),
                 (
                     'asset_manager.models.Asset',
                     'asset_manager.models.Exchange',
+                    'asset_manager.models.Stocktake',
+                    'asset_manager.models.AssetCount',
                     'asset_manager.models.Office',
                     'asset_manager.models.Location',
                     'asset_manager.models.Manufacturer',
                     'asset_manager.models.Supplier',
                     'asset_manager.models.Type',
+                    'asset_manager.models.DirectoryMapping',
                 ),
             ),
             items.ModelList(
@@ -46,12 +49,18 @@ class CustomMenu(Menu):
                     'license_manager.models.License',
                     'license_manager.models.LicenseAssignment',
                     'license_manager.models.LicenseSummary',
+                    'license_manager.models.ArchivedLicenseAssignment',
+                    'license_manager.models.LicenseAssignmentHistory',
                     'license_manager.models.Platform',
                     'license_manager.models.SoftwareFamily',
                     'license_manager.models.Software',
                     'license_manager.models.Supplier',
                 ),
             ),
+            items.MenuItem(_('Import Assets'), reverse('admin:asset_manager_asset_import')),
+            items.MenuItem(_('Kitting Queue'), reverse('admin:asset_manager_exchange_kitting')),
+            items.MenuItem(_('Warranty Expiry'), reverse('admin:asset_manager_asset_warranty')),
+            items.MenuItem(_('License Usage'), reverse('admin:license_manager_license_usage')),
         ]
 
     def init_with_context(self, context):
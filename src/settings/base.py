@@ -147,8 +147,15 @@ ADMIN_TOOLS_MENU = 'menu.CustomMenu'
 ADMIN_TOOLS_INDEX_DASHBOARD = 'dashboard.CustomIndexDashboard'
 ADMIN_TOOLS_APP_INDEX_DASHBOARD = 'dashboard.CustomAppIndexDashboard'
 
+# prefix of the asset codes printed on the labels, eg: PVN00042
+AMS_ASSET_ID_PREFIX = os.environ.get('AMS_ASSET_ID_PREFIX', 'PVN')
+
 EMAIL_HOST = 'aspmx.l.google.com'
 EMAIL_USE_TLS = False
+# write the emails as files instead of sending them, eg: in development
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH')
+if EMAIL_FILE_PATH:
+    EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 
 # Debug toolbar
 INTERNAL_IPS = ['127.0.0.1']
@@ -183,3 +190,58 @@ SOCIAL_AUTH_GOOGLE_OAUTH2_AUTH_EXTRA_ARGUMENTS = {'hd': 'punch.vn'}
 
 FILER_ENABLE_PERMISSIONS = True
 FILER_IS_PUBLIC_DEFAULT = False
+
+# Engine used to pick licenses in bulk assign,
+# license_manager.allocation.GreedyAllocator is the previous behavior
+LICENSE_ALLOCATOR = 'license_manager.allocation.MinCostAllocator'
+
+# Jobs of the run-scheduler command, schedules use the crontab syntax
+# (minute hour day-of-month month day-of-week) in TIME_ZONE.
+# timeout: minutes a run may hold the job lock. Default: 60
+SCHEDULED_JOBS = [
+    {
+        'name': 'sync-gsuite-users-incremental',
+        'command': 'sync-gsuite-users',
+        'args': ['-u', 'tung.vu@punch.vn', '--incremental'],
+        'schedule': '*/10 * * * *',
+        'timeout': 30,
+    },
+    {
+        'name': 'sync-gsuite-users-full',
+        'command': 'sync-gsuite-users',
+        'args': ['-u', 'tung.vu@punch.vn'],
+        'schedule': '30 1 * * *',
+    },
+    {
+        'name': 'reconcile-license-counters',
+        'command': 'reconcile-license-counters',
+        'schedule': '0 2 * * *',
+    },
+    {
+        'name': 'clearsessions',
+        'command': 'clearsessions',
+        'schedule': '30 2 * * *',
+    },
+    {
+        'name': 'record-license-usage',
+        'command': 'record-license-usage',
+        'schedule': '50 23 * * *',
+    },
+    {
+        'name': 'cancel-stale-exchanges',
+        'command': 'cancel-stale-exchanges',
+        'schedule': '0 3 * * *',
+    },
+    {
+        'name': 'send-notifications',
+        'command': 'send-notifications',
+        'schedule': '*/5 * * * *',
+    },
+    {
+        'name': 'send-reports',
+        'command': 'send-reports',
+        'args': ['--to', 'tung.vu@punch.vn', '-u'],
+        'schedule': '0 9 * * 3',
+    },
+]
+SCHEDULER_WORKERS = 4